@@ -1,16 +1,36 @@
 import os
 import cv2
+import random
+import argparse
+import threading
+from functools import lru_cache
 import numpy as np
 from pathlib import Path
 import albumentations as A
 from tqdm import tqdm
+from array_store import ArrayStore, is_array_store
+from manifest import Manifest, array_hash, combine_hashes, code_version, MANIFEST_NAME
+from sharding import add_shard_arguments, check_shard, in_shard, shard_name, shard_suffix, write_shard_report
+from tar_shards import TarShardWriter
+from image_io import (IMAGE_FORMATS, READ_EXTENSIONS, AsyncImageWriter, read_image, find_image,
+                      output_name)
+from metrics import RunMetrics, add_metrics_arguments
+from stats import DatasetStats, PixelStats, STATS_NAME, print_stats
 
-def get_mammography_augmentation(angle):
+# Все углы поворота
+ROTATION_ANGLES = [30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330]
+
+# Шаг джиттера угла: конечный набор углов позволяет кешировать матрицы поворота
+JITTER_STEP = 0.1
+
+@lru_cache(maxsize=None)
+def get_mammography_augmentation(angle, jitter=1):
     """
-    Creates an augmentation pipeline for specific rotation angle
+    Creates an augmentation pipeline for specific rotation angle (±jitter degrees).
+    Pipelines are cached and reused for the same arguments.
     """
     return A.Compose([
-        A.Rotate(limit=[angle-1, angle+1], p=1.0),  # Конкретный угол поворота
+        A.Rotate(limit=[angle-jitter, angle+jitter], p=1.0),  # Конкретный угол поворота
         A.PadIfNeeded(
             min_height=None,
             min_width=None,
@@ -22,76 +42,425 @@ def get_mammography_augmentation(angle):
         )
     ], p=1.0)
 
-def process_and_augment_images(orig_base_path, clahe_base_path, output_base_path):
+SYMMETRY_MODES = ('off', 'dedupe', 'symlink')
+
+# folders: PNG файлы по категориям, tar: упакованные шарды (tar_shards.py)
+OUTPUT_FORMATS = ('folders', 'tar')
+
+def pad_to_divisor(image, divisor=32):
+    """Pads image with zeros to a multiple of divisor, centered like A.PadIfNeeded"""
+    h, w = image.shape[:2]
+    pad_h = -h % divisor
+    pad_w = -w % divisor
+    if not pad_h and not pad_w:
+        return image
+    top, left = pad_h // 2, pad_w // 2
+    return cv2.copyMakeBorder(image, top, pad_h - top, left, pad_w - left, cv2.BORDER_CONSTANT, value=0)
+
+def _center_fit(image, height, width):
+    """Center-crops and zero-pads image to height x width"""
+    h, w = image.shape[:2]
+    top, left = max(0, (h - height) // 2), max(0, (w - width) // 2)
+    image = image[top:top + height, left:left + width]
+    h, w = image.shape[:2]
+    pad_top, pad_left = (height - h) // 2, (width - w) // 2
+    return cv2.copyMakeBorder(image, pad_top, height - h - pad_top, pad_left, width - w - pad_left,
+                              cv2.BORDER_CONSTANT, value=0)
+
+def sample_angle(angle, jitter=1, rng=None):
+    """Draws a rotation angle from [angle-jitter, angle+jitter] on a JITTER_STEP grid"""
+    steps = int(round(jitter / JITTER_STEP))
+    k = int((rng or random).random() * (2 * steps + 1)) - steps
+    return round(angle + k * JITTER_STEP, 6)
+
+@lru_cache(maxsize=4096)
+def get_rotation_matrix(shape, angle):
+    """Returns cached affine matrix rotating an image of given shape about its center"""
+    h, w = shape
+    matrix = cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), angle, 1.0)
+    matrix.setflags(write=False)
+    return matrix
+
+def rotate_image(image, angle):
+    """
+    Rotates image about its center keeping the canvas size (same geometry as A.Rotate).
+    Right angles use exact pixel moves instead of warpAffine.
+    """
+    h, w = image.shape[:2]
+    angle = angle % 360
+    if angle == 0:
+        return image.copy()
+    if angle == 180:
+        return cv2.rotate(image, cv2.ROTATE_180)
+    if angle in (90, 270) and (h - w) % 2 == 0:
+        # При четной разнице сторон поворот на 90° - точный сдвиг пикселей
+        code = cv2.ROTATE_90_COUNTERCLOCKWISE if angle == 90 else cv2.ROTATE_90_CLOCKWISE
+        return _center_fit(cv2.rotate(image, code), h, w)
+    return cv2.warpAffine(image, get_rotation_matrix((h, w), angle), (w, h), flags=cv2.INTER_LINEAR,
+                          borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+def canonical_variant(angle, flip):
+    """
+    Maps (angle, flip) to a unique dihedral group element.
+    Vertical flip of rotation by θ equals horizontal flip of rotation by θ+180°.
+    """
+    if flip == 'vflip':
+        return (angle + 180) % 360, 'hflip'
+    return angle % 360, flip
+
+def augment_image_unique(image, source, img_file, output_dir, rotation_angles=ROTATION_ANGLES,
+                         duplicates='dedupe', writer=None):
+    """
+    Save rotated/flipped variants of one image computing each distinct group element once.
+
+    Rotations by θ+180° are exact flips of rotations by θ, so only angles below 180°
+    need warpAffine (90° uses an exact transpose). Rotation angles are exact, without
+    the ±1° jitter of get_mammography_augmentation. Vertical flips are deduplicated
+    only when the padding is even on both axes: with odd padding the extra row/column
+    moves to the other side and the outputs differ by a one-pixel shift.
+
+    Args:
+        image: Source image
+        source: 'orig' or 'clahe', used in file names
+        img_file: Source file name
+        output_dir: Output directory
+        rotation_angles: Rotation angles
+        duplicates: 'dedupe' writes each distinct image once, 'symlink' also links duplicate names to it
+        writer: Optional function(name, image, meta) called instead of writing to output_dir
+
+    Returns:
+        List of file names written or linked
+    """
+    base_rotations = {}  # поворот на angle % 180 без паддинга
+    # Поворот сохраняет размер холста, поэтому паддинг у всех вариантов одинаковый
+    h, w = image.shape[:2]
+    symmetric_padding = (-h % 32) % 2 == 0 and (-w % 32) % 2 == 0
+    written = {}  # canonical element -> file name
+    outputs = []
+
+    def rotated(angle):
+        base = angle % 180
+        if base not in base_rotations:
+            base_rotations[base] = rotate_image(image, base)
+        # Поворот на 180° - отражение по обеим осям
+        return base_rotations[base] if angle < 180 else cv2.flip(base_rotations[base], -1)
+
+    for angle in rotation_angles:
+        for flip in (None, 'hflip', 'vflip'):
+            suffix = f"{flip}_" if flip else ""
+            name = f"rotation_{angle}_{source}_{suffix}{img_file}"
+            output_path = os.path.join(output_dir, name)
+            key = canonical_variant(angle, flip) if symmetric_padding else (angle % 360, flip)
+
+            if key in written:
+                if duplicates == 'symlink':
+                    if os.path.lexists(output_path):
+                        os.remove(output_path)
+                    os.symlink(written[key], output_path)
+                    outputs.append(name)
+                continue
+
+            result = pad_to_divisor(rotated(key[0]))
+            if key[1] == 'hflip':
+                result = cv2.flip(result, 1)
+            elif key[1] == 'vflip':
+                result = cv2.flip(result, 0)
+            if writer is not None:
+                writer(name, result, {'source': source, 'angle': angle, 'flip': flip})
+            else:
+                cv2.imwrite(output_path, result)
+            written[key] = name
+            outputs.append(name)
+
+    return outputs
+
+def augment_image_pair(orig_img, clahe_img, img_file, output_dir, rotation_angles=ROTATION_ANGLES,
+                       symmetry='off', writer=None):
     """
-    Process both original and CLAHE images with augmentations
+    Save original and CLAHE images with all rotated and flipped variants.
+    symmetry='dedupe'/'symlink' skips or links duplicate variants, see augment_image_unique.
+    writer: Optional function(name, image, meta) called instead of writing files to output_dir
+    Returns list of file names written.
     """
-    # Определяем все углы поворота
-    rotation_angles = [30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330]
+    outputs = []
+    
+    def save(name, image, source, angle=None, flip=None, exact_angle=None):
+        if writer is not None:
+            writer(name, image, {'source': source, 'angle': angle, 'flip': flip, 'exact_angle': exact_angle})
+        else:
+            cv2.imwrite(os.path.join(output_dir, name), image)
+        outputs.append(name)
+    
+    # Save original versions
+    save(f"orig_{img_file}", orig_img, 'orig')
+    save(f"clahe_{img_file}", clahe_img, 'clahe')
+    
+    if symmetry != 'off':
+        outputs += augment_image_unique(orig_img, 'orig', img_file, output_dir, rotation_angles, symmetry, writer)
+        outputs += augment_image_unique(clahe_img, 'clahe', img_file, output_dir, rotation_angles, symmetry, writer)
+        return outputs
+    
+    # Apply rotations
+    for angle in rotation_angles:
+        # Оригинал и CLAHE имеют одинаковую геометрию: один угол и одна матрица поворота
+        # (то же, что A.Rotate + PadIfNeeded из get_mammography_augmentation)
+        exact_angle = sample_angle(angle)
+        
+        # Augment original image
+        aug_orig = pad_to_divisor(rotate_image(orig_img, exact_angle))
+        save(f"rotation_{angle}_orig_{img_file}", aug_orig, 'orig', angle, None, exact_angle)
+        
+        # Augment CLAHE image
+        aug_clahe = pad_to_divisor(rotate_image(clahe_img, exact_angle))
+        save(f"rotation_{angle}_clahe_{img_file}", aug_clahe, 'clahe', angle, None, exact_angle)
+        
+        # Apply flips
+        # Horizontal flip
+        save(f"rotation_{angle}_orig_hflip_{img_file}", cv2.flip(aug_orig, 1), 'orig', angle, 'hflip', exact_angle)
+        save(f"rotation_{angle}_clahe_hflip_{img_file}", cv2.flip(aug_clahe, 1), 'clahe', angle, 'hflip', exact_angle)
+        
+        # Vertical flip
+        save(f"rotation_{angle}_orig_vflip_{img_file}", cv2.flip(aug_orig, 0), 'orig', angle, 'vflip', exact_angle)
+        save(f"rotation_{angle}_clahe_vflip_{img_file}", cv2.flip(aug_clahe, 0), 'clahe', angle, 'vflip', exact_angle)
+    
+    return outputs
+
+def process_and_augment_images(orig_base_path, clahe_base_path, output_base_path, symmetry='off',
+                               force=False, shard_index=0, shard_count=1, output_format='folders',
+                               tar_shard_bytes=1 << 30, image_format='png', compression=None,
+                               writer_threads=2, max_pending=32, metrics=None):
+    """
+    Process both original and CLAHE images with augmentations.
+    Source paths may be image folders or array stores (see array_store.py).
+    symmetry: 'off' (all variants), 'dedupe' or 'symlink' for duplicate rotation/flip outputs
+    force: Reprocess all images; otherwise images up to date in the output manifest are skipped
+    shard_index, shard_count: Process only images whose filename hash falls into this shard
+    output_format: 'folders' writes image files per category, 'tar' packs samples with their
+        metadata into tar shards of about tar_shard_bytes (rewritten on every run, no manifest)
+    image_format, compression: File format and compression level for 'folders', see image_io.encode_image
+    writer_threads, max_pending: Background encoder threads and the maximum number of images
+        waiting for them; rotation of the next images overlaps with encoding
+    metrics: Optional RunMetrics; per image 'decode' (reading and hashing the inputs), 'compute'
+        (rotations and flips), 'encode', 'stats' and 'write_wait' (blocked on a full writer queue) are recorded
+    
+    Pixel statistics of the written images are accumulated per source image from the arrays in
+    memory and saved to <output_base_path>/.stats.json (see stats.py); symlinked duplicates count
+    as images but not as pixels. Up-to-date images without statistics are processed again.
+    """
+    check_shard(shard_index, shard_count)
+    if metrics is None:
+        metrics = RunMetrics('augmentation')
+    tar_writer = None
+    if output_format == 'tar':
+        prefix = 'augmented' if shard_count <= 1 else f"augmented-{shard_suffix(shard_index, shard_count)}"
+        tar_writer = TarShardWriter(output_base_path, prefix, max_bytes=tar_shard_bytes)
+        # В tar нет символических ссылок, дубликаты просто пропускаются
+        symmetry = 'dedupe' if symmetry == 'symlink' else symmetry
+    image_writer = (AsyncImageWriter(image_format, compression, writer_threads, max_pending, metrics)
+                    if tar_writer is None else None)
+    results_lock = threading.Lock()
+    manifest = Manifest(output_base_path,
+                        {'rotation_angles': ROTATION_ANGLES, 'jitter_step': JITTER_STEP, 'symmetry': symmetry,
+                         'format': image_format, 'compression': compression},
+                        code_version(__file__), name=shard_name(MANIFEST_NAME, shard_index, shard_count),
+                        fallback=MANIFEST_NAME)
+    stats = DatasetStats(output_base_path, shard_name(STATS_NAME, shard_index, shard_count),
+                         fallback=STATS_NAME)
+    if force:
+        manifest.entries = {}
+    if force or tar_writer is not None:
+        # tar шарды переписываются при каждом запуске, статистика тоже
+        stats.entries = {}
+    seen_keys = []
+    skipped = 0
+    successful = {}
+    failed = []
+    
+    orig_store = ArrayStore(orig_base_path) if is_array_store(orig_base_path) else None
+    clahe_store = ArrayStore(clahe_base_path) if is_array_store(clahe_base_path) else None
     
     # Get all subdirectories
-    subdirs = [d for d in os.listdir(orig_base_path) 
-              if os.path.isdir(os.path.join(orig_base_path, d))]
+    if orig_store is not None:
+        subdirs = orig_store.categories()
+    else:
+        subdirs = [d for d in os.listdir(orig_base_path) 
+                  if os.path.isdir(os.path.join(orig_base_path, d)) and not d.startswith('.')]
     
     for subdir in subdirs:
         print(f"\nProcessing {subdir}")
         
         output_dir = os.path.join(output_base_path, subdir)
-        os.makedirs(output_dir, exist_ok=True)
+        if tar_writer is None:
+            os.makedirs(output_dir, exist_ok=True)
         
         orig_dir = os.path.join(orig_base_path, subdir)
         clahe_dir = os.path.join(clahe_base_path, subdir)
         
-        # Get all image files
-        image_files = [f for f in os.listdir(orig_dir) 
-                      if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif'))]
+        # Get all image files (store names get .png so output names stay the same)
+        if orig_store is not None:
+            image_files = [f"{name}.png" for name in orig_store.names(subdir)]
+        else:
+            image_files = [f for f in os.listdir(orig_dir) 
+                          if f.lower().endswith(READ_EXTENSIONS)]
+        image_files = [f for f in image_files if in_shard(f, shard_index, shard_count)]
         
         for img_file in tqdm(image_files, desc="Augmenting images"):
             # Read images
             orig_path = os.path.join(orig_dir, img_file)
-            clahe_path = os.path.join(clahe_dir, f"clahe_{img_file}")
+            # CLAHE может быть сохранен в другом формате, чем оригинал
+            clahe_path = (find_image(clahe_dir, f"clahe_{img_file}") if clahe_store is None else None) \
+                or os.path.join(clahe_dir, f"clahe_{img_file}")
+            
+            key = f"{subdir}/{img_file}"
+            seen_keys.append(key)
+            try:
+                with metrics.phase(key, 'decode'):
+                    if orig_store is not None:
+                        orig_img = orig_store.get(subdir, Path(img_file).stem)
+                        orig_hash = array_hash(orig_img) if tar_writer is None else ''
+                    else:
+                        orig_img = None
+                        orig_hash = manifest.input_hash(orig_path) if tar_writer is None else ''
+                    if clahe_store is not None:
+                        clahe_img = clahe_store.get(subdir, f"clahe_{Path(img_file).stem}")
+                        clahe_hash = array_hash(clahe_img) if tar_writer is None else ''
+                    else:
+                        clahe_img = None
+                        clahe_hash = manifest.input_hash(clahe_path) if tar_writer is None else ''
+            except (OSError, KeyError):
+                # KeyError: изображения нет в хранилище массивов
+                print(f"Error reading images for {img_file}")
+                failed.append((img_file, "Error reading images"))
+                continue
+            
+            # Пропускаем изображения, для которых все выходы актуальны
+            input_hash = combine_hashes(orig_hash, clahe_hash)
+            if tar_writer is None and key in stats and manifest.is_current(
+                    key, input_hash, lambda name: os.path.lexists(os.path.join(output_dir, name))):
+                skipped += 1
+                with results_lock:
+                    successful[subdir] = successful.get(subdir, 0) + 1
+                continue
             
-            orig_img = cv2.imread(orig_path, cv2.IMREAD_GRAYSCALE)
-            clahe_img = cv2.imread(clahe_path, cv2.IMREAD_GRAYSCALE)
+            with metrics.phase(key, 'decode'):
+                if orig_img is None:
+                    orig_img = read_image(orig_path)
+                    metrics.count(key, bytes_read=os.path.getsize(orig_path) if orig_img is not None else 0)
+                if clahe_img is None:
+                    clahe_img = read_image(clahe_path)
+                    metrics.count(key, bytes_read=os.path.getsize(clahe_path) if clahe_img is not None else 0)
             
             if orig_img is None or clahe_img is None:
                 print(f"Error reading images for {img_file}")
+                failed.append((img_file, "Error reading images"))
+                continue
+            
+            # Статистика пикселей по всем вариантам исходного изображения.
+            # Отражения только переставляют пиксели, поэтому считаются один раз на (источник, угол)
+            pair_stats = PixelStats()
+            variants = {}
+            def add_stats(image, meta, key=key, pair_stats=pair_stats, variants=variants):
+                with metrics.phase(key, 'stats'):
+                    variant = (meta['source'], meta['angle']) if meta['angle'] is not None else None
+                    pixels = variants.get(variant) if variant is not None else None
+                    if pixels is None:
+                        pixels = PixelStats.from_image(image)
+                        if variant is not None:
+                            variants[variant] = pixels
+                    pair_stats.merge(pixels)
+            
+            if tar_writer is not None:
+                # Ключ образца: <category>/<имя файла без расширения>, метаданные рядом с изображением
+                def write_sample(name, image, meta):
+                    add_stats(image, meta)
+                    with metrics.phase(key, 'encode'):
+                        size = tar_writer.write(f"{subdir}/{Path(name).stem}", image,
+                                                {'category': subdir, 'image': img_file, **meta})
+                    metrics.count(key, bytes_written=size)
+                with metrics.phase(key, 'compute'):
+                    outputs = augment_image_pair(orig_img, clahe_img, img_file, output_dir, symmetry=symmetry,
+                                                 writer=write_sample)
+                stats.record(key, subdir, pair_stats, len(outputs))
+                successful[subdir] = successful.get(subdir, 0) + 1
                 continue
             
-            # Save original versions
-            cv2.imwrite(os.path.join(output_dir, f"orig_{img_file}"), orig_img)
-            cv2.imwrite(os.path.join(output_dir, f"clahe_{img_file}"), clahe_img)
+            # Кодирование и запись идут в фоновых потоках, пока поворачиваются следующие изображения
+            futures = []
+            def write_file(name, image, meta, output_dir=output_dir, key=key):
+                add_stats(image, meta)
+                with metrics.phase(key, 'write_wait'):
+                    futures.append(image_writer.write(os.path.join(output_dir, name), image, key))
+            with metrics.phase(key, 'compute'):
+                outputs = augment_image_pair(orig_img, clahe_img, output_name(img_file, image_format),
+                                             output_dir, symmetry=symmetry, writer=write_file)
+            # Удаляем выходы прежнего запуска, которых больше нет (например, после смены symmetry)
+            for name in manifest.stale_outputs(key, outputs):
+                if os.path.lexists(os.path.join(output_dir, name)):
+                    os.remove(os.path.join(output_dir, name))
             
-            # Apply rotations
-            for angle in rotation_angles:
-                transform = get_mammography_augmentation(angle)
-                
-                # Augment original image
-                aug_orig = transform(image=orig_img)['image']
-                cv2.imwrite(os.path.join(output_dir, f"rotation_{angle}_orig_{img_file}"), aug_orig)
-                
-                # Augment CLAHE image
-                aug_clahe = transform(image=clahe_img)['image']
-                cv2.imwrite(os.path.join(output_dir, f"rotation_{angle}_clahe_{img_file}"), aug_clahe)
-                
-                # Apply flips
-                # Horizontal flip
-                h_flip_orig = cv2.flip(aug_orig, 1)
-                h_flip_clahe = cv2.flip(aug_clahe, 1)
-                cv2.imwrite(os.path.join(output_dir, f"rotation_{angle}_orig_hflip_{img_file}"), h_flip_orig)
-                cv2.imwrite(os.path.join(output_dir, f"rotation_{angle}_clahe_hflip_{img_file}"), h_flip_clahe)
-                
-                # Vertical flip
-                v_flip_orig = cv2.flip(aug_orig, 0)
-                v_flip_clahe = cv2.flip(aug_clahe, 0)
-                cv2.imwrite(os.path.join(output_dir, f"rotation_{angle}_orig_vflip_{img_file}"), v_flip_orig)
-                cv2.imwrite(os.path.join(output_dir, f"rotation_{angle}_clahe_vflip_{img_file}"), v_flip_clahe)
+            # В манифест попадают только полностью записанные изображения
+            def finished(error, subdir=subdir, img_file=img_file, key=key, input_hash=input_hash, outputs=outputs,
+                         pair_stats=pair_stats):
+                if error is not None:
+                    print(f"Error writing images for {img_file}: {error}")
+                    failed.append((img_file, str(error)))
+                    return
+                manifest.record(key, input_hash, outputs)
+                stats.record(key, subdir, pair_stats, len(outputs))
+                with results_lock:
+                    successful[subdir] = successful.get(subdir, 0) + 1
+            image_writer.when_done(futures, finished)
+    
+    if image_writer is not None:
+        image_writer.close()
+    if tar_writer is not None:
+        tar_writer.close()
+    else:
+        manifest.close()
+    if shard_count <= 1:
+        stats.prune(seen_keys)
+    stats.close()
+    print_stats(stats.summary())
+    if skipped:
+        print(f"\nSkipped {skipped} up-to-date images")
+    if shard_count > 1:
+        write_shard_report(output_base_path, 'augment', shard_index, shard_count, successful, failed)
+        print(f"\nShard {shard_index} of {shard_count} done; after all shards run: "
+              f"python sharding.py augment {output_base_path}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rotate/flip augmentation of original and CLAHE images')
+    parser.add_argument('--symmetry', choices=SYMMETRY_MODES, default='off',
+                        help='Skip (dedupe) or symlink rotation/flip outputs that duplicate each other')
+    parser.add_argument('--force', action='store_true',
+                        help='Reprocess all images, ignoring the manifest of up-to-date outputs')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default='folders',
+                        help='PNG files per category (augmented_dataset/) or packed tar shards (augmented_shards/)')
+    parser.add_argument('--tar-shard-size', type=int, default=1024,
+                        help='Approximate size of one tar shard in MB')
+    parser.add_argument('--format', choices=IMAGE_FORMATS, default='png',
+                        help='Image file format for the folders output')
+    parser.add_argument('--compression', type=int, default=None,
+                        help='PNG zlib level 0-9 (default: OpenCV default); for TIFF 0 disables LZW')
+    parser.add_argument('--writer-threads', type=int, default=2,
+                        help='Background threads encoding and writing images')
+    parser.add_argument('--max-pending', type=int, default=32,
+                        help='Maximum number of images waiting to be written')
+    add_shard_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = RunMetrics('augmentation', {key: value for key, value in vars(args).items()
+                                          if key not in ('metrics', 'profile')}, profile=bool(args.profile))
+    
     # Define paths
     orig_base_path = "./mass_images"
     clahe_base_path = "./mass_images_clahe"
-    output_base_path = "./augmented_dataset"
+    output_base_path = "./augmented_dataset" if args.output_format == 'folders' else "./augmented_shards"
    
-    process_and_augment_images(orig_base_path, clahe_base_path, output_base_path)
-    print("\nAugmentation completed!")  
\ No newline at end of file
+    with metrics.stage('augment'):
+        process_and_augment_images(orig_base_path, clahe_base_path, output_base_path, args.symmetry, args.force,
+                                   args.shard_index, args.shard_count, args.output_format,
+                                   args.tar_shard_size << 20, args.format, args.compression,
+                                   args.writer_threads, args.max_pending, metrics)
+    print("\nAugmentation completed!")
+    metrics.finish(args.metrics, args.profile)  
\ No newline at end of file
@@ -0,0 +1,280 @@
+import os
+import json
+import sqlite3
+from pathlib import Path
+
+DB_NAME = 'all_annotations.db'
+JSONL_NAME = 'all_annotations.jsonl'
+JSON_NAME = 'all_annotations.json'
+
+# Колонки с индексами, по ним можно фильтровать и группировать
+INDEXED_COLUMNS = ('filename', 'category', 'density', 'mass_type', 'laterality', 'view')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS annotations (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    pixel_spacing TEXT,
+    density INTEGER,
+    mass_type TEXT,
+    category TEXT,
+    birads,
+    laterality TEXT,
+    view TEXT,
+    date TEXT,
+    mass INTEGER,
+    calcification INTEGER,
+    distortion INTEGER,
+    asymmetry INTEGER,
+    description TEXT,
+    lesion_annotation TEXT,
+    extra TEXT
+)
+'''
+
+# Ключи аннотации, которые хранятся в отдельных колонках; остальное - в extra (JSON)
+_SECTIONS = {
+    'image': {'width': 'width', 'height': 'height', 'pixel_spacing': 'pixel_spacing'},
+    'classification': {'density': 'density', 'mass_type': 'mass_type', 'category': 'category', 'birads': 'birads'},
+    'exam': {'laterality': 'laterality', 'view': 'view', 'date': 'date'},
+    'findings': {'mass': 'mass', 'calcification': 'calcification', 'distortion': 'distortion',
+                 'asymmetry': 'asymmetry', 'description': 'description',
+                 'lesion_annotation': 'lesion_annotation'}
+}
+_BOOL_COLUMNS = ('mass', 'calcification', 'distortion', 'asymmetry')
+
+def _annotation_to_row(annotation):
+    """Flattens annotation dictionary into a table row"""
+    row = {'filename': annotation['filename']}
+    extra = {key: value for key, value in annotation.items() if key not in _SECTIONS and key != 'filename'}
+    for section, columns in _SECTIONS.items():
+        values = annotation.get(section, {})
+        for key, column in columns.items():
+            row[column] = values.get(key)
+        section_extra = {key: value for key, value in values.items() if key not in columns}
+        if section_extra:
+            extra.setdefault('_sections', {})[section] = section_extra
+    row['pixel_spacing'] = json.dumps(list(row['pixel_spacing']), default=float) \
+        if row['pixel_spacing'] is not None else None
+    row['extra'] = json.dumps(extra, ensure_ascii=False) if extra else None
+    return row
+
+def _row_to_annotation(row):
+    """Rebuilds annotation dictionary (same structure as all_annotations.json) from a table row"""
+    extra = json.loads(row['extra']) if row['extra'] else {}
+    section_extra = extra.pop('_sections', {})
+    annotation = {'filename': row['filename']}
+    for section, columns in _SECTIONS.items():
+        values = {}
+        for key, column in columns.items():
+            value = row[column]
+            if column == 'pixel_spacing' and value is not None:
+                value = json.loads(value)
+            elif column in _BOOL_COLUMNS and value is not None:
+                value = bool(value)
+            values[key] = value
+        values.update(section_extra.get(section, {}))
+        annotation[section] = values
+    annotation.update(extra)
+    return annotation
+
+def write_annotation_store(annotations, db_path):
+    """
+    Write annotations to an indexed SQLite store, replacing its contents.
+
+    Args:
+        annotations: Iterable of annotation dictionaries
+        db_path: Path of the SQLite file
+    """
+    tmp_path = f"{db_path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        _fill(conn, annotations)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+
+def _fill(conn, annotations):
+    conn.execute(SCHEMA)
+    for column in INDEXED_COLUMNS:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{column} ON annotations ({column})")
+    rows = (_annotation_to_row(annotation) for annotation in annotations)
+    conn.executemany(
+        "INSERT INTO annotations (filename, width, height, pixel_spacing, density, mass_type, category, birads, "
+        "laterality, view, date, mass, calcification, distortion, asymmetry, description, lesion_annotation, extra) "
+        "VALUES (:filename, :width, :height, :pixel_spacing, :density, :mass_type, :category, :birads, "
+        ":laterality, :view, :date, :mass, :calcification, :distortion, :asymmetry, :description, "
+        ":lesion_annotation, :extra)", rows)
+
+class AnnotationStore:
+    """
+    Query API over annotations kept in an indexed SQLite table.
+
+    Opening a .json or .jsonl file imports it into an in-memory table, so the same queries
+    work for both formats. Results keep the original annotation order.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        if self.path.suffix in ('.json', '.jsonl'):
+            self.conn = sqlite3.connect(':memory:')
+            _fill(self.conn, iter_annotations(self.path))
+        else:
+            self.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        self.conn.row_factory = sqlite3.Row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _where(self, filters):
+        """Builds WHERE clause; filter values may be a single value or a list"""
+        clauses, params = [], []
+        for column, value in filters.items():
+            if column not in INDEXED_COLUMNS:
+                raise ValueError(f"Cannot filter by {column}, indexed columns: {INDEXED_COLUMNS}")
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                clauses.append(f"{column} IN ({', '.join('?' * len(value))})")
+                params.extend(value)
+            elif value is None:
+                clauses.append(f"{column} IS NULL")
+            else:
+                clauses.append(f"{column} = ?")
+                params.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def iter(self, **filters):
+        """Yields annotation dictionaries matching filters, row by row"""
+        where, params = self._where(filters)
+        cursor = self.conn.execute(f"SELECT * FROM annotations{where} ORDER BY id", params)
+        for row in cursor:
+            yield _row_to_annotation(row)
+
+    def query(self, **filters):
+        """Returns list of annotation dictionaries matching filters, e.g. query(category='Density1+Benign')"""
+        return list(self.iter(**filters))
+
+    def count(self, **filters):
+        """Returns number of annotations matching filters"""
+        where, params = self._where(filters)
+        return self.conn.execute(f"SELECT COUNT(*) FROM annotations{where}", params).fetchone()[0]
+
+    def count_by(self, column, **filters):
+        """Returns {value: count} grouped by an indexed column"""
+        if column not in INDEXED_COLUMNS:
+            raise ValueError(f"Cannot group by {column}, indexed columns: {INDEXED_COLUMNS}")
+        where, params = self._where(filters)
+        cursor = self.conn.execute(f"SELECT {column}, COUNT(*) FROM annotations{where} GROUP BY {column}", params)
+        return dict(cursor.fetchall())
+
+    def export_json(self, json_path):
+        """Export all annotations in the all_annotations.json format"""
+        write_json_array(self.iter(), json_path)
+
+    def close(self):
+        self.conn.close()
+
+class AnnotationWriter:
+    """
+    Streaming writer for JSON Lines annotations (one annotation per line).
+
+    Every annotation is flushed as soon as it is written, so a crash keeps
+    all finished rows and memory does not grow with the dataset size.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.count = 0
+        self._file = open(self.path, 'w', encoding='utf-8')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, annotation):
+        """Append one annotation; returns number of bytes written"""
+        line = json.dumps(annotation, ensure_ascii=False) + '\n'
+        self._file.write(line)
+        self._file.flush()
+        self.count += 1
+        return len(line.encode('utf-8'))
+
+    def close(self):
+        self._file.close()
+
+def _matches(annotation, filters):
+    """Checks annotation dictionary against AnnotationStore-style filters"""
+    row = _annotation_to_row(annotation)
+    for column, value in filters.items():
+        if column not in INDEXED_COLUMNS:
+            raise ValueError(f"Cannot filter by {column}, indexed columns: {INDEXED_COLUMNS}")
+        if isinstance(value, (list, tuple, set)):
+            if row[column] not in value:
+                return False
+        elif row[column] != value:
+            return False
+    return True
+
+def iter_annotations(path, **filters):
+    """
+    Yields annotations from a .jsonl, .json or SQLite (.db) file one at a time.
+
+    JSON Lines and SQLite are read incrementally; a .json array has to be parsed
+    whole. A truncated last line (interrupted run) is skipped.
+
+    Args:
+        path: Annotations file
+        **filters: Optional filters on indexed columns, e.g. category=['Density1+Benign']
+    """
+    path = Path(path)
+    if path.suffix == '.jsonl':
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                if line.strip():
+                    annotation = json.loads(line)
+                    if not filters or _matches(annotation, filters):
+                        yield annotation
+    elif path.suffix == '.json':
+        with open(path, 'r', encoding='utf-8') as f:
+            annotations = json.load(f)
+        for annotation in annotations:
+            if not filters or _matches(annotation, filters):
+                yield annotation
+    else:
+        with AnnotationStore(path) as store:
+            yield from store.iter(**filters)
+
+def write_json_array(annotations, json_path):
+    """Writes annotations as an indented JSON array (same text as json.dump(..., indent=2)) without building a list"""
+    tmp_path = f"{json_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        first = True
+        for annotation in annotations:
+            text = json.dumps(annotation, indent=2, ensure_ascii=False).replace('\n', '\n  ')
+            f.write(('[\n  ' if first else ',\n  ') + text)
+            first = False
+        f.write('[]' if first else '\n]')
+    os.replace(tmp_path, json_path)
+
+def default_annotations_path(annotations_dir):
+    """
+    Returns the most recently written annotations file in annotations_dir:
+    SQLite store, JSON Lines or all_annotations.json (preferred in this order on ties)
+    """
+    candidates = [Path(annotations_dir) / name for name in (DB_NAME, JSONL_NAME, JSON_NAME)]
+    existing = [path for path in candidates if path.exists()]
+    if not existing:
+        return candidates[-1]
+    return max(existing, key=lambda path: (path.stat().st_mtime, -candidates.index(path)))
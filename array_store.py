@@ -0,0 +1,186 @@
+import os
+import json
+import threading
+import numpy as np
+from pathlib import Path
+
+INDEX_NAME = 'index.json'
+ALIGNMENT = 64  # выравнивание начала каждого изображения в файле
+
+STORAGE_FORMATS = ('png', 'npy')
+
+def is_array_store(path):
+    """Checks whether path is an array store directory"""
+    return (Path(path) / INDEX_NAME).is_file()
+
+class ArrayStore:
+    """
+    Packed array store for images: one raw file per category plus an offset/shape index.
+
+    Layout:
+        <base>/<category>.bin   images stored back to back (64-byte aligned)
+        <base>/index.json       {category: {name: {offset, shape, dtype}}}
+
+    Reading returns zero-copy views into a read-only np.memmap of the category file,
+    so there is no decode step. Writing is thread-safe; the index is saved on close().
+    """
+
+    def __init__(self, base_path, mode='r'):
+        """
+        Args:
+            base_path: Store directory
+            mode: 'r' read, 'a' append to existing store, 'w' start a new store
+        """
+        if mode not in ('r', 'a', 'w'):
+            raise ValueError(f"Unknown store mode: {mode}")
+        self.base_path = Path(base_path)
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._maps = {}
+        self._files = {}
+
+        if mode == 'w':
+            self.base_path.mkdir(parents=True, exist_ok=True)
+            for bin_path in self.base_path.glob('*.bin'):
+                bin_path.unlink()
+            self.index = {}
+            self._save_index()
+        elif mode == 'a' and not is_array_store(self.base_path):
+            self.base_path.mkdir(parents=True, exist_ok=True)
+            self.index = {}
+        else:
+            with open(self.base_path / INDEX_NAME, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def categories(self):
+        """Returns sorted list of categories"""
+        return sorted(self.index)
+
+    def names(self, category):
+        """Returns sorted list of image names in category"""
+        return sorted(self.index.get(category, {}))
+
+    def __contains__(self, key):
+        category, name = key
+        return name in self.index.get(category, {})
+
+    def put(self, category, name, array):
+        """
+        Store image array under category/name.
+
+        An image replacing one of the same shape and dtype is written over it in place; otherwise it
+        is appended and the old bytes are reclaimed by compact() on close().
+        """
+        if self.mode == 'r':
+            raise IOError("Array store is opened read-only")
+        array = np.ascontiguousarray(array)
+        with self._lock:
+            f = self._files.get(category)
+            if f is None:
+                bin_path = self.base_path / f"{category}.bin"
+                f = self._files[category] = open(bin_path, 'r+b' if bin_path.exists() else 'w+b')
+            entry = self.index.get(category, {}).get(name)
+            if entry is not None and entry['shape'] == list(array.shape) and entry['dtype'] == array.dtype.str:
+                f.seek(entry['offset'])
+                f.write(array.data)
+                self._maps.pop(category, None)
+                return
+            offset = f.seek(0, os.SEEK_END)
+            padding = -offset % ALIGNMENT
+            if padding:
+                f.write(b'\0' * padding)
+                offset += padding
+            f.write(array.data)
+            self.index.setdefault(category, {})[name] = {
+                'offset': offset,
+                'shape': list(array.shape),
+                'dtype': array.dtype.str
+            }
+            # Старая карта памяти не видит новых данных
+            self._maps.pop(category, None)
+
+    def get(self, category, name):
+        """Returns read-only zero-copy view of the image"""
+        entry = self.index[category][name]
+        mm = self._maps.get(category)
+        if mm is None:
+            for f in self._files.values():
+                f.flush()
+            mm = self._maps[category] = np.memmap(self.base_path / f"{category}.bin", dtype=np.uint8, mode='r')
+        dtype = np.dtype(entry['dtype'])
+        nbytes = int(np.prod(entry['shape'])) * dtype.itemsize
+        start = entry['offset']
+        return mm[start:start + nbytes].view(dtype).reshape(entry['shape'])
+
+    def items(self, category):
+        """Yields (name, image) pairs for category"""
+        for name in self.names(category):
+            yield name, self.get(category, name)
+
+    def _save_index(self):
+        tmp_path = self.base_path / f"{INDEX_NAME}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.base_path / INDEX_NAME)
+
+    def compact(self, categories=None):
+        """
+        Rewrite the live images of categories (default: all) into new data files, dropping
+        the bytes of replaced images. Views returned by get() before are invalid afterwards.
+        """
+        if self.mode == 'r':
+            raise IOError("Array store is opened read-only")
+        with self._lock:
+            self._compact(self.categories() if categories is None else categories)
+
+    def _compact(self, categories):
+        for category in categories:
+            f = self._files.pop(category, None)
+            if f is not None:
+                f.close()
+            self._maps.pop(category, None)
+            bin_path = self.base_path / f"{category}.bin"
+            tmp_path = bin_path.with_name(f"{bin_path.name}.tmp")
+            entries = self.index.get(category, {})
+            mm = np.memmap(bin_path, dtype=np.uint8, mode='r') if entries else None
+            compacted = {}
+            with open(tmp_path, 'wb') as out:
+                # В порядке смещений, чтобы читать исходный файл последовательно
+                for name, entry in sorted(entries.items(), key=lambda item: item[1]['offset']):
+                    offset = out.tell()
+                    padding = -offset % ALIGNMENT
+                    if padding:
+                        out.write(b'\0' * padding)
+                        offset += padding
+                    nbytes = int(np.prod(entry['shape'])) * np.dtype(entry['dtype']).itemsize
+                    out.write(mm[entry['offset']:entry['offset'] + nbytes].data)
+                    compacted[name] = {**entry, 'offset': offset}
+            del mm
+            os.replace(tmp_path, bin_path)
+            self.index[category] = compacted
+            self._save_index()
+
+    def _wasted(self, category):
+        """Checks whether the data file of category holds bytes of replaced images"""
+        entries = self.index.get(category, {}).values()
+        live = sum(int(np.prod(entry['shape'])) * np.dtype(entry['dtype']).itemsize for entry in entries)
+        # Выравнивание добавляет меньше ALIGNMENT байт на изображение
+        return os.path.getsize(self.base_path / f"{category}.bin") >= live + ALIGNMENT * len(entries)
+
+    def close(self):
+        """Flush data files, compact the written files that hold replaced images and save the index"""
+        with self._lock:
+            written = list(self._files)
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+            self._maps = {}
+            if self.mode != 'r':
+                self._compact([category for category in written if self._wasted(category)])
+                self._save_index()
@@ -1,5 +1,8 @@
 import os
+import argparse
 from pathlib import Path
+from tar_shards import is_tar_shard_dir, category_counts
+from stats import load_summary
 
 def count_files_in_augmented_dataset(base_path="augmented_dataset"):
     categories = [
@@ -17,7 +20,19 @@ def count_files_in_augmented_dataset(base_path="augmented_dataset"):
     print("\nFiles distribution:")
     print("-" * 40)
     
+    # Счетчики из статистики аугментации; без нее tar шарды считаем по индексам, без чтения архивов
+    summary = load_summary(base_path)
+    if summary:
+        counts = {category: item['images'] for category, item in summary.items()}
+    else:
+        counts = category_counts(base_path) if is_tar_shard_dir(base_path) else None
+    
     for category in categories:
+        if counts is not None:
+            num_files = counts.get(category, 0)
+            total_files += num_files
+            print(f"{category}: {num_files:,} samples")
+            continue
         path = Path(base_path) / category
         if path.exists():
             files = list(path.glob("*"))
@@ -29,4 +44,8 @@ def count_files_in_augmented_dataset(base_path="augmented_dataset"):
     print(f"Total files: {total_files:,}")
 
 if __name__ == "__main__":
-    count_files_in_augmented_dataset()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Count augmented images per category')
+    parser.add_argument('path', nargs='?', default='augmented_dataset',
+                        help='augmented_dataset folder or tar shard directory (augmented_shards)')
+    args = parser.parse_args()
+    count_files_in_augmented_dataset(args.path)
\ No newline at end of file
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tracemalloc
+import importlib
+from pathlib import Path
+from datetime import datetime, timezone
+
+import cv2
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+import data_augmentation
+from clahe import apply_clahe
+from dicom_converter import read_dicom, normalize_dicom, convert_dicom_to_png
+
+# Имя файла скрипта аугментации содержит кириллическую букву
+augmentation = importlib.import_module('Comb_Auп_for_Orig_and_CLAHE_Images')
+
+# Размеры снимков INbreast (ширина x высота), как в аннотациях: портретные 2560x3328 и 3328x4084
+DEFAULT_SIZES = ((2560, 3328), (3328, 4084))
+BATCH_SIZE = 8  # изображений в пакете для бенчмарков онлайн-аугментации
+RESULTS_NAME = 'benchmark_results.jsonl'
+FIXTURES_DIR = '.bench_fixtures'
+
+def synthetic_mammogram(width, height, seed=0):
+    """
+    Returns 14-bit mammogram-like image in uint16: a breast-shaped region with
+    smooth falloff towards the skin line, tissue texture and detector noise on
+    a dark background.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    # Полуэллипс груди у левого края снимка
+    r = np.sqrt((x / (0.75 * width)) ** 2 + ((y - height / 2) / (0.48 * height)) ** 2)
+    breast = np.clip(1.0 - r, 0, None) ** 0.35
+    # Текстура ткани: сглаженный шум
+    texture = cv2.GaussianBlur(rng.standard_normal((height, width)).astype(np.float32), (0, 0), 12)
+    texture /= np.abs(texture).max() + 1e-6
+    image = 300 + breast * (9000 + 3000 * texture) + rng.normal(0, 40, (height, width)).astype(np.float32)
+    return np.clip(image, 0, 2 ** 14 - 1).astype(np.uint16)
+
+def write_synthetic_dicom(path, width, height, seed=0):
+    """Writes synthetic 16-bit MONOCHROME2 mammogram DICOM"""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.1.2'  # Digital Mammography X-Ray Image
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'MG'
+    ds.Rows = height
+    ds.Columns = width
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 14
+    ds.HighBit = 13
+    ds.PixelRepresentation = 0
+    ds.PixelSpacing = [0.07, 0.07]
+    ds.WindowCenter = 6000
+    ds.WindowWidth = 10000
+    ds.PixelData = synthetic_mammogram(width, height, seed).tobytes()
+    ds.save_as(path, enforce_file_format=True)
+
+def get_fixture(fixtures_dir, width, height):
+    """Returns path of the synthetic DICOM for a size, generating it once"""
+    path = Path(fixtures_dir) / f"synthetic_{width}x{height}.dcm"
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        print(f"Generating {path}...")
+        write_synthetic_dicom(path, width, height)
+    return path
+
+def measure(fn, repeat):
+    """
+    Run fn repeat times.
+
+    Returns:
+        Dictionary with median/min seconds and peak traced memory (MB)
+    """
+    times = []
+    peak = 0
+    for _ in range(repeat):
+        tracemalloc.start()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        'seconds': statistics.median(times),
+        'min_seconds': min(times),
+        'peak_mb': peak / 2 ** 20
+    }
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=3, fixtures_dir=FIXTURES_DIR, only=None):
+    """
+    Time every pipeline stage on synthetic DICOMs.
+
+    Args:
+        sizes: List of (width, height)
+        repeat: Repetitions per benchmark (the augmentation loop runs once)
+        fixtures_dir: Directory for generated DICOMs and temporary outputs
+        only: Optional collection of benchmark names to run
+
+    Returns:
+        List of result dictionaries
+    """
+    results = []
+    output_dir = Path(fixtures_dir) / 'output'
+
+    for width, height in sizes:
+        dicom_path = get_fixture(fixtures_dir, width, height)
+        dicom_data = read_dicom(dicom_path)
+        image = normalize_dicom(dicom_data)
+        clahe_img = apply_clahe(image)
+        batch = np.stack([image] * BATCH_SIZE)
+        online_augmentation = data_augmentation.get_mammography_augmentation()
+        megapixels = width * height / 1e6
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        # (имя, функция, число изображений за вызов, повторы)
+        benchmarks = [
+            ('read_dicom', lambda: read_dicom(dicom_path), 1, repeat),
+            ('normalize_dicom', lambda: normalize_dicom(dicom_data), 1, repeat),
+            ('normalize_dicom_voi16', lambda: normalize_dicom(dicom_data, 'voi', 16), 1, repeat),
+            ('convert_dicom_to_png',
+             lambda: convert_dicom_to_png(dicom_path, output_dir / 'converted.png'), 1, repeat),
+            ('apply_clahe', lambda: apply_clahe(image), 1, repeat),
+            ('get_mammography_augmentation',
+             lambda: augmentation.get_mammography_augmentation(30)(image=image), 1, repeat),
+            ('augmentation_loop',
+             lambda: augmentation.augment_image_pair(image, clahe_img, 'bench.png', str(output_dir)),
+             2 + 6 * len(augmentation.ROTATION_ANGLES), 1),
+            ('augmentation_loop_dedupe',
+             lambda: augmentation.augment_image_pair(image, clahe_img, 'bench.png', str(output_dir),
+                                                     symmetry='dedupe'),
+             2 + 6 * len(augmentation.ROTATION_ANGLES), 1),
+            ('online_augmentation_albumentations',
+             lambda: [online_augmentation(image=img) for img in batch], BATCH_SIZE, repeat),
+            ('online_augmentation_batch',
+             lambda: data_augmentation.augment_batch(batch, seed=0), BATCH_SIZE, repeat),
+        ]
+
+        for name, fn, images, runs in benchmarks:
+            if only and name not in only:
+                continue
+            result = measure(fn, runs)
+            result.update({
+                'name': name,
+                'size': f"{width}x{height}",
+                'images_per_second': images / result['seconds'],
+                'megapixels_per_second': images * megapixels / result['seconds'],
+                'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            })
+            results.append(result)
+            print(f"{name:<30} {width}x{height}  {result['seconds'] * 1000:9.1f} ms  "
+                  f"{result['images_per_second']:8.2f} img/s  {result['peak_mb']:8.1f} MB peak")
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+def git_commit():
+    """Returns (commit hash, dirty flag) of the working tree or ('unknown', False)"""
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=cwd, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=cwd,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown', False
+
+def save_results(results, results_path):
+    """Appends run record (commit, environment, results) to the JSON Lines results file"""
+    commit, dirty = git_commit()
+    record = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': commit,
+        'dirty': dirty,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'pydicom': pydicom.__version__,
+        'cpu_count': os.cpu_count(),
+        'machine': platform.machine(),
+        'results': results
+    }
+    with open(results_path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+def load_baseline(results_path, commit=None):
+    """
+    Returns the record before the latest one in the results file; with commit,
+    the latest earlier record of that commit
+    """
+    if not os.path.exists(results_path):
+        return None
+    with open(results_path, 'r', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    for previous in reversed(records[:-1]):
+        if commit is None or previous['commit'].startswith(commit):
+            return previous
+    return None
+
+def print_comparison(record, baseline, threshold=0.1):
+    """Print time ratios against a baseline record, marking changes above threshold"""
+    print(f"\nComparison with {baseline['commit'][:10]} ({baseline['timestamp']}):")
+    old = {(r['name'], r['size']): r for r in baseline['results']}
+    for result in record['results']:
+        previous = old.get((result['name'], result['size']))
+        if previous is None:
+            continue
+        ratio = result['seconds'] / previous['seconds']
+        mark = 'REGRESSION' if ratio > 1 + threshold else ('faster' if ratio < 1 - threshold else '')
+        print(f"{result['name']:<30} {result['size']}  {previous['seconds'] * 1000:9.1f} -> "
+              f"{result['seconds'] * 1000:9.1f} ms  x{ratio:5.2f}  {mark}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pipeline stages on synthetic mammogram-sized DICOMs')
+    parser.add_argument('--sizes', nargs='+', default=[f"{w}x{h}" for w, h in DEFAULT_SIZES],
+                        help='Image sizes WIDTHxHEIGHT')
+    parser.add_argument('--repeat', type=int, default=3, help='Repetitions per benchmark')
+    parser.add_argument('--only', nargs='+', default=None, help='Run only these benchmarks')
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help='Directory for generated DICOMs')
+    parser.add_argument('--results', default=RESULTS_NAME, help='JSON Lines file results are appended to')
+    parser.add_argument('--compare', default=None,
+                        help='Commit to compare with (default: the previous run)')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in size.lower().split('x')) for size in args.sizes]
+    results = run_benchmarks(sizes, args.repeat, args.fixtures, args.only)
+    record = save_results(results, args.results)
+    print(f"\nResults appended to {args.results} (commit {record['commit'][:10]}{'+dirty' if record['dirty'] else ''})")
+
+    baseline = load_baseline(args.results, args.compare)
+    if baseline is not None:
+        print_comparison(record, baseline)
@@ -1,8 +1,38 @@
 import cv2
 import numpy as np
 import os
+import json
+import argparse
+import threading
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from conversion_engine import run_stages, default_workers
+from array_store import ArrayStore, is_array_store, STORAGE_FORMATS
+from manifest import Manifest, array_hash, code_version, MANIFEST_NAME
+from image_io import IMAGE_FORMATS, READ_EXTENSIONS, read_image, write_image, output_name
+from sharding import (add_shard_arguments, check_shard, in_shard, shard_name, shard_store_path,
+                      store_exists, write_shard_report)
+from metrics import RunMetrics, add_metrics_arguments
+from pyramid import add_pyramid_arguments, write_pyramid, remove_stale_levels
+from stats import DatasetStats, PixelStats, STATS_NAME
+
+# CLAHE-объекты для каждого потока, по (clip_limit, tile_grid_size)
+_local = threading.local()
+
+def get_clahe(clip_limit=2.0, tile_grid_size=(8,8)):
+    """
+    Returns CLAHE object for the current thread, cached by parameters.
+    cv2.CLAHE objects are not shared between threads.
+    """
+    cache = getattr(_local, 'clahe', None)
+    if cache is None:
+        cache = _local.clahe = {}
+    key = (float(clip_limit), tuple(tile_grid_size))
+    clahe = cache.get(key)
+    if clahe is None:
+        clahe = cache[key] = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tuple(tile_grid_size))
+    return clahe
 
 def apply_clahe(image, clip_limit=2.0, tile_grid_size=(8,8)):
     """
@@ -16,64 +46,442 @@ def apply_clahe(image, clip_limit=2.0, tile_grid_size=(8,8)):
     Returns:
         Processed image
     """
-    # Create CLAHE object
-    clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=tile_grid_size)
+    # Apply CLAHE (object is reused within the thread)
+    return get_clahe(clip_limit, tile_grid_size).apply(image)
+
+def apply_clahe_batch(images, clip_limit=2.0, tile_grid_size=(8,8), workers=None):
+    """
+    Apply CLAHE to many images in a thread pool (OpenCV releases the GIL).
+    
+    Args:
+        images: Iterable of input images
+        clip_limit: Threshold for contrast limiting
+        tile_grid_size: Size of grid for histogram equalization
+        workers: Number of threads (default: CPU count)
+    
+    Returns:
+        List of processed images in input order
+    """
+    with ThreadPoolExecutor(max_workers=workers or default_workers()) as executor:
+        return list(executor.map(lambda image: apply_clahe(image, clip_limit, tile_grid_size), images))
+
+def tile_histograms(image, tile_grid_size=(8,8)):
+    """
+    Compute per-tile 256-bin histograms of an 8-bit image (the step shared by all clip limits).
+    
+    Args:
+        image: uint8 grayscale image
+        tile_grid_size: (tiles_x, tiles_y), as in cv2.createCLAHE
+    
+    Returns:
+        Tuple (histograms, tile_size): int64 array (tiles_y, tiles_x, 256) and (tile_h, tile_w)
+    """
+    if image.dtype != np.uint8:
+        raise ValueError("Tile histograms are implemented for 8-bit images only")
+    tiles_x, tiles_y = tile_grid_size
+    h, w = image.shape
+    
+    # Как в OpenCV: если размер не кратен сетке, дополняем отражением обе стороны
+    # (кратная сторона при этом получает целый лишний ряд тайлов)
+    if h % tiles_y or w % tiles_x:
+        image = cv2.copyMakeBorder(image, 0, tiles_y - h % tiles_y, 0, tiles_x - w % tiles_x,
+                                   cv2.BORDER_REFLECT_101)
+    tile_h, tile_w = image.shape[0] // tiles_y, image.shape[1] // tiles_x
+    
+    # Смещаем значения каждого тайла в свой диапазон и считаем все гистограммы одним bincount
+    tiles = image.reshape(tiles_y, tile_h, tiles_x, tile_w).transpose(0, 2, 1, 3)
+    offsets = (np.arange(tiles_y * tiles_x, dtype=np.int64) * 256).reshape(tiles_y, tiles_x, 1, 1)
+    hist = np.bincount((tiles + offsets).ravel(), minlength=tiles_y * tiles_x * 256)
+    return hist.reshape(tiles_y, tiles_x, 256), (tile_h, tile_w)
+
+def clahe_luts(histograms, tile_size, clip_limit=2.0):
+    """
+    Build CLAHE lookup tables from tile histograms (same clipping and redistribution as OpenCV).
+    
+    Args:
+        histograms: Array (tiles_y, tiles_x, 256) from tile_histograms
+        tile_size: (tile_h, tile_w)
+        clip_limit: Threshold for contrast limiting
+    
+    Returns:
+        float32 array (tiles_y, tiles_x, 256) of equalized values
+    """
+    tile_area = tile_size[0] * tile_size[1]
+    hist = histograms.astype(np.int64)
+    
+    if clip_limit > 0:
+        limit = max(int(clip_limit * tile_area / 256), 1)
+        excess = np.maximum(hist - limit, 0).sum(axis=-1)
+        np.minimum(hist, limit, out=hist)
+        
+        # Равномерно раздаем срезанное, остаток - с шагом 256 // residual
+        batch = excess // 256
+        residual = excess - batch * 256
+        hist += batch[..., None]
+        step = np.maximum(256 // np.maximum(residual, 1), 1)[..., None]
+        bins = np.arange(256)
+        hist += (bins % step == 0) & (bins // step < residual[..., None])
+    
+    lut_scale = np.float32(255.0 / tile_area)
+    luts = np.cumsum(hist, axis=-1).astype(np.float32) * lut_scale
+    return np.clip(np.rint(luts), 0, 255).astype(np.float32)
+
+def interpolate_luts(image, luts, tile_size):
+    """
+    Map image through tile LUTs with bilinear interpolation between tile centers.
+    
+    Args:
+        image: uint8 grayscale image
+        luts: Array (tiles_y, tiles_x, 256) from clahe_luts
+        tile_size: (tile_h, tile_w)
+    
+    Returns:
+        uint8 image
+    """
+    tiles_y, tiles_x = luts.shape[:2]
+    h, w = image.shape
+    
+    def coords(n, tile):
+        # Та же арифметика float32, что и в OpenCV
+        pos = np.arange(n, dtype=np.float32) * np.float32(1.0 / tile) - np.float32(0.5)
+        t1 = np.floor(pos).astype(np.int64)
+        return t1, (pos - t1).astype(np.float32)
+    
+    def bands(t):
+        # Полосы пикселей между центрами соседних тайлов
+        edges = np.flatnonzero(np.diff(t)) + 1
+        starts = np.concatenate(([0], edges))
+        ends = np.concatenate((edges, [len(t)]))
+        return zip(starts, ends, t[starts])
+    
+    tx, xa = coords(w, tile_size[1])
+    ty, ya = coords(h, tile_size[0])
+    xa1 = np.float32(1) - xa
+    ya1 = (np.float32(1) - ya)[:, None]
+    ya = ya[:, None]
+    
+    result = np.empty_like(image)
+    for r0, r1, t in bands(ty):
+        y1, y2 = max(t, 0), min(t + 1, tiles_y - 1)
+        for c0, c1, t in bands(tx):
+            x1, x2 = max(t, 0), min(t + 1, tiles_x - 1)
+            sub = image[r0:r1, c0:c1]
+            top = cv2.LUT(sub, luts[y1, x1]) * xa1[c0:c1] + cv2.LUT(sub, luts[y1, x2]) * xa[c0:c1]
+            bottom = cv2.LUT(sub, luts[y2, x1]) * xa1[c0:c1] + cv2.LUT(sub, luts[y2, x2]) * xa[c0:c1]
+            result[r0:r1, c0:c1] = np.clip(np.rint(top * ya1[r0:r1] + bottom * ya[r0:r1]), 0, 255)
+    return result
+
+def clahe_sweep(image, clip_limits, tile_grid_size=(8,8)):
+    """
+    Apply CLAHE with several clip limits sharing one tile histogram pass.
     
-    # Apply CLAHE
-    return clahe.apply(image)
+    Args:
+        image: Grayscale image
+        clip_limits: List of clip limits
+        tile_grid_size: Size of grid for histogram equalization
+    
+    Returns:
+        List of processed images, one per clip limit
+    """
+    if image.dtype != np.uint8:
+        # 16-bit: гистограммы на 65536 бинов, используем OpenCV для каждого порога
+        return [apply_clahe(image, clip_limit, tile_grid_size) for clip_limit in clip_limits]
+    histograms, tile_size = tile_histograms(image, tile_grid_size)
+    return [interpolate_luts(image, clahe_luts(histograms, tile_size, clip_limit), tile_size)
+            for clip_limit in clip_limits]
 
-def process_dataset(input_base_path, output_base_path):
+def process_dataset(input_base_path, output_base_path, storage='png',
+                    clip_limit=2.0, tile_grid_size=(8,8), force=False, workers=None, queue_size=8,
+                    shard_index=0, shard_count=1, image_format='png', compression=None, metrics=None,
+                    pyramid=None):
     """
     Process all images in the dataset applying CLAHE augmentation.
+    Images that are up to date according to the output manifest are skipped.
+    Pixel statistics of the outputs are saved to <output>/.stats.json (see stats.py).
     
     Args:
-        input_base_path: Path to original images
+        input_base_path: Path to original images (image folders or array store)
         output_base_path: Path where augmented images will be saved
+        storage: 'png' writes image files, 'npy' writes an array store
+        clip_limit: Threshold for contrast limiting
+        tile_grid_size: Size of grid for histogram equalization
+        force: Reprocess all images, ignoring the manifest
+        workers: Threads per read/CLAHE/write stage (default: CPU count)
+        queue_size: Maximum number of images waiting between stages
+        shard_index, shard_count: Process only images whose filename hash falls into this shard
+        image_format, compression: Output file format and compression level, see image_io.encode_image
+        metrics: Optional RunMetrics; read/CLAHE/write times and bytes are recorded per image
+        pyramid: Optional list of long-side sizes; reduced copies are saved in the same pass
+            to <output>/.pyramid/<size>/<category>/ (see pyramid.py)
     """
+    check_shard(shard_index, shard_count)
+    if metrics is None:
+        metrics = RunMetrics('clahe')
     # Create output base directory if it doesn't exist
     os.makedirs(output_base_path, exist_ok=True)
     
+    input_store = ArrayStore(input_base_path) if is_array_store(input_base_path) else None
+    output_store = (ArrayStore(shard_store_path(output_base_path, shard_index, shard_count),
+                               mode='w' if force else 'a') if storage == 'npy' else None)
+    
+    manifest = Manifest(output_base_path,
+                        {'clip_limit': clip_limit, 'tile_grid_size': tile_grid_size, 'storage': storage,
+                         'format': image_format, 'compression': compression,
+                         **({'pyramid': sorted(set(pyramid))} if pyramid else {})},
+                        code_version(__file__), name=shard_name(MANIFEST_NAME, shard_index, shard_count),
+                        fallback=MANIFEST_NAME)
+    stats = DatasetStats(output_base_path, shard_name(STATS_NAME, shard_index, shard_count), fallback=STATS_NAME)
+    if force:
+        manifest.entries = {}
+        stats.entries = {}
+    exists = None
+    if output_store is not None:
+        exists = store_exists(output_store, manifest.base_path)
+    skipped = 0
+    
     # Get all subdirectories (Density1+Benign, Density1+Malignant, etc.)
-    subdirs = [d for d in os.listdir(input_base_path) 
-              if os.path.isdir(os.path.join(input_base_path, d))]
+    if input_store is not None:
+        subdirs = input_store.categories()
+    else:
+        subdirs = [d for d in os.listdir(input_base_path) 
+                  if os.path.isdir(os.path.join(input_base_path, d)) and not d.startswith('.')]
     
+    tasks = []
     for subdir in subdirs:
         input_dir = os.path.join(input_base_path, subdir)
         output_dir = os.path.join(output_base_path, subdir)
         
         # Create output subdirectory
-        os.makedirs(output_dir, exist_ok=True)
+        if output_store is None:
+            os.makedirs(output_dir, exist_ok=True)
         
         # Process all images in subdirectory
-        image_files = [f for f in os.listdir(input_dir) 
-                      if f.lower().endswith(('.png', '.jpg', '.jpeg', '.tif', '.dicom'))]
+        if input_store is not None:
+            image_files = input_store.names(subdir)
+        else:
+            image_files = [f for f in os.listdir(input_dir) 
+                          if f.lower().endswith(READ_EXTENSIONS)]
+        
+        for image_file in image_files:
+            if not in_shard(image_file, shard_index, shard_count):
+                continue
+            if output_store is not None:
+                output_key = f"{subdir}/clahe_{Path(image_file).stem}"
+            else:
+                name = output_name(image_file if input_store is None else f"{image_file}.png", image_format)
+                output_key = f"{subdir}/clahe_{name}"
+            tasks.append((subdir, image_file, os.path.join(input_dir, image_file), output_key))
+    
+    # Чтение, CLAHE и запись перекрываются между изображениями
+    def read(task):
+        subdir, image_file, input_path, output_key = task
+        # Read image (ANYDEPTH keeps 16-bit PNGs from the converter)
+        if input_store is not None:
+            img = input_store.get(subdir, image_file)
+            input_hash = array_hash(img)
+        else:
+            input_hash = manifest.input_hash(input_path)
+            img = None
         
-        print(f"Processing {subdir}...")
-        for image_file in tqdm(image_files):
-            input_path = os.path.join(input_dir, image_file)
-            output_path = os.path.join(output_dir, f"clahe_{image_file}")
-            
-            try:
-                # Read image
-                img = cv2.imread(input_path, cv2.IMREAD_GRAYSCALE)
-                if img is None:
-                    print(f"Error reading image: {input_path}")
-                    continue
-                
-                # Apply CLAHE
-                processed_img = apply_clahe(img)
-                
-                # Save processed image
-                cv2.imwrite(output_path, processed_img)
-                
-            except Exception as e:
-                print(f"Error processing {input_path}: {str(e)}")
+        if manifest.is_current(output_key, input_hash, exists) and output_key in stats:
+            return None
+        
+        if img is None:
+            img = read_image(input_path)
+        if img is None:
+            raise IOError(f"Error reading image: {input_path}")
+        metrics.count(output_key, bytes_read=img.nbytes if input_store is not None else os.path.getsize(input_path))
+        return task, input_hash, img
+    
+    def enhance(item):
+        if item is None:
+            return None
+        task, input_hash, img = item
+        with metrics.phase(task[3], 'compute'):
+            return task, input_hash, apply_clahe(img, clip_limit, tile_grid_size)
+    
+    def write(item):
+        if item is None:
+            return False
+        (subdir, image_file, _, output_key), input_hash, processed_img = item
+        
+        # Save processed image
+        outputs = [output_key]
+        with metrics.phase(output_key, 'encode'):
+            if output_store is not None:
+                output_store.put(subdir, f"clahe_{Path(image_file).stem}", processed_img)
+                size = processed_img.nbytes
+            else:
+                size = write_image(os.path.join(output_base_path, output_key), processed_img,
+                                   image_format, compression)
+            if pyramid:
+                level_outputs, level_size = write_pyramid(
+                    output_base_path, subdir, f"clahe_{Path(image_file).stem}.png", processed_img, pyramid,
+                    'raw' if output_store is not None else image_format, compression)
+                outputs += level_outputs
+                size += level_size
+        metrics.count(output_key, bytes_written=size)
+        with metrics.phase(output_key, 'stats'):
+            stats.record(output_key, subdir, PixelStats.from_image(processed_img))
+        remove_stale_levels(manifest, output_key, outputs)
+        manifest.record(output_key, input_hash, outputs)
+        return True
+    
+    successful = {}
+    failed = []
+    print(f"Processing {len(tasks)} images in {len(subdirs)} categories...")
+    stages = [metrics.timed('decode', read, lambda task: task[3]), enhance, write]
+    for idx, written, error in tqdm(run_stages(tasks, stages, workers, queue_size), total=len(tasks)):
+        if error is not None:
+            print(f"Error processing {tasks[idx][2]}: {str(error)}")
+            failed.append((tasks[idx][1], str(error)))
+            continue
+        if not written:
+            skipped += 1
+        successful[tasks[idx][0]] = successful.get(tasks[idx][0], 0) + 1
+    
+    if output_store is not None:
+        output_store.close()
+    manifest.close()
+    if shard_count <= 1:
+        # Убираем статистику изображений, которых больше нет во входных данных
+        stats.prune(task[3] for task in tasks)
+    stats.close()
+    if skipped:
+        print(f"Skipped {skipped} up-to-date images")
+    if shard_count > 1:
+        write_shard_report(output_base_path, 'clahe', shard_index, shard_count, successful, failed)
+        print(f"Shard {shard_index} of {shard_count} done; after all shards run: "
+              f"python sharding.py clahe {output_base_path}")
+
+def sweep_setting_name(clip_limit, tile_grid_size):
+    """Returns directory name for a sweep setting, e.g. clip2_grid8x8"""
+    return f"clip{clip_limit:g}_grid{tile_grid_size[0]}x{tile_grid_size[1]}"
+
+def sweep_dataset(input_base_path, output_base_path, clip_limits, tile_grid_sizes=((8,8),),
+                  workers=None, queue_size=4):
+    """
+    Run a CLAHE parameter sweep reading every image once.
+    
+    For each tile grid the tile histograms are computed once per image and reused
+    for all clip limits. Outputs go to <output>/<setting>/<category>/clahe_<file>
+    and <output>/sweep_index.json records which setting produced which file.
+    
+    Args:
+        input_base_path: Path to original images (image folders or array store)
+        output_base_path: Path where sweep results will be saved
+        clip_limits: List of clip limits
+        tile_grid_sizes: List of tile grid sizes
+        workers: Threads per read/CLAHE/write stage (default: CPU count)
+        queue_size: Maximum number of images waiting between stages
+    
+    Returns:
+        List of index records
+    """
+    input_store = ArrayStore(input_base_path) if is_array_store(input_base_path) else None
+    settings = [(clip_limit, tuple(grid)) for grid in tile_grid_sizes for clip_limit in clip_limits]
+    
+    if input_store is not None:
+        tasks = [(category, name, f"{name}.png") for category in input_store.categories()
+                 for name in input_store.names(category)]
+    else:
+        tasks = [(category, f, f) for category in sorted(os.listdir(input_base_path))
+                 if os.path.isdir(os.path.join(input_base_path, category)) and not category.startswith('.')
+                 for f in sorted(os.listdir(os.path.join(input_base_path, category)))
+                 if f.lower().endswith(READ_EXTENSIONS)]
+    
+    for clip_limit, grid in settings:
+        for category in {task[0] for task in tasks}:
+            os.makedirs(os.path.join(output_base_path, sweep_setting_name(clip_limit, grid), category), exist_ok=True)
+    
+    def read(task):
+        category, name, _ = task
+        if input_store is not None:
+            return input_store.get(category, name)
+        img = read_image(os.path.join(input_base_path, category, name))
+        if img is None:
+            raise IOError(f"Error reading image: {category}/{name}")
+        return img
+    
+    def enhance(img):
+        results = []
+        for grid in dict.fromkeys(grid for _, grid in settings):
+            results.extend(clahe_sweep(img, clip_limits, grid))
+        return results
+    
+    index = [None] * len(tasks)
+    
+    def write(item):
+        idx, images = item
+        category, _, output_name = tasks[idx]
+        records = []
+        for (clip_limit, grid), processed_img in zip(settings, images):
+            output_path = os.path.join(sweep_setting_name(clip_limit, grid), category, f"clahe_{output_name}")
+            cv2.imwrite(os.path.join(output_base_path, output_path), processed_img)
+            records.append({
+                'setting': sweep_setting_name(clip_limit, grid),
+                'clip_limit': clip_limit,
+                'tile_grid_size': list(grid),
+                'category': category,
+                'source': output_name,
+                'output': output_path
+            })
+        index[idx] = records
+    
+    # Индекс задачи нужен этапу записи, поэтому передаем его вместе с изображением
+    stages = [lambda item: (item[0], read(item[1])),
+              lambda item: (item[0], enhance(item[1])),
+              write]
+    
+    print(f"Sweeping {len(settings)} settings over {len(tasks)} images...")
+    for idx, _, error in tqdm(run_stages(list(enumerate(tasks)), stages, workers, queue_size), total=len(tasks)):
+        if error is not None:
+            print(f"Error processing {tasks[idx][0]}/{tasks[idx][1]}: {str(error)}")
+    
+    records = [record for records in index if records for record in records]
+    with open(os.path.join(output_base_path, 'sweep_index.json'), 'w', encoding='utf-8') as f:
+        json.dump(records, f, indent=2)
+    return records
+
+def parse_grid(value):
+    """Parses tile grid size like 8x8"""
+    tiles_x, tiles_y = value.lower().split('x')
+    return int(tiles_x), int(tiles_y)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Apply CLAHE to converted mammograms')
     # Define input and output paths
-    input_base_path = "./mass_images"  # Change this to your input path
-    output_base_path = "./mass_images_clahe"  # Change this to your desired output path
+    parser.add_argument('--input', default='./mass_images', help='Input images (folders or array store)')
+    parser.add_argument('--output', default='./mass_images_clahe', help='Output path')
+    parser.add_argument('--clip-limit', type=float, default=2.0, help='Threshold for contrast limiting')
+    parser.add_argument('--tile-grid', type=parse_grid, default=(8, 8), help='Tile grid size, e.g. 8x8')
+    parser.add_argument('--storage', choices=STORAGE_FORMATS, default='png', help='Output storage')
+    parser.add_argument('--format', choices=IMAGE_FORMATS, default='png', help='Image file format')
+    parser.add_argument('--compression', type=int, default=None,
+                        help='PNG zlib level 0-9 (default: OpenCV default); for TIFF 0 disables LZW')
+    parser.add_argument('--force', action='store_true', help='Reprocess all images, ignoring the manifest')
+    parser.add_argument('--workers', type=int, default=None, help='Threads per stage (default: CPU count)')
+    parser.add_argument('--sweep-clip-limits', type=float, nargs='+',
+                        help='Run a parameter sweep over these clip limits instead of a single setting')
+    parser.add_argument('--sweep-tile-grids', type=parse_grid, nargs='+',
+                        help='Tile grids for the sweep (default: --tile-grid)')
+    add_pyramid_arguments(parser)
+    add_shard_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    metrics = RunMetrics('clahe', {key: value for key, value in vars(args).items()
+                                   if key not in ('metrics', 'profile')}, profile=bool(args.profile))
     
-    # Process the dataset
-    process_dataset(input_base_path, output_base_path)
-    print("Processing complete!")
\ No newline at end of file
+    if args.sweep_clip_limits or args.sweep_tile_grids:
+        with metrics.stage('sweep'):
+            sweep_dataset(args.input, args.output, args.sweep_clip_limits or [args.clip_limit],
+                          args.sweep_tile_grids or [args.tile_grid], args.workers)
+    else:
+        # Process the dataset
+        with metrics.stage('clahe'):
+            process_dataset(args.input, args.output, args.storage, args.clip_limit, args.tile_grid,
+                            args.force, args.workers, shard_index=args.shard_index, shard_count=args.shard_count,
+                            image_format=args.format, compression=args.compression, metrics=metrics,
+                            pyramid=args.pyramid)
+    print("Processing complete!")
+    metrics.finish(args.metrics, args.profile)
@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+
+# Маркер конца потока задач
+_DONE = object()
+
+def default_workers():
+    """Returns number of workers to use per stage"""
+    return os.cpu_count() or 1
+
+def _stage_worker(fn, q_in, q_out, stop):
+    """Takes tasks from q_in, applies fn and puts results to q_out (tasks pass unprocessed after stop is set)"""
+    while True:
+        task = q_in.get()
+        if task is _DONE:
+            break
+        idx, value, error = task
+        # Ошибка на раннем этапе пропускает все последующие
+        if error is None and not stop.is_set():
+            try:
+                value = fn(value)
+            except Exception as e:
+                value, error = None, e
+        q_out.put((idx, value, error))
+
+def _close_after(threads, q_out, n_next):
+    """Waits for stage workers and signals the next stage to stop"""
+    for t in threads:
+        t.join()
+    for _ in range(n_next):
+        q_out.put(_DONE)
+
+def _feed(items, q_out, n_next, errors, stop):
+    """Puts input items into the first queue until stop is set; an error of the items iterator goes to errors"""
+    try:
+        for idx, item in enumerate(items):
+            if stop.is_set():
+                break
+            q_out.put((idx, item, None))
+    except Exception as e:
+        errors.append(e)
+    finally:
+        # Этапы должны завершиться и при ошибке, иначе конвейер зависнет
+        for _ in range(n_next):
+            q_out.put(_DONE)
+
+def run_stages(items, stages, workers=None, queue_size=8):
+    """
+    Run items through pipelined stages in worker threads connected by bounded queues.
+
+    The heavy parts (file I/O, NumPy, zlib/PNG encoding, OpenCV) release the GIL,
+    so the stages run in parallel. Bounded queues cap the number of images in
+    memory at roughly (queue_size + workers) per stage. If the consumer stops
+    early (an exception in its loop, close() or garbage collection of the
+    generator), feeding stops, the remaining tasks pass the stages unprocessed
+    and the worker threads exit.
+
+    Args:
+        items: Iterable of inputs for the first stage
+        stages: List of callables, each takes the previous stage's output
+        workers: Workers per stage, int for all stages or list with one value per stage
+        queue_size: Maximum number of tasks waiting between two stages
+
+    Yields:
+        (index, result, error) tuples in completion order; error is the exception
+        raised by the first failing stage or None
+
+    Raises:
+        The exception raised while iterating items, after the items read before it are finished
+    """
+    if workers is None:
+        workers = default_workers()
+    if isinstance(workers, int):
+        workers = [workers] * len(stages)
+    workers = [max(1, n) for n in workers]
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    feed_errors = []
+    stop = threading.Event()
+    threads = [threading.Thread(target=_feed, args=(items, queues[0], workers[0], feed_errors, stop), daemon=True)]
+
+    for k, fn in enumerate(stages):
+        stage_threads = [threading.Thread(target=_stage_worker, args=(fn, queues[k], queues[k + 1], stop),
+                                          daemon=True)
+                         for _ in range(workers[k])]
+        n_next = workers[k + 1] if k + 1 < len(stages) else 1
+        threads.extend(stage_threads)
+        threads.append(threading.Thread(target=_close_after, args=(stage_threads, queues[k + 1], n_next), daemon=True))
+
+    for t in threads:
+        t.start()
+
+    done = False
+    try:
+        while True:
+            task = queues[-1].get()
+            if task is _DONE:
+                done = True
+                break
+            yield task
+    finally:
+        if not done:
+            # Потребитель остановился раньше: без чтения выходной очереди потоки зависнут на полных очередях.
+            # Дочитываем ее до конца, этапы пропускают оставшиеся задачи без обработки
+            stop.set()
+            while queues[-1].get() is not _DONE:
+                pass
+    if feed_errors:
+        raise feed_errors[0]
@@ -1,8 +1,15 @@
-import json
+import argparse
 from collections import Counter
 from pathlib import Path
+from annotation_store import iter_annotations, default_annotations_path
+from tar_shards import source_counts
+from stats import load_summary, print_stats
 
-def print_comparison_table():
+def print_comparison_table(shards_dir=None, stats_path=None):
+    """
+    Compares category counts with the expected table; with shards_dir counts source images in tar shards,
+    with stats_path takes the counts of converted images from the converter statistics (mass_images/.stats.json)
+    """
     # Ожидаемые значения из таблицы
     expected_counts = {
         'Density1+Benign': 12,
@@ -15,18 +22,37 @@ def print_comparison_table():
         'Density4+Malignant': 1
     }
 
-    # Загружаем наши аннотации
-    annotations_path = Path('annotations/all_annotations.json')
-    with open(annotations_path, 'r', encoding='utf-8') as f:
-        annotations = json.load(f)
-
-    # Подсчитываем категории в наших аннотациях
     actual_counts = Counter()
-    for ann in annotations:
-        if 'classification' in ann and 'category' in ann['classification']:
-            category = ann['classification']['category']
-            if '+' in category:  # Учитываем только категории с массами
+    density_counts = Counter()
+    total = 0
+    summary = load_summary(stats_path) if stats_path is not None else None
+    if stats_path is not None and summary is None:
+        print(f"No statistics file in {stats_path}, counting annotations")
+    if summary is not None:
+        # Счетчики из статистики конвертера, без чтения аннотаций и изображений
+        actual_counts = Counter({category: item['images'] for category, item in summary.items()})
+        total = sum(actual_counts.values())
+        for category, count in actual_counts.items():
+            density_counts[f"Density {category.split('+')[0][len('Density'):]}"] += count
+    elif shards_dir is not None:
+        # Исходные изображения в tar шардах, только по индексам шардов
+        actual_counts = source_counts(shards_dir)
+        total = sum(actual_counts.values())
+        for category, count in actual_counts.items():
+            density_counts[f"Density {category.split('+')[0][len('Density'):]}"] += count
+    else:
+        # Загружаем наши аннотации
+        annotations_path = default_annotations_path(Path('annotations'))
+
+        # Подсчитываем категории и плотности за один проход, аннотации читаются по одной
+        for ann in iter_annotations(annotations_path):
+            total += 1
+            classification = ann.get('classification', {})
+            category = classification.get('category')
+            if category and '+' in category:  # Учитываем только категории с массами
                 actual_counts[category] += 1
+            if 'density' in classification:
+                density_counts[f"Density {classification['density']}"] += 1
 
     # Печатаем сравнительную таблицу
     print("\nComparison with expected distribution:")
@@ -67,17 +93,23 @@ def print_comparison_table():
 
     # Подробная статистика по всем найденным изображениям
     print("\nDetailed statistics:")
-    print(f"Total images in annotations: {len(annotations)}")
+    source = 'statistics' if summary is not None else ('annotations' if shards_dir is None else 'shards')
+    print(f"Total images in {source}: {total}")
     
     # Распределение по плотности
-    density_counts = Counter()
-    for ann in annotations:
-        if 'classification' in ann and 'density' in ann['classification']:
-            density_counts[f"Density {ann['classification']['density']}"] += 1
-    
     print("\nDistribution by density:")
     for density, count in sorted(density_counts.items()):
         print(f"{density}: {count}")
 
+    if summary is not None:
+        print_stats(summary)
+
 if __name__ == '__main__':
-    print_comparison_table()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Compare category counts with the expected distribution')
+    parser.add_argument('--shards', default=None,
+                        help='Count source images in tar shards (e.g. augmented_shards) instead of annotations')
+    parser.add_argument('--stats', nargs='?', const='mass_images', default=None,
+                        help='Count converted images from the statistics file of the converter output '
+                             '(default: mass_images)')
+    args = parser.parse_args()
+    print_comparison_table(args.shards, args.stats)
\ No newline at end of file
@@ -1,5 +1,18 @@
 import albumentations as A
 import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Параметры пакетной аугментации, те же, что в get_mammography_augmentation
+ROTATION_ANGLES = (30, 60, 90, 120, 150, 180, 210, 240, 270, 300, 330)
+ROTATION_JITTER = 1
+BRIGHTNESS_LIMIT = (-0.1, 0.1)
+CONTRAST_LIMIT = (-0.1, 0.1)
+GAMMA_LIMIT = (90, 110)
+NOISE_VAR_LIMIT = (5, 20)
+BLUR_LIMIT = (3, 5)
+BLUR_SIGMA_LIMIT = (0.5, 3.0)
+SCALE_LIMIT = (-0.1, 0.1)
 
 def get_mammography_augmentation():
     """
@@ -57,9 +70,162 @@ def get_mammography_augmentation():
         )
     ], p=1.0)
 
+def brightness_contrast_lut(alpha, beta):
+    """Returns uint8 LUT of x * alpha + beta * 255 (RandomBrightnessContrast on uint8)"""
+    return np.clip(np.arange(256, dtype=np.float32) * alpha + beta * 255, 0, 255).astype(np.uint8)
+
+def gamma_lut(gamma):
+    """Returns uint8 LUT of 255 * (x / 255) ** gamma (RandomGamma on uint8)"""
+    return np.clip(np.power(np.arange(256) / 255.0, gamma) * 255, 0, 255).astype(np.uint8)
+
+def sample_params(rng):
+    """
+    Draws augmentation parameters for one image with the probabilities of get_mammography_augmentation.
+
+    Returns:
+        Dictionary: angle (None if not rotated), hflip, vflip, scale, intensity ('brightness_contrast',
+        'gamma' or None) with alpha/beta or gamma, degradation ('noise', 'blur' or None) with
+        noise_std or blur_ksize/blur_sigma
+    """
+    params = {'angle': None, 'hflip': False, 'vflip': False, 'scale': 1.0,
+              'intensity': None, 'degradation': None}
+    # OneOf выбирает преобразование пропорционально p (здесь равные) и применяет его принудительно
+    if rng.random() < 0.8:
+        params['angle'] = float(rng.choice(ROTATION_ANGLES) + rng.uniform(-ROTATION_JITTER, ROTATION_JITTER))
+    params['hflip'] = bool(rng.random() < 0.5)
+    params['vflip'] = bool(rng.random() < 0.5)
+    if rng.random() < 0.3:
+        if rng.random() < 0.5:
+            params['intensity'] = 'brightness_contrast'
+            params['alpha'] = 1.0 + float(rng.uniform(*CONTRAST_LIMIT))
+            params['beta'] = float(rng.uniform(*BRIGHTNESS_LIMIT))
+        else:
+            params['intensity'] = 'gamma'
+            params['gamma'] = float(rng.uniform(*GAMMA_LIMIT)) / 100
+    if rng.random() < 0.2:
+        if rng.random() < 0.5:
+            params['degradation'] = 'noise'
+            params['noise_std'] = float(np.sqrt(rng.uniform(*NOISE_VAR_LIMIT)))
+        else:
+            params['degradation'] = 'blur'
+            params['blur_ksize'] = int(rng.choice(np.arange(BLUR_LIMIT[0], BLUR_LIMIT[1] + 1, 2)))
+            params['blur_sigma'] = float(rng.uniform(*BLUR_SIGMA_LIMIT))
+    if rng.random() < 0.3:
+        params['scale'] = 1.0 + float(rng.uniform(*SCALE_LIMIT))
+    return params
+
+_noise_banks = {}
+
+def noise_bank(h, w, seed=0):
+    """Returns cached standard normal float32 field of shape (h, w); samples use random cyclic shifts of it"""
+    key = (h, w, seed)
+    if key not in _noise_banks:
+        # Держим только последний размер
+        _noise_banks.clear()
+        _noise_banks[key] = np.random.default_rng(seed).standard_normal((h, w), dtype=np.float32)
+    return _noise_banks[key]
+
+def sample_rng(seed, index):
+    """Returns generator for one sample; depends only on (seed, index), not on batch composition"""
+    return np.random.default_rng([seed, index])
+
+def _augment_image(image, p):
+    """Applies geometric, LUT and blur parameters of sample_params to one image (noise is added by the caller)"""
+    h, w = image.shape
+    if p['angle'] is not None or p['scale'] != 1.0:
+        # Поворот, масштаб и отражения - одна аффинная матрица, один проход warpAffine
+        matrix = np.vstack([cv2.getRotationMatrix2D(((w - 1) / 2, (h - 1) / 2), p['angle'] or 0.0, p['scale']),
+                            [0, 0, 1]])
+        if p['hflip']:
+            matrix = np.array([[-1, 0, w - 1], [0, 1, 0], [0, 0, 1]]) @ matrix
+        if p['vflip']:
+            matrix = np.array([[1, 0, 0], [0, -1, h - 1], [0, 0, 1]]) @ matrix
+        image = cv2.warpAffine(image, matrix[:2], (w, h), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    elif p['hflip'] or p['vflip']:
+        image = cv2.flip(image, -1 if p['hflip'] and p['vflip'] else (1 if p['hflip'] else 0))
+
+    if p['intensity'] == 'brightness_contrast':
+        image = cv2.LUT(image, brightness_contrast_lut(p['alpha'], p['beta']))
+    elif p['intensity'] == 'gamma':
+        image = cv2.LUT(image, gamma_lut(p['gamma']))
+
+    if p['degradation'] == 'blur':
+        image = cv2.GaussianBlur(image, (p['blur_ksize'], p['blur_ksize']), p['blur_sigma'])
+    return image
+
+def augment_batch(images, seed=0, indices=None, pad_divisor=32, workers=1):
+    """
+    Batched version of get_mammography_augmentation for an N x H x W uint8 stack.
+
+    Intensity transforms are precomputed 256-entry LUTs (brightness/contrast or
+    gamma), applied with one cv2.LUT per image. Rotation, scaling and flips are
+    combined into a single warpAffine per image. Noise is a random cyclic shift
+    of a cached Gaussian field (noise_bank), scaled and added to all noisy images
+    of the batch at once. Results are reproducible
+    and do not depend on workers:
+    the parameters and noise of sample i depend only on (seed, indices[i]).
+
+    Differences from the albumentations pipeline: RandomScale scales the content
+    inside the fixed frame (the canvas size stays H x W so the batch stays a stack),
+    GaussNoise uses the variance range NOISE_VAR_LIMIT in pixel units.
+
+    Args:
+        images: uint8 array (N, H, W)
+        seed: Base seed
+        indices: Sample indices for the seeds (default: 0..N-1), e.g. dataset indices
+        pad_divisor: Pad height and width to a multiple of this (PadIfNeeded), None to skip
+        workers: Threads processing the images of the batch
+
+    Returns:
+        Tuple (augmented uint8 array (N, H', W'), list of parameter dictionaries)
+    """
+    images = np.asarray(images)
+    if images.ndim != 3 or images.dtype != np.uint8:
+        raise ValueError("Expected uint8 array of shape (N, H, W)")
+    n, h, w = images.shape
+    if indices is None:
+        indices = range(n)
+    rngs = [sample_rng(seed, int(index)) for index in indices]
+    params = [sample_params(rng) for rng in rngs]
+
+    out = np.empty_like(images)
+
+    def augment_one(i):
+        out[i] = _augment_image(images[i], params[i])
+
+    if workers and workers > 1:
+        # OpenCV отпускает GIL, изображения пакета обрабатываются параллельно
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(augment_one, range(n)))
+    else:
+        for i in range(n):
+            augment_one(i)
+
+    # Шум для всех зашумляемых изображений одной операцией
+    noisy = [i for i, p in enumerate(params) if p['degradation'] == 'noise']
+    if noisy:
+        # Сдвиг (циклический) заранее сгенерированного поля шума вместо генерации нового
+        bank = noise_bank(h, w)
+        noise = np.stack([np.roll(bank, (int(rngs[i].integers(h)), int(rngs[i].integers(w))), axis=(0, 1))
+                          for i in noisy])
+        noise *= np.array([params[i]['noise_std'] for i in noisy], dtype=np.float32)[:, None, None]
+        noise += out[noisy]
+        out[noisy] = np.clip(np.rint(noise), 0, 255).astype(np.uint8)
+
+    if pad_divisor:
+        pad_h, pad_w = -h % pad_divisor, -w % pad_divisor
+        if pad_h or pad_w:
+            top, left = pad_h // 2, pad_w // 2
+            out = np.pad(out, ((0, 0), (top, pad_h - top), (left, pad_w - left)))
+    return out, params
+
 # Usage example:
 if __name__ == "__main__":
     transform = get_mammography_augmentation()
     
     # Example usage with an image:
-    # augmented = transform(image=image)['image']   
\ No newline at end of file
+    # augmented = transform(image=image)['image']
+    
+    # Batched version for an N x H x W uint8 stack, reproducible from the seed:
+    # augmented, params = augment_batch(images, seed=42)   
\ No newline at end of file
@@ -1,105 +1,216 @@
 import os
-import json
+import pickle
+import argparse
 import pydicom
 import pandas as pd
 import numpy as np
 from pathlib import Path
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+from dicom_index import load_dicom_index, find_dicom
+from annotation_store import (AnnotationWriter, iter_annotations, write_json_array, write_annotation_store,
+                              DB_NAME, JSONL_NAME, JSON_NAME)
+from metrics import RunMetrics, add_metrics_arguments
+from roi import breast_bbox, DEFAULT_MARGIN
 
-def get_dicom_info(dicom_path):
-    """Extracts basic info from DICOM file"""
+def read_dicom_info(dicom_path, header_only=True, roi_margin=None):
+    """
+    Reads basic info from DICOM file, returns (info, error message).
+    With roi_margin the pixels are decoded and info['roi'] holds the breast region (see roi.breast_bbox).
+    """
     try:
-        dcm = pydicom.dcmread(dicom_path)
-        return {
+        # stop_before_pixels: читаем только заголовок, без десятков МБ пикселей
+        dcm = pydicom.dcmread(dicom_path, stop_before_pixels=header_only and roi_margin is None)
+        info = {
             'width': dcm.Columns,
             'height': dcm.Rows,
             'spacing': getattr(dcm, 'PixelSpacing', [1, 1])
         }
+        if roi_margin is not None:
+            info['roi'] = breast_bbox(dcm.pixel_array, roi_margin)
+        return info, None
     except Exception as e:
-        print(f"Error reading DICOM {dicom_path}: {e}")
-        return None
-
-def clean_value(value):
-    """Cleans string value by removing extra spaces and newlines"""
-    if pd.isna(value):
-        return None
-    if isinstance(value, str):
-        cleaned = value.strip()
-        return cleaned if cleaned else None
-    return value
-
-def get_mass_type(row):
-    """Determines if mass is benign or malignant based on BI-RADS and findings"""
-    birads = clean_value(row['Bi-Rads'])
-    findings = str(clean_value(row.get('Findings Notes (in Portuguese)', ''))).lower()
-    
-    # Если нет массы, возвращаем None
-    if clean_value(row.get('Mass ')) != 'X':
-        return None
-    
-    # Определяем злокачественность
-    if isinstance(birads, (int, float)):
-        is_malignant = float(birads) >= 4
-    elif isinstance(birads, str):
-        is_malignant = any(birads.startswith(str(i)) for i in [4, 5, 6])
-    else:
-        is_malignant = False
+        return None, f"Error reading DICOM {dicom_path}: {e}"
+
+def get_dicom_info(dicom_path, header_only=False):
+    """Extracts basic info from DICOM file"""
+    info, error = read_dicom_info(dicom_path, header_only)
+    if error:
+        print(error)
+    return info
+
+def iter_dicom_infos(dicom_paths, header_only=True, workers=None, roi_margin=None):
+    """
+    Extract info for many DICOM files, optionally in a process pool, yielding results as they arrive.
+
+    Args:
+        dicom_paths: List of DICOM paths
+        header_only: Read only the header, stopping before pixel data
+        workers: Number of worker processes (None = CPU count, 1 = serial)
+        roi_margin: Also find the breast region with this margin (reads the pixels)
+
+    Yields:
+        (info, error message) tuples in the same order as dicom_paths
+    """
+    if workers == 1 or len(dicom_paths) < 2:
+        for path in dicom_paths:
+            yield read_dicom_info(path, header_only, roi_margin)
+        return
     
-    # Проверяем описание
-    if 'benigno' in findings or 'normal' in findings:
-        is_malignant = False
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map сохраняет порядок входных путей
+        yield from executor.map(read_dicom_info, dicom_paths, repeat(header_only), repeat(roi_margin),
+                                chunksize=16)
+
+def get_dicom_infos(dicom_paths, header_only=True, workers=None, roi_margin=None):
+    """Returns list of (info, error message) tuples for DICOM files, see iter_dicom_infos"""
+    return list(iter_dicom_infos(dicom_paths, header_only, workers, roi_margin))
+
+def excel_cache_path(excel_path):
+    """Returns path of the parsed-sheet cache stored next to the Excel file"""
+    return Path(f"{excel_path}.cache.pkl")
+
+def load_excel(excel_path, cache_path=None):
+    """
+    Load the INbreast sheet, caching the parsed DataFrame.
+
+    The slow xlrd parse runs only when the Excel file changed: the pickle cache
+    is keyed by the file's mtime and size.
+
+    Args:
+        excel_path: Path to INbreast.xls
+        cache_path: Cache file (default: <excel_path>.cache.pkl)
+
+    Returns:
+        Parsed DataFrame
+    """
+    cache_path = Path(cache_path) if cache_path else excel_cache_path(excel_path)
+    st = os.stat(excel_path)
+    key = (st.st_mtime_ns, st.st_size)
+    try:
+        with open(cache_path, 'rb') as f:
+            cached_key, df = pickle.load(f)
+        if cached_key == key:
+            return df
+    except Exception:
+        # Нет кэша или он от другой версии pandas - просто читаем Excel заново
+        pass
     
-    return 'Malignant' if is_malignant else 'Benign'
+    df = pd.read_excel(excel_path)
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        pickle.dump((key, df), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, cache_path)
+    return df
+
+def _is_str(values):
+    """Boolean mask of string elements in an object Series"""
+    try:
+        return values.str.len().notna()
+    except AttributeError:  # в колонке нет строк
+        return pd.Series(False, index=values.index)
+
+def clean_column(df, name):
+    """Cleans a column: strips strings, NaN and empty strings become None (missing column - all None)"""
+    if name not in df:
+        return pd.Series(None, index=df.index, dtype=object)
+    values = df[name].astype(object)
+    is_str = _is_str(values)
+    if is_str.any():
+        values = values.where(~is_str, values.str.strip())
+    return values.where(values.notna() & (values != ''), None)
+
+def build_annotation_table(df):
+    """
+    Derive annotation fields from the Excel sheet with whole-column operations.
 
-def create_annotation(row, img_info):
-    """Creates annotation based on Excel row data"""
-    if not img_info:
-        return None
+    Args:
+        df: DataFrame from INbreast.xls
+
+    Returns:
+        DataFrame with one row per Excel row that has a file name (index of df kept):
+        filename, density, valid_density, mass_type, category, birads, laterality, view,
+        date, mass, calcification, distortion, asymmetry, description, lesion_annotation
+    """
+    df = df[df['File Name'].notna()]
+    table = pd.DataFrame(index=df.index)
+    table['filename'] = df['File Name'].astype(float).astype('int64').astype(str)
     
-    # Get density and mass type
-    density = clean_value(row['ACR'])
-    if not density or not str(density).isdigit():
-        print(f"Warning: Invalid density value for file {row['File Name']}: {density}")
-        return None
-        
-    mass_type = get_mass_type(row)
+    # Плотность: целое число, 0 и нечисловые значения недопустимы
+    density = clean_column(df, 'ACR')
+    density_str = density.astype(str)
+    table['density'] = density
+    table['valid_density'] = (density.notna() & (density != 0)
+                              & density_str.str.isdigit().fillna(False).astype(bool))
+    
+    # Злокачественность по BI-RADS: число >= 4 или строка, начинающаяся с 4, 5 или 6
+    birads = clean_column(df, 'Bi-Rads')
+    birads_is_str = _is_str(birads)
+    birads_num = pd.to_numeric(birads.where(~birads_is_str), errors='coerce')
+    is_malignant = (birads_num >= 4) | (birads_is_str & birads.str.match(r'[456]').eq(True))
+    
+    # Проверяем описание
+    description = clean_column(df, 'Findings Notes (in Portuguese)')
+    is_benign_note = description.astype(str).str.contains('benigno|normal', case=False, na=False)
+    is_malignant &= ~is_benign_note
     
-    # Create category string like "Density1+Benign"
-    if mass_type:
-        category = f"Density{density}+{mass_type}"
-    else:
-        category = f"Density{density}"
+    table['mass'] = clean_column(df, 'Mass ').eq('X')
+    table['mass_type'] = pd.Series(np.where(is_malignant, 'Malignant', 'Benign'),
+                                   index=df.index, dtype=object).where(table['mass'], None)
     
+    # Категория вида "Density1+Benign"
+    category = 'Density' + density_str.fillna('None')
+    table['category'] = category.where(~table['mass'], category + '+' + table['mass_type'].fillna(''))
+    
+    table['birads'] = birads
+    table['laterality'] = clean_column(df, 'Laterality')
+    table['view'] = clean_column(df, 'View')
+    table['date'] = clean_column(df, 'Acquisition date').astype(str).fillna('None')
+    table['calcification'] = clean_column(df, 'Micros ').eq('X')
+    table['distortion'] = clean_column(df, 'Distortion').eq('X')
+    table['asymmetry'] = clean_column(df, 'Asymmetry').eq('X')
+    table['description'] = description
+    table['lesion_annotation'] = clean_column(df, 'Lesion Annotation Status')
+    return table
+
+def create_annotation(record):
+    """Creates annotation from a row of the annotation table joined with DICOM info"""
     annotation = {
-        'filename': str(int(float(clean_value(row['File Name'])))),
+        'filename': record['filename'],
         'image': {
-            'width': img_info['width'],
-            'height': img_info['height'],
-            'pixel_spacing': img_info['spacing']
+            'width': record['width'],
+            'height': record['height'],
+            'pixel_spacing': record['spacing']
         },
         'classification': {
-            'density': int(density),
-            'mass_type': mass_type,
-            'category': category,
-            'birads': clean_value(row['Bi-Rads'])
+            'density': int(record['density']),
+            'mass_type': record['mass_type'],
+            'category': record['category'],
+            'birads': record['birads']
         },
         'exam': {
-            'laterality': clean_value(row['Laterality']),
-            'view': clean_value(row['View']),
-            'date': str(clean_value(row['Acquisition date']))
+            'laterality': record['laterality'],
+            'view': record['view'],
+            'date': record['date']
         },
         'findings': {
-            'mass': clean_value(row.get('Mass ')) == 'X',
-            'calcification': clean_value(row.get('Micros ')) == 'X',
-            'distortion': clean_value(row.get('Distortion')) == 'X',
-            'asymmetry': clean_value(row.get('Asymmetry')) == 'X',
-            'description': clean_value(row.get('Findings Notes (in Portuguese)')),
-            'lesion_annotation': clean_value(row.get('Lesion Annotation Status'))
+            'mass': bool(record['mass']),
+            'calcification': bool(record['calcification']),
+            'distortion': bool(record['distortion']),
+            'asymmetry': bool(record['asymmetry']),
+            'description': record['description'],
+            'lesion_annotation': record['lesion_annotation']
         }
     }
-    
+    # Область груди для обрезки (dicom_converter.py --crop): смещения для пересчета координат
+    if record.get('roi') is not None:
+        annotation['image']['roi'] = record['roi']
     return annotation
 
-def main():
+def main(header_only=True, workers=None, metrics_path=None, profile_path=None, roi_margin=None):
+    metrics = RunMetrics('dicom_annotation', {'header_only': header_only, 'workers': workers,
+                                              'roi_margin': roi_margin},
+                         profile=bool(profile_path))
     # Setup paths
     current_dir = Path.cwd()
     excel_path = current_dir / 'INbreast.xls'
@@ -111,54 +222,81 @@ def main():
     
     # Load Excel data
     print("Loading Excel data...")
-    df = pd.read_excel(excel_path)
+    with metrics.stage('load_excel'):
+        df = load_excel(excel_path)
     print(f"Loaded {len(df)} rows from Excel")
+    with metrics.stage('build_table'):
+        table = build_annotation_table(df)
     
     # Process each row
-    annotations = []
     categories_count = {}  # Для подсчета количества изображений в каждой категории
     errors = []  # Для сбора информации об ошибках
     
+    print("\nIndexing DICOM files...")
+    with metrics.stage('index_dicoms'):
+        dicom_index = load_dicom_index(dicom_dir)
+    
     print("\nProcessing DICOM files...")
     
-    for idx, row in df.iterrows():
-        try:
-            if pd.isna(row['File Name']):
-                continue
+    # Сначала находим файлы, затем читаем заголовки пакетом
+    pending = []
+    for idx, filename in table['filename'].items():
+        dicom_path = find_dicom(dicom_index, filename)
+        if dicom_path is None:
+            print(f"Warning: No DICOM file found for {filename}")
+            continue
+        pending.append((idx, dicom_path))
+    
+    # Строки Excel для найденных файлов; заголовки DICOM читаются параллельно и
+    # каждая аннотация пишется в JSONL, как только готов ее заголовок
+    records = table.loc[[idx for idx, _ in pending]].to_dict('records')
+    infos = iter_dicom_infos([dicom_path for _, dicom_path in pending], header_only, workers, roi_margin)
+    
+    jsonl_path = annotations_dir / JSONL_NAME
+    writer = AnnotationWriter(jsonl_path)
+    with metrics.stage('read_and_write'):
+        for (idx, _), record in zip(pending, records):
+            with metrics.phase(record['filename'], 'decode'):
+                info, read_error = next(infos)
+            try:
+                if read_error:
+                    print(read_error)
+                    continue
+                record.update({'width': info['width'], 'height': info['height'], 'spacing': info['spacing'],
+                               'roi': info.get('roi')})
                 
-            filename = str(int(float(clean_value(row['File Name']))))
-            dicom_paths = list(dicom_dir.glob(f"*{filename}*.dcm"))
-            
-            if not dicom_paths:
-                print(f"Warning: No DICOM file found for {filename}")
-                continue
+                if not record['valid_density']:
+                    print(f"Warning: Invalid density value for file {record['filename']}: {record['density']}")
+                    continue
                 
-            dicom_path = dicom_paths[0]
-            img_info = get_dicom_info(dicom_path)
-            
-            if img_info:
-                annotation = create_annotation(row, img_info)
-                if annotation:
-                    annotations.append(annotation)
-                    # Подсчет категорий
-                    category = annotation['classification']['category']
-                    categories_count[category] = categories_count.get(category, 0) + 1
-                    print(f"Processed image {filename} - {category}")
+                with metrics.phase(record['filename'], 'compute'):
+                    annotation = create_annotation(record)
+                with metrics.phase(record['filename'], 'encode'):
+                    size = writer.write(annotation)
+                metrics.count(record['filename'], bytes_written=size)
+                # Подсчет категорий
+                category = annotation['classification']['category']
+                categories_count[category] = categories_count.get(category, 0) + 1
+                print(f"Processed image {record['filename']} - {category}")
         
-        except Exception as e:
-            error_msg = f"Error processing row {idx} (File: {row.get('File Name')}): {str(e)}"
-            print(error_msg)
-            errors.append(error_msg)
-            continue
+            except Exception as e:
+                error_msg = f"Error processing row {idx} (File: {record['filename']}): {str(e)}"
+                print(error_msg)
+                errors.append(error_msg)
+                continue
+    
+    writer.close()
     
-    # Save annotations
-    output_path = annotations_dir / 'all_annotations.json'
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(annotations, f, indent=2, ensure_ascii=False)
+    # all_annotations.json и индексированная копия (annotation_store.py) строятся потоково из JSONL
+    output_path = annotations_dir / JSON_NAME
+    with metrics.stage('export_json'):
+        write_json_array(iter_annotations(jsonl_path), output_path)
+    with metrics.stage('export_db'):
+        write_annotation_store(iter_annotations(jsonl_path), annotations_dir / DB_NAME)
     
     # Print statistics
     print("\nDataset statistics:")
-    print(f"Total images processed: {len(annotations)}")
+    print(f"Total images processed: {writer.count}")
     print(f"Failed to process: {len(errors)} images")
     
     print("\nImages per category:")
@@ -173,6 +311,19 @@ def main():
         print(f"\nErrors have been saved to {error_path}")
     
     print(f"\nDone! Annotations saved to {output_path}")
+    metrics.finish(metrics_path, profile_path)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Build INbreast annotations from Excel and DICOM headers')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Number of processes for reading DICOM headers (default: CPU count)')
+    parser.add_argument('--full-read', action='store_true',
+                        help='Read complete DICOM files instead of headers only')
+    parser.add_argument('--roi', action='store_true',
+                        help='Decode pixels and store the breast region (image.roi) used by dicom_converter.py --crop')
+    parser.add_argument('--roi-margin', type=int, default=DEFAULT_MARGIN,
+                        help='Margin around the breast region in pixels')
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    main(header_only=not args.full_read, workers=args.workers, metrics_path=args.metrics,
+         profile_path=args.profile, roi_margin=args.roi_margin if args.roi else None)
\ No newline at end of file
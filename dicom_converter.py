@@ -1,11 +1,28 @@
 import os
 import json
+import argparse
 import numpy as np
 import pydicom
 from PIL import Image
+try:
+    from pydicom.pixels import apply_voi_lut
+except ImportError:  # pydicom < 3
+    from pydicom.pixel_data_handlers.util import apply_voi_lut
 from pathlib import Path
 from tqdm import tqdm
 from collections import defaultdict
+from dicom_index import load_dicom_index, find_dicom
+from conversion_engine import run_stages
+from array_store import ArrayStore, STORAGE_FORMATS
+from manifest import Manifest, code_version, combine_hashes, MANIFEST_NAME
+from sharding import (add_shard_arguments, check_shard, in_shard, shard_name, shard_store_path,
+                      store_exists, write_shard_report)
+from annotation_store import iter_annotations, default_annotations_path
+from image_io import IMAGE_FORMATS, extension, write_image
+from metrics import RunMetrics, add_metrics_arguments
+from roi import breast_bbox, crop, DEFAULT_MARGIN
+from pyramid import add_pyramid_arguments, write_pyramid, remove_stale_levels, PYRAMID_DIR
+from stats import DatasetStats, PixelStats, STATS_NAME, print_stats
 
 # Ожидаемое количество изображений в каждой категории
 EXPECTED_COUNTS = {
@@ -19,39 +36,234 @@ EXPECTED_COUNTS = {
     'Density4+Malignant': 1
 }
 
-def normalize_dicom(dicom_data):
-    """Normalize DICOM pixel array to 0-255 range"""
-    pixel_array = dicom_data.pixel_array
-    if pixel_array.max() != pixel_array.min():
-        normalized = ((pixel_array - pixel_array.min()) * 255.0 / (pixel_array.max() - pixel_array.min()))
+NORMALIZE_MODES = ('minmax', 'voi')
+
+def get_voi_window(dicom_data):
+    """Returns (low, high) of the first VOI window in stored pixel units or None"""
+    center = getattr(dicom_data, 'WindowCenter', None)
+    width = getattr(dicom_data, 'WindowWidth', None)
+    if center is None or width is None:
+        return None
+    if isinstance(center, pydicom.multival.MultiValue):
+        center = center[0]
+    if isinstance(width, pydicom.multival.MultiValue):
+        width = width[0]
+    center, width = float(center), float(width)
+    if width <= 0:
+        return None
+    
+    # Окно задано в единицах после Rescale Slope/Intercept
+    slope = float(getattr(dicom_data, 'RescaleSlope', 1) or 1)
+    intercept = float(getattr(dicom_data, 'RescaleIntercept', 0) or 0)
+    low = (center - width / 2 - intercept) / slope
+    high = (center + width / 2 - intercept) / slope
+    return (low, high) if low < high else (high, low)
+
+def normalize_dicom(dicom_data, mode='minmax', bit_depth=8, roi=None):
+    """
+    Normalize DICOM pixel array to 8-bit (0-255) or 16-bit (0-65535) range.
+
+    Args:
+        dicom_data: pydicom dataset
+        mode: 'minmax' stretches the pixel range, 'voi' applies the DICOM VOI window/LUT
+        bit_depth: Output depth, 8 (uint8) or 16 (uint16, keeps the detector dynamic range)
+        roi: Optional region {x, y, width, height} (see roi.py); only it is normalized and returned
+
+    Returns:
+        Normalized image array
+    """
+    if mode not in NORMALIZE_MODES:
+        raise ValueError(f"Unknown normalization mode: {mode}")
+    if bit_depth not in (8, 16):
+        raise ValueError(f"Unsupported bit depth: {bit_depth}")
+    out_dtype = np.uint8 if bit_depth == 8 else np.uint16
+    out_max = np.iinfo(out_dtype).max
+    
+    # Обрезка до нормализации: дальше обрабатывается только область груди
+    pixel_array = crop(dicom_data.pixel_array, roi)
+    window = get_voi_window(dicom_data) if mode == 'voi' else None
+    
+    if mode == 'voi' and window is None and 'VOILUTSequence' in dicom_data:
+        # Нелинейный VOI LUT: применяем средствами pydicom, дальше min-max
+        pixel_array = apply_voi_lut(pixel_array, dicom_data)
+    
+    if window is not None:
+        low, high = window
+        buffer = np.empty(pixel_array.shape, dtype=np.float32)
+        np.subtract(pixel_array, low, out=buffer, dtype=np.float32)
+        np.clip(buffer, 0, high - low, out=buffer)
+        np.multiply(buffer, out_max / (high - low), out=buffer)
+        np.add(buffer, 0.5, out=buffer)  # округление вместо усечения
+        return buffer.astype(out_dtype)
+    
+    # Рабочие буферы выделяются на вызов: после него память освобождается, потоки ее не держат
+    # Один проход min/max
+    low = pixel_array.min()
+    high = pixel_array.max()
+    if high == low:
+        return np.zeros(pixel_array.shape, dtype=out_dtype)
+    
+    if np.issubdtype(pixel_array.dtype, np.integer) and int(high) - int(low) <= 0xFFFF:
+        # Целочисленная арифметика: (x - min) * max // (max - min) без float64 копий,
+        # совпадает с прежним усечением float-результата
+        buffer = np.empty(pixel_array.shape, dtype=np.uint32)
+        # Знаковые типы вычитаем в int64: для int16 разность может не поместиться в исходный тип
+        signed = np.issubdtype(pixel_array.dtype, np.signedinteger)
+        np.subtract(pixel_array, low, out=buffer, dtype=np.int64 if signed else None, casting='unsafe')
+        np.multiply(buffer, out_max, out=buffer)
+        np.floor_divide(buffer, int(high) - int(low), out=buffer)
     else:
-        normalized = pixel_array * 0
-    return normalized.astype('uint8')
+        buffer = np.empty(pixel_array.shape, dtype=np.float32)
+        np.subtract(pixel_array, low, out=buffer, dtype=np.float32, casting='unsafe')
+        np.multiply(buffer, out_max / (float(high) - float(low)), out=buffer)
+    return buffer.astype(out_dtype)
+
+def read_dicom(dicom_path):
+    """Read DICOM file and decode its pixel data"""
+    dicom_data = pydicom.dcmread(dicom_path)
+    dicom_data.pixel_array  # декодируем сразу, чтобы этап чтения включал декодирование
+    return dicom_data
 
-def convert_dicom_to_png(dicom_path, output_path, file_format='PNG'):
+def save_image(img_array, output_path, file_format='PNG', compression=None):
+    """
+    Encode image array and save it.
+    file_format: one of image_io.IMAGE_FORMATS (png, webp, tiff, raw) with compression level,
+    other formats (e.g. JPEG) are saved with PIL
+    Returns number of bytes written
+    """
+    if file_format.lower() in IMAGE_FORMATS:
+        return write_image(output_path, img_array, file_format.lower(), compression)
+    image = Image.fromarray(img_array)
+    image.save(output_path, format=file_format)
+    return os.path.getsize(output_path)
+
+def convert_dicom_to_png(dicom_path, output_path, file_format='PNG', mode='minmax', bit_depth=8):
     """Convert DICOM file to PNG/JPG"""
     try:
-        dicom_data = pydicom.dcmread(dicom_path)
-        img_array = normalize_dicom(dicom_data)
-        image = Image.fromarray(img_array)
-        image.save(output_path, format=file_format)
+        dicom_data = read_dicom(dicom_path)
+        img_array = normalize_dicom(dicom_data, mode, bit_depth)
+        save_image(img_array, output_path, file_format)
         return True
     except Exception as e:
         print(f"Error converting {dicom_path}: {str(e)}")
         return False
 
-def load_annotations(annotations_path):
-    """Load and filter annotations to include only mass cases"""
-    with open(annotations_path, 'r') as f:
-        annotations = json.load(f)
+def output_key(output_path, store=None):
+    """Returns manifest key of an output: <category>/<file name> (or <category>/<name> in a store)"""
+    output_path = Path(output_path)
+    name = output_path.stem if store is not None else output_path.name
+    return f"{output_path.parent.name}/{name}"
+
+def convert_dicom_files(jobs, file_format='PNG', workers=None, queue_size=8,
+                        mode='minmax', bit_depth=8, store=None, manifest=None, compression=None,
+                        metrics=None, rois=None, crop_margin=None, pyramid=None, stats=None):
+    """
+    Convert many DICOM files with pipelined decode, normalization and encoding stages.
+
+    Args:
+        jobs: List of (dicom_path, output_path) tuples
+        file_format: Output image format, see save_image
+        workers: Workers per stage (int or [read, normalize, encode])
+        queue_size: Maximum number of images waiting between stages
+        mode: Normalization mode, see normalize_dicom
+        bit_depth: Output bit depth, 8 or 16
+        store: Optional ArrayStore; images are saved as raw arrays under
+            (output_path.parent.name, output_path.stem) instead of image files
+        manifest: Optional Manifest; up-to-date outputs are skipped and new ones recorded
+        compression: Compression level for the format, see image_io.encode_image
+        metrics: Optional RunMetrics; decode/compute/encode times and bytes are recorded per image
+        rois: Optional list of breast regions (annotation['image']['roi'] or None), one per job
+        crop_margin: Crop to the breast region; jobs without a region in rois get one
+            computed with this margin (roi.breast_bbox)
+        pyramid: Optional list of long-side sizes; reduced copies are saved in the same pass
+            to <output base>/.pyramid/<size>/<category>/ (see pyramid.py)
+        stats: Optional DatasetStats; pixel statistics of every converted image are recorded
+            from the array already in memory. Up-to-date outputs without statistics are converted again
+
+    Returns:
+        List of booleans in the same order as jobs, True if conversion succeeded
+    """
+    if metrics is None:
+        metrics = RunMetrics('dicom_converter')
+
+    def decode(job):
+        dicom_path, output_path, input_hash, roi = job
+        metrics.count(output_key(output_path, store), bytes_read=os.path.getsize(dicom_path))
+        return output_path, input_hash, roi, read_dicom(dicom_path)
+
+    def normalize(task):
+        output_path, input_hash, roi, dicom_data = task
+        if crop_margin is not None and roi is None:
+            roi = breast_bbox(dicom_data.pixel_array, crop_margin)
+        return output_path, input_hash, normalize_dicom(dicom_data, mode, bit_depth, roi)
+
+    def encode(task):
+        output_path, input_hash, img_array = task
+        key = output_key(output_path, store)
+        output_path = Path(output_path)
+        if store is not None:
+            store.put(output_path.parent.name, output_path.stem, img_array)
+            size = img_array.nbytes
+        else:
+            size = save_image(img_array, output_path, file_format, compression)
+        outputs = [key]
+        if pyramid:
+            # Уровни пирамиды в том же формате, что и полноразмерные изображения (raw для хранилища)
+            level_format = file_format.lower() if file_format.lower() in IMAGE_FORMATS else 'png'
+            level_outputs, level_size = write_pyramid(
+                output_path.parent.parent, output_path.parent.name, output_path.name, img_array,
+                pyramid, 'raw' if store is not None else level_format, compression)
+            outputs += level_outputs
+            size += level_size
+        metrics.count(key, bytes_written=size)
+        if stats is not None:
+            with metrics.phase(key, 'stats'):
+                stats.record(key, output_path.parent.name, PixelStats.from_image(img_array))
+        if manifest is not None:
+            remove_stale_levels(manifest, key, outputs)
+            manifest.record(key, input_hash, outputs)
+
+    results = [False] * len(jobs)
+    
+    # Пропускаем актуальные результаты
+    pending = []
+    pending_idx = []
+    exists = None
+    if store is not None:
+        # Уровни пирамиды - файлы рядом с хранилищем, остальные выходы - ключи хранилища шарда или общего
+        exists = store_exists(store, manifest.base_path)
+    for idx, (dicom_path, output_path) in enumerate(jobs):
+        roi = rois[idx] if crop_margin is not None and rois is not None else None
+        input_hash = manifest.input_hash(dicom_path) if manifest is not None else None
+        if input_hash is not None and roi is not None:
+            # Другая область из аннотаций - другой выход
+            input_hash = combine_hashes(input_hash, json.dumps(roi, sort_keys=True))
+        key = output_key(output_path, store)
+        if manifest is not None and manifest.is_current(key, input_hash, exists) and (stats is None or key in stats):
+            results[idx] = True
+            continue
+        pending.append((dicom_path, output_path, input_hash, roi))
+        pending_idx.append(idx)
+    if manifest is not None and len(pending) < len(jobs):
+        print(f"Skipping {len(jobs) - len(pending)} up-to-date images")
     
-    # Группируем аннотации по категориям
+    stages = [metrics.timed('decode', decode, lambda job: output_key(job[1], store)),
+              metrics.timed('compute', normalize, lambda task: output_key(task[0], store)),
+              metrics.timed('encode', encode, lambda task: output_key(task[0], store))]
+    for i, _, error in tqdm(run_stages(pending, stages, workers, queue_size), total=len(pending)):
+        idx = pending_idx[i]
+        if error is None:
+            results[idx] = True
+        else:
+            print(f"Error converting {jobs[idx][0]}: {str(error)}")
+    return results
+
+def load_annotations(annotations_path):
+    """Load and filter annotations to include only mass cases (SQLite store, JSON Lines or JSON)"""
+    # Группируем аннотации по категориям; читаем по одной, только нужные категории
     category_annotations = defaultdict(list)
-    for ann in annotations:
-        if 'classification' in ann and 'category' in ann['classification']:
-            category = ann['classification']['category']
-            if category in EXPECTED_COUNTS:  # только нужные категории
-                category_annotations[category].append(ann)
+    for ann in iter_annotations(annotations_path, category=list(EXPECTED_COUNTS)):
+        category_annotations[ann['classification']['category']].append(ann)
     
     return category_annotations
 
@@ -76,52 +288,53 @@ def select_cases(category_annotations):
     
     return selected_annotations
 
-def main():
-    current_dir = Path.cwd()
-    dicom_dir = current_dir / 'ALL-IMGS'
-    annotations_path = current_dir / 'annotations' / 'all_annotations.json'
-    output_base = current_dir / 'mass_images'
-    
-    # Загружаем и фильтруем аннотации
-    print("Loading annotations...")
-    category_annotations = load_annotations(annotations_path)
-    
-    # Выбираем нужное количество случаев
-    selected_annotations = select_cases(category_annotations)
-    
-    # Создаем директории для каждой категории
-    for category in EXPECTED_COUNTS:
-        (output_base / category).mkdir(parents=True, exist_ok=True)
-    
-    # Конвертируем отобранные случаи
-    print("\nConverting selected DICOM files...")
-    successful = defaultdict(int)
-    failed = []
-    
-    for ann in tqdm(selected_annotations):
+def collect_jobs(selected_annotations, dicom_index, output_base, failed, ext='.png'):
+    """
+    Find DICOM files for selected annotations.
+
+    Args:
+        selected_annotations: Annotations to convert
+        dicom_index: Index from dicom_index.load_dicom_index
+        output_base: Output directory, images go to <output_base>/<category>/<filename><ext>
+        failed: List where (filename, reason) of missing files is appended
+        ext: Output file extension
+
+    Returns:
+        Tuple (jobs, job_annotations): (dicom_path, output_path) pairs and their annotations
+    """
+    jobs = []
+    job_anns = []
+    for ann in selected_annotations:
         try:
             filename = ann['filename']
             category = ann['classification']['category']
             
             # Ищем DICOM файл
-            dicom_paths = list(dicom_dir.glob(f"*{filename}*.dcm"))
-            if not dicom_paths:
+            dicom_path = find_dicom(dicom_index, filename)
+            if dicom_path is None:
                 print(f"Warning: No DICOM file found for {filename}")
                 failed.append((filename, "File not found"))
                 continue
             
-            # Конвертируем
-            output_path = output_base / category / f"{filename}.png"
-            if convert_dicom_to_png(dicom_paths[0], output_path):
-                successful[category] += 1
-            else:
-                failed.append((filename, "Conversion failed"))
+            output_path = output_base / category / f"{filename}{ext}"
+            jobs.append((dicom_path, output_path))
+            job_anns.append(ann)
                 
         except Exception as e:
             print(f"Error processing {filename}: {str(e)}")
             failed.append((filename, str(e)))
     
-    # Выводим итоговую статистику
+    return jobs, job_anns
+
+def sort_failures(failed, annotations):
+    """Sorts (filename, reason) failures in annotation order, as a sequential run reports them"""
+    order = {}
+    for position, ann in enumerate(annotations):
+        order.setdefault(ann['filename'], position)
+    failed.sort(key=lambda item: order.get(item[0], len(order)))
+
+def print_summary(successful, failed):
+    """Print per-category conversion table and failed conversions"""
     print("\nConversion completed!")
     print("\nResults by category:")
     print("╔════════════════════╦═══════════╦════════════╦════════════╗")
@@ -133,7 +346,7 @@ def main():
     
     for category in EXPECTED_COUNTS:
         expected = EXPECTED_COUNTS[category]
-        converted = successful[category]
+        converted = successful.get(category, 0)
         diff = converted - expected
         total_expected += expected
         total_converted += converted
@@ -148,8 +361,130 @@ def main():
         print("\nFailed conversions:")
         for filename, reason in failed:
             print(f"- {filename}: {reason}")
+
+def main(workers=None, queue_size=8, mode='minmax', bit_depth=8, storage='png', force=False,
+         shard_index=0, shard_count=1, image_format='png', compression=None, metrics_path=None,
+         profile_path=None, crop_margin=None, pyramid=None):
+    check_shard(shard_index, shard_count)
+    params = {'mode': mode, 'bit_depth': bit_depth, 'storage': storage,
+              'format': image_format, 'compression': compression}
+    if crop_margin is not None:
+        params['crop_margin'] = crop_margin
+    if pyramid:
+        params['pyramid'] = sorted(set(pyramid))
+    metrics = RunMetrics('dicom_converter', {**params, 'workers': workers, 'shard_index': shard_index,
+                                             'shard_count': shard_count}, profile=bool(profile_path))
+    current_dir = Path.cwd()
+    dicom_dir = current_dir / 'ALL-IMGS'
+    annotations_path = default_annotations_path(current_dir / 'annotations')
+    output_base = current_dir / ('mass_images' if storage == 'png' else 'mass_images_npy')
+    
+    # Загружаем и фильтруем аннотации
+    print("Loading annotations...")
+    with metrics.stage('load_annotations'):
+        category_annotations = load_annotations(annotations_path)
+        
+        # Выбираем нужное количество случаев
+        selected_annotations = select_cases(category_annotations)
+    
+    # Выбор делается по всем аннотациям до разбиения на шарды, поэтому не зависит от их числа
+    selected_annotations = [ann for ann in selected_annotations
+                            if in_shard(ann['filename'], shard_index, shard_count)]
+    
+    # Создаем директории для каждой категории
+    # Без --force дописываем в существующее хранилище, актуальные изображения пропускаются
+    # Каждый шард пишет в свое хранилище, sharding.py объединяет их
+    store = (ArrayStore(shard_store_path(output_base, shard_index, shard_count), mode='w' if force else 'a')
+             if storage == 'npy' else None)
+    for category in EXPECTED_COUNTS:
+        if store is None:
+            (output_base / category).mkdir(parents=True, exist_ok=True)
+    
+    # Конвертируем отобранные случаи
+    with metrics.stage('index_dicoms'):
+        dicom_index = load_dicom_index(dicom_dir)
+    print("\nConverting selected DICOM files...")
+    successful = defaultdict(int)
+    failed = []
+    
+    jobs, job_anns = collect_jobs(selected_annotations, dicom_index, output_base, failed, extension(image_format))
+    
+    manifest = Manifest(output_base, params, code_version(__file__),
+                        name=shard_name(MANIFEST_NAME, shard_index, shard_count), fallback=MANIFEST_NAME)
+    stats = DatasetStats(output_base, shard_name(STATS_NAME, shard_index, shard_count), fallback=STATS_NAME)
+    if force:
+        manifest.entries = {}
+        stats.entries = {}
+    
+    # Области груди из аннотаций (dicom_annotation.py --roi), иначе вычисляются при конвертации
+    rois = [ann['image'].get('roi') for ann in job_anns]
+    if crop_margin is not None and None in rois:
+        print(f"Note: {rois.count(None)} annotations have no breast region, it is computed during conversion "
+              f"(run dicom_annotation.py --roi to store crop offsets in the annotations)")
+    
+    # Конвертируем параллельно: чтение -> нормализация -> кодирование
+    with metrics.stage('convert'):
+        results = convert_dicom_files(jobs, image_format, workers=workers, queue_size=queue_size,
+                                      mode=mode, bit_depth=bit_depth, store=store, manifest=manifest,
+                                      compression=compression, metrics=metrics, rois=rois,
+                                      crop_margin=crop_margin, pyramid=pyramid, stats=stats)
+    if store is not None:
+        store.close()
+    manifest.close()
+    if shard_count <= 1:
+        # Убираем статистику изображений, которые больше не отбираются
+        stats.prune(output_key(output_path, store) for _, output_path in jobs)
+    stats.close()
+    for ann, converted in zip(job_anns, results):
+        if converted:
+            successful[ann['classification']['category']] += 1
+        else:
+            failed.append((ann['filename'], "Conversion failed"))
+    # Отсутствующие файлы и ошибки конвертации - в порядке аннотаций
+    sort_failures(failed, selected_annotations)
+    
+    print_summary(successful, failed)
+    
+    if shard_count > 1:
+        write_shard_report(output_base, 'converter', shard_index, shard_count, successful, failed)
+        print(f"\nShard {shard_index} of {shard_count} done; after all shards run: "
+              f"python sharding.py converter {output_base}")
     
+    print_stats(stats.summary())
     print(f"\nImages are saved in: {output_base}")
+    print(f"Pixel statistics are saved in: {stats.path}")
+    if pyramid:
+        print(f"Pyramid levels {sorted(set(pyramid))} are saved in: {output_base / PYRAMID_DIR}")
+    metrics.finish(metrics_path, profile_path)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Convert selected INbreast DICOM files to PNG')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker threads per stage (default: CPU count)')
+    parser.add_argument('--queue-size', type=int, default=8,
+                        help='Maximum number of images waiting between stages')
+    parser.add_argument('--mode', choices=NORMALIZE_MODES, default='minmax',
+                        help='Intensity normalization: min-max stretch or DICOM VOI window/LUT')
+    parser.add_argument('--bit-depth', type=int, choices=(8, 16), default=8,
+                        help='Output bit depth (16 keeps the detector dynamic range)')
+    parser.add_argument('--storage', choices=STORAGE_FORMATS, default='png',
+                        help='Save image files or a memory-mapped array store (mass_images_npy)')
+    parser.add_argument('--format', choices=IMAGE_FORMATS, default='png',
+                        help='Image file format (webp is lossless and 8-bit only, raw writes .npy)')
+    parser.add_argument('--compression', type=int, default=None,
+                        help='PNG zlib level 0-9 (default: OpenCV default); for TIFF 0 disables LZW')
+    parser.add_argument('--force', action='store_true',
+                        help='Reconvert all images, ignoring the manifest of up-to-date outputs')
+    parser.add_argument('--crop', action='store_true',
+                        help='Crop images to the breast region (image.roi from the annotations)')
+    parser.add_argument('--crop-margin', type=int, default=DEFAULT_MARGIN,
+                        help='Margin for breast regions computed during conversion')
+    add_pyramid_arguments(parser)
+    add_shard_arguments(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    main(workers=args.workers, queue_size=args.queue_size, mode=args.mode, bit_depth=args.bit_depth,
+         storage=args.storage, force=args.force, shard_index=args.shard_index, shard_count=args.shard_count,
+         image_format=args.format, compression=args.compression, metrics_path=args.metrics,
+         profile_path=args.profile, crop_margin=args.crop_margin if args.crop else None,
+         pyramid=args.pyramid)
\ No newline at end of file
@@ -0,0 +1,77 @@
+import os
+import json
+from pathlib import Path
+
+INDEX_VERSION = 1
+
+def default_index_path(dicom_dir):
+    """Returns the index file location next to (not inside) the DICOM directory"""
+    # Храним индекс вне папки, иначе запись файла меняет mtime папки
+    dicom_dir = Path(dicom_dir)
+    return dicom_dir.with_name(f"{dicom_dir.name}_index.json")
+
+def file_id(name):
+    """Extracts INbreast numeric file ID from a DICOM filename (e.g. 22678622_..._ANON.dcm)"""
+    prefix = name.split('_', 1)[0]
+    return prefix if prefix.isdigit() else None
+
+def scan_dicom_dir(dicom_dir):
+    """Scans DICOM directory once and maps file ID to DICOM path"""
+    index = {}
+    with os.scandir(dicom_dir) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if not entry.name.endswith('.dcm') or not entry.is_file():
+                continue
+            key = file_id(entry.name) or entry.name[:-len('.dcm')]
+            # Как и glob, берем первый найденный файл
+            index.setdefault(key, entry.path)
+    return index
+
+def load_dicom_index(dicom_dir, index_path=None):
+    """
+    Load filename -> DICOM path index, rebuilding it only if the directory changed.
+
+    Args:
+        dicom_dir: Directory with DICOM files (ALL-IMGS)
+        index_path: Where the index is persisted (defaults to <dicom_dir>_index.json)
+
+    Returns:
+        Dictionary mapping file ID to DICOM path
+    """
+    dicom_dir = Path(dicom_dir)
+    index_path = Path(index_path) if index_path else default_index_path(dicom_dir)
+    mtime_ns = os.stat(dicom_dir).st_mtime_ns
+
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if (cached.get('version') == INDEX_VERSION
+                and cached.get('dicom_dir') == str(dicom_dir.resolve())
+                and cached.get('mtime_ns') == mtime_ns):
+            return cached['files']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    index = scan_dicom_dir(dicom_dir)
+    try:
+        with open(index_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': INDEX_VERSION,
+                'dicom_dir': str(dicom_dir.resolve()),
+                'mtime_ns': mtime_ns,
+                'files': index
+            }, f)
+    except OSError as e:
+        print(f"Warning: Could not save DICOM index to {index_path}: {e}")
+    return index
+
+def find_dicom(index, filename):
+    """Returns DICOM path for a file ID or None if it is not in the index"""
+    path = index.get(str(filename))
+    if path is None:
+        # Запасной вариант: та же подстрочная семантика, что у glob(f"*{filename}*.dcm")
+        for key in sorted(index):
+            if str(filename) in Path(index[key]).name:
+                path = index[key]
+                break
+    return Path(path) if path else None
@@ -1,10 +1,28 @@
+import argparse
 import matplotlib.pyplot as plt
 import numpy as np
+from stats import load_summary
 
 categories = ['Density1', 'Density2', 'Density3', 'Density4']
+# Значения последнего подсчета, если файла статистики еще нет
 benign = [816, 272, 884, 408]
 malignant = [2040, 2176, 544, 68]
 
+parser = argparse.ArgumentParser(description='Plot class distribution from the statistics of the augmented dataset')
+parser.add_argument('path', nargs='?', default='augmented_dataset',
+                    help='augmented_dataset folder or tar shard directory with .stats.json')
+parser.add_argument('--histograms', action='store_true',
+                    help='Also plot intensity histograms per category (intensity_histograms.png)')
+args = parser.parse_args()
+
+# Количество изображений из статистики, собранной при аугментации (без повторного обхода файлов)
+summary = load_summary(args.path)
+if summary:
+    benign = [summary.get(f"{density}+Benign", {}).get('images', 0) for density in categories]
+    malignant = [summary.get(f"{density}+Malignant", {}).get('images', 0) for density in categories]
+else:
+    print(f"No statistics in {args.path}, using saved counts (run the augmentation to update them)")
+
 # Set up positions for bars
 x = np.arange(len(categories))
 width = 0.35  # Width of the bars
@@ -38,4 +56,21 @@ plt.tight_layout()
 plt.savefig('class_distribution.png')
 plt.close()
 
-print("Plot has been saved as 'class_distribution.png'")
\ No newline at end of file
+print("Plot has been saved as 'class_distribution.png'")
+
+if args.histograms and summary:
+    fig, ax = plt.subplots(figsize=(12, 6))
+    for category, item in summary.items():
+        histogram = np.asarray(item['histogram'], dtype=np.float64)
+        edges = np.linspace(0, item['levels'], len(histogram) + 1)
+        # Доля пикселей без нулевой корзины (фон и паддинг поворотов)
+        ax.plot(edges[1:-1], histogram[1:] / max(histogram[1:].sum(), 1),
+                label=f"{category} (mean {item['mean']:.1f}, std {item['std']:.1f})")
+    ax.set_xlabel('Intensity')
+    ax.set_ylabel('Fraction of non-background pixels')
+    ax.set_title('Intensity Histograms by Category')
+    ax.legend()
+    plt.tight_layout()
+    plt.savefig('intensity_histograms.png')
+    plt.close()
+    print("Plot has been saved as 'intensity_histograms.png'")
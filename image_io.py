@@ -0,0 +1,167 @@
+import io
+import os
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+# Форматы выходных изображений и их расширения
+IMAGE_FORMATS = ('png', 'webp', 'tiff', 'raw')
+EXTENSIONS = {'png': '.png', 'webp': '.webp', 'tiff': '.tif', 'raw': '.npy'}
+
+# Расширения, которые читают этапы конвейера
+READ_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.webp', '.npy')
+
+def extension(fmt):
+    """Returns file extension for an image format"""
+    if fmt not in EXTENSIONS:
+        raise ValueError(f"Unknown image format: {fmt}, choose from {IMAGE_FORMATS}")
+    return EXTENSIONS[fmt]
+
+def encode_image(image, fmt='png', level=None):
+    """
+    Encode image array to bytes.
+
+    Args:
+        image: Image array (8 or 16 bit for png/tiff/raw, 8 bit for webp)
+        fmt: 'png', 'webp' (lossless), 'tiff' or 'raw' (.npy, no compression)
+        level: Compression level; png: zlib level 0-9 (None = OpenCV default),
+            tiff: 0 = uncompressed, otherwise LZW (default); ignored for webp and raw
+
+    Returns:
+        Encoded bytes
+    """
+    if fmt == 'raw':
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(image), allow_pickle=False)
+        return buffer.getvalue()
+    if fmt == 'png':
+        params = [] if level is None else [cv2.IMWRITE_PNG_COMPRESSION, int(level)]
+    elif fmt == 'webp':
+        if image.dtype != np.uint8:
+            raise ValueError("WebP supports only 8-bit images")
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]  # качество > 100 - сжатие без потерь
+    elif fmt == 'tiff':
+        params = [cv2.IMWRITE_TIFF_COMPRESSION, 1 if level == 0 else 5]
+    else:
+        raise ValueError(f"Unknown image format: {fmt}, choose from {IMAGE_FORMATS}")
+    ok, data = cv2.imencode(extension(fmt), image, params)
+    if not ok:
+        raise IOError(f"Error encoding image as {fmt}")
+    return data.tobytes()
+
+def write_image(path, image, fmt='png', level=None):
+    """Encode and write image atomically (temporary file + rename), so a partial file is never visible"""
+    data = encode_image(image, fmt, level)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+def read_image(path):
+    """Reads grayscale image of any supported format keeping its bit depth; returns None on failure"""
+    if str(path).lower().endswith('.npy'):
+        try:
+            return np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+    return cv2.imread(str(path), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH)
+
+def find_image(directory, name):
+    """Returns path of name in directory, also trying the other readable extensions; None if missing"""
+    path = Path(directory) / name
+    if path.exists():
+        return path
+    for ext in READ_EXTENSIONS:
+        candidate = path.with_suffix(ext)
+        if candidate.exists():
+            return candidate
+    return None
+
+def output_name(name, fmt):
+    """Replaces extension of a file name with the one of the format"""
+    return Path(name).with_suffix(extension(fmt)).name
+
+class AsyncImageWriter:
+    """
+    Background pool that encodes and writes images while the caller keeps computing.
+
+    write() returns immediately unless max_pending images are already waiting; then
+    it blocks until one is written (backpressure), so memory stays bounded.
+    """
+
+    def __init__(self, fmt='png', level=None, workers=2, max_pending=32, metrics=None):
+        """
+        Args:
+            fmt, level: Output format and compression level, see encode_image
+            workers: Encoder threads
+            max_pending: Maximum number of images queued or being encoded
+            metrics: Optional metrics.RunMetrics; encode time and bytes are recorded
+                under the key passed to write()
+        """
+        extension(fmt)
+        self.fmt = fmt
+        self.level = level
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.bytes_written = 0
+        self._lock = threading.Lock()
+        self.metrics = metrics
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write(self, path, image, key):
+        try:
+            if self.metrics is not None:
+                with self.metrics.phase(key, 'encode'):
+                    size = write_image(path, image, self.fmt, self.level)
+                self.metrics.count(key, bytes_written=size)
+            else:
+                size = write_image(path, image, self.fmt, self.level)
+            with self._lock:
+                self.bytes_written += size
+        finally:
+            self._slots.release()
+
+    def write(self, path, image, key=None):
+        """Queue image for writing; returns a Future. key: image key for metrics (default: path)"""
+        self._slots.acquire()
+        try:
+            return self._executor.submit(self._write, path, image, key or str(path))
+        except Exception:
+            self._slots.release()
+            raise
+
+    def when_done(self, futures, callback):
+        """
+        Call callback(error) once all futures finished; error is the first exception or None.
+        The callback runs in a writer thread.
+        """
+        futures = list(futures)
+        if not futures:
+            callback(None)
+            return
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            callback(errors[0] if errors else None)
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def close(self):
+        """Wait until all queued images are written"""
+        self._executor.shutdown(wait=True)
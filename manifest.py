@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from pathlib import Path
+
+MANIFEST_NAME = '.manifest.json'
+MANIFEST_VERSION = 1
+
+def file_hash(path, chunk_size=1 << 20):
+    """Returns BLAKE2 hash of file content"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def array_hash(array):
+    """Returns BLAKE2 hash of array shape, dtype and data"""
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f"{array.shape}{array.dtype.str}".encode())
+    h.update(np.ascontiguousarray(array))
+    return h.hexdigest()
+
+def combine_hashes(*hashes):
+    """Combines several hashes into one"""
+    return hashlib.blake2b(''.join(hashes).encode(), digest_size=16).hexdigest()
+
+def code_version(*paths):
+    """Returns hash of the source files that implement a stage"""
+    return combine_hashes(*(file_hash(path) for path in paths))
+
+class Manifest:
+    """
+    Record of outputs produced by a pipeline stage.
+
+    For every output key the manifest stores the input content hash, the stage
+    parameters, the code version and the list of files written. An output is up to
+    date when all three match and its files still exist, so reruns skip finished
+    work and resume after a crash. The manifest is saved every save_every records
+    and on close().
+    """
+
+    def __init__(self, base_path, params, version, save_every=20, name=MANIFEST_NAME, fallback=None):
+        """
+        Args:
+            base_path: Output directory; the manifest is <base_path>/<name>
+            params: JSON-serializable stage parameters
+            version: Code version, see code_version
+            save_every: Save after this many new records
+            name: Manifest file name
+            fallback: Manifest file to start from when <name> does not exist yet
+                (a shard starts from the merged manifest)
+        """
+        self.base_path = Path(base_path)
+        self.path = self.base_path / name
+        # Параметры через JSON, чтобы кортежи и списки сравнивались одинаково
+        self.params = json.loads(json.dumps(params))
+        self.version = version
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self._input_hashes = {}
+
+        path = self.path
+        if fallback and not path.exists():
+            path = self.base_path / fallback
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != MANIFEST_VERSION:
+                raise ValueError("Unsupported manifest version")
+            self.entries = data['entries']
+            self._input_hashes = data.get('inputs', {})
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def input_hash(self, path):
+        """Returns content hash of an input file, cached by size and mtime"""
+        path = str(path)
+        st = os.stat(path)
+        with self._lock:
+            cached = self._input_hashes.get(path)
+        if cached and cached['size'] == st.st_size and cached['mtime_ns'] == st.st_mtime_ns:
+            return cached['hash']
+        digest = file_hash(path)
+        with self._lock:
+            self._input_hashes[path] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': digest}
+        return digest
+
+    def is_current(self, key, input_hash, exists=None):
+        """
+        Check whether output is up to date.
+
+        Args:
+            key: Output key
+            input_hash: Current hash of the inputs
+            exists: Function checking that an output exists (default: file relative to base_path)
+
+        Returns:
+            True if the output can be skipped
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+        if (entry is None or entry['input_hash'] != input_hash
+                or entry['params'] != self.params or entry['code_version'] != self.version):
+            return False
+        exists = exists or (lambda output: (self.base_path / output).exists())
+        return all(exists(output) for output in entry['outputs'])
+
+    def stale_outputs(self, key, outputs):
+        """Returns outputs recorded earlier for key that are not in the new outputs"""
+        with self._lock:
+            entry = self.entries.get(key)
+        return [output for output in entry['outputs'] if output not in set(outputs)] if entry else []
+
+    def record(self, key, input_hash, outputs):
+        """Record finished output with the list of files written (relative to base_path)"""
+        with self._lock:
+            self.entries[key] = {
+                'input_hash': input_hash,
+                'params': self.params,
+                'code_version': self.version,
+                'outputs': [str(output) for output in outputs]
+            }
+            self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self._save()
+
+    def _save(self):
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': MANIFEST_VERSION, 'entries': self.entries, 'inputs': self._input_hashes}, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+    def close(self):
+        """Save the manifest"""
+        with self._lock:
+            self._save()
+
+def merge_manifests(base_path, paths, name=MANIFEST_NAME, owns=None):
+    """
+    Merge entries of several manifest files (e.g. one per shard) into <base_path>/<name> and remove them.
+
+    owns(path, key): optional check that the file at path owns the key; only those entries are
+    taken from it. A shard starts from a copy of the merged manifest, so its entries of other
+    shards' keys are stale and must not overwrite the fresh ones.
+    """
+    target = Manifest(base_path, {}, None, name=name)
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        target.entries.update((key, entry) for key, entry in data.get('entries', {}).items()
+                              if owns is None or owns(path, key))
+        target._input_hashes.update(data.get('inputs', {}))
+    target.close()
+    for path in paths:
+        os.remove(path)
@@ -0,0 +1,276 @@
+import os
+import csv
+import json
+import time
+import pstats
+import cProfile
+import sys
+import platform
+import resource
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+# Фазы обработки одного изображения
+PHASES = ('decode', 'compute', 'encode')
+
+# С Python 3.12 cProfile работает через sys.monitoring: активен только один профилировщик
+# на процесс, и он видит все потоки. До 3.12 профилировщик действует на свой поток
+SHARED_PROFILER = sys.version_info >= (3, 12)
+
+def peak_rss_mb():
+    """Returns peak resident set size of this process and its finished children in MB"""
+    # ru_maxrss в КБ на Linux и в байтах на macOS
+    scale = 1 if platform.system() == 'Darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * scale / 2 ** 20
+
+def add_metrics_arguments(parser):
+    """Adds --metrics/--profile options to an argparse parser"""
+    parser.add_argument('--metrics', default=None,
+                        help='Write a run report with per-stage and per-image timings (.json or .csv)')
+    parser.add_argument('--profile', default=None,
+                        help='Save cProfile statistics of the per-image work to this file (.prof)')
+
+class RunMetrics:
+    """
+    Timings and I/O counters of one script run.
+
+    Stages are whole steps of the run (loading annotations, converting, ...),
+    timed with stage(). Phases are the per-image steps (decode, compute, encode),
+    timed with phase() from any worker thread. Nested phases are exclusive: time
+    spent in an inner phase is not counted for the outer one, so a synchronous
+    encode inside augmentation counts as encode only.
+
+    With profile=True the outermost phases of every thread run under cProfile.
+    Before Python 3.12 every thread has its own profiler, merged by write_profile();
+    from 3.12 on a single profiler is enabled while any thread is inside a phase.
+    If profiling cannot start (another profiler is active), only timings are recorded.
+    """
+
+    def __init__(self, script, params=None, profile=False):
+        """
+        Args:
+            script: Script name for the report
+            params: JSON-serializable run parameters for the report
+            profile: Capture cProfile statistics of the phases
+        """
+        self.script = script
+        self.params = params or {}
+        self.started = datetime.now(timezone.utc).isoformat(timespec='seconds')
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stages = {}
+        self.images = {}
+        self.profile = profile
+        self._profiles = []
+        self._shared_profiler = None
+        self._profiling_threads = 0
+
+    def _image(self, key):
+        image = self.images.get(key)
+        if image is None:
+            image = self.images[key] = {'bytes_read': 0, 'bytes_written': 0, 'first': None, 'last': None}
+        return image
+
+    @contextmanager
+    def stage(self, name):
+        """Time a whole stage of the run; repeated stages are added up"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stage = self.stages.setdefault(name, {'seconds': 0.0})
+                stage['seconds'] += elapsed
+                stage['peak_rss_mb'] = peak_rss_mb()
+
+    def _profiler(self):
+        profiler = getattr(self._local, 'profiler', None)
+        if profiler is None:
+            profiler = self._local.profiler = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profiler)
+        return profiler
+
+    def _profiling_unavailable(self, error):
+        """Turns profiling off after enable() failed; returns False"""
+        if self.profile:
+            self.profile = False
+            print(f"Warning: profiling disabled ({error}), only timings are recorded")
+        return False
+
+    def _start_profiling(self):
+        """Enables profiling for a phase of the current thread; returns False if it is not possible"""
+        if not SHARED_PROFILER:
+            try:
+                self._profiler().enable()
+                return True
+            except ValueError as e:
+                return self._profiling_unavailable(e)
+        with self._lock:
+            if self._profiling_threads == 0:
+                if self._shared_profiler is None:
+                    self._shared_profiler = cProfile.Profile()
+                    self._profiles.append(self._shared_profiler)
+                try:
+                    self._shared_profiler.enable()
+                except ValueError as e:
+                    return self._profiling_unavailable(e)
+            self._profiling_threads += 1
+        return True
+
+    def _stop_profiling(self):
+        if not SHARED_PROFILER:
+            self._local.profiler.disable()
+            return
+        with self._lock:
+            self._profiling_threads -= 1
+            if self._profiling_threads == 0:
+                self._shared_profiler.disable()
+
+    @contextmanager
+    def phase(self, key, name):
+        """Time a phase (decode, compute, encode, ...) of one image"""
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        profiling = self.profile and not stack and self._start_profiling()
+        stack.append(0.0)  # время вложенных фаз
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profiling:
+                self._stop_profiling()
+            end = time.perf_counter()
+            nested = stack.pop()
+            if stack:
+                stack[-1] += end - start
+            with self._lock:
+                image = self._image(key)
+                image[name] = image.get(name, 0.0) + (end - start - nested)
+                start, end = start - self._start, end - self._start
+                image['first'] = start if image['first'] is None else min(image['first'], start)
+                image['last'] = end if image['last'] is None else max(image['last'], end)
+
+    def timed(self, name, fn, key):
+        """Wraps a pipeline stage function so each call is timed as a phase; key(arg) names the image"""
+        def wrapper(arg):
+            with self.phase(key(arg), name):
+                return fn(arg)
+        return wrapper
+
+    def count(self, key, bytes_read=0, bytes_written=0):
+        """Add bytes read/written for an image"""
+        with self._lock:
+            image = self._image(key)
+            image['bytes_read'] += bytes_read
+            image['bytes_written'] += bytes_written
+
+    def phase_names(self):
+        """Returns phase names in use, standard phases first"""
+        names = {name for image in self.images.values() for name in image} - {
+            'bytes_read', 'bytes_written', 'first', 'last'}
+        return [name for name in PHASES if name in names] + sorted(names - set(PHASES))
+
+    def image_rows(self):
+        """Returns per-image rows: key, phase seconds, total busy seconds, latency and bytes"""
+        phases = self.phase_names()
+        rows = []
+        with self._lock:
+            for key, image in self.images.items():
+                row = {'image': key}
+                row.update({name: round(image.get(name, 0.0), 6) for name in phases})
+                row['busy_seconds'] = round(sum(image.get(name, 0.0) for name in phases), 6)
+                # Задержка: от начала первой фазы до конца последней (включает ожидание в очередях)
+                row['latency_seconds'] = (round(image['last'] - image['first'], 6)
+                                          if image['first'] is not None else 0.0)
+                row['bytes_read'] = image['bytes_read']
+                row['bytes_written'] = image['bytes_written']
+                rows.append(row)
+        return rows
+
+    def summary(self):
+        """Returns report dictionary: run info, stage times, phase totals and I/O"""
+        rows = self.image_rows()
+        phases = self.phase_names()
+        wall = time.perf_counter() - self._start
+        timed_rows = [row for row in rows if row['busy_seconds'] > 0]
+        return {
+            'script': self.script,
+            'started': self.started,
+            'wall_seconds': round(wall, 3),
+            'params': self.params,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'stages': {name: {'seconds': round(stage['seconds'], 3),
+                              'peak_rss_mb': round(stage['peak_rss_mb'], 1)}
+                       for name, stage in self.stages.items()},
+            'images': len(rows),
+            # Сумма по потокам, при параллельной обработке может превышать время выполнения
+            'phase_seconds': {name: round(sum(row[name] for row in rows), 3) for name in phases},
+            'mean_image_seconds': (round(sum(row['busy_seconds'] for row in timed_rows) / len(timed_rows), 4)
+                                   if timed_rows else 0.0),
+            'bytes_read': sum(row['bytes_read'] for row in rows),
+            'bytes_written': sum(row['bytes_written'] for row in rows)
+        }
+
+    def write_report(self, path):
+        """
+        Save the run report.
+        .csv: one row per image; other extensions: JSON with the summary and per-image rows
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        if path.suffix.lower() == '.csv':
+            rows = self.image_rows()
+            fields = ['image', *self.phase_names(), 'busy_seconds', 'latency_seconds',
+                      'bytes_read', 'bytes_written']
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            report = self.summary()
+            report['per_image'] = self.image_rows()
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def write_profile(self, path):
+        """Merge the per-thread cProfile statistics and save them (view with python -m pstats)"""
+        profiles = [profile for profile in self._profiles if profile.getstats()]
+        if not profiles:
+            return None
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(str(path))
+        return stats
+
+    def print_summary(self):
+        """Print stage times, phase totals, I/O and peak memory"""
+        report = self.summary()
+        print(f"\nRun metrics ({report['wall_seconds']:.1f} s, peak RSS {report['peak_rss_mb']:.0f} MB):")
+        for name, stage in report['stages'].items():
+            print(f"  {name:<20} {stage['seconds']:9.2f} s")
+        if report['images']:
+            phases = ', '.join(f"{name} {seconds:.2f} s" for name, seconds in report['phase_seconds'].items())
+            print(f"  {report['images']} images, {report['mean_image_seconds']:.3f} s per image ({phases})")
+            print(f"  Read {report['bytes_read'] / 2 ** 20:.1f} MB, wrote {report['bytes_written'] / 2 ** 20:.1f} MB")
+
+    def finish(self, report_path=None, profile_path=None):
+        """Save the report and profile if paths are given; the summary is printed only then"""
+        if not report_path and not profile_path:
+            # Без --metrics/--profile вывод скриптов не меняется
+            return
+        self.print_summary()
+        if report_path:
+            self.write_report(report_path)
+            print(f"Metrics report saved to {report_path}")
+        if profile_path:
+            if self.write_profile(profile_path) is not None:
+                print(f"Profile saved to {profile_path} (python -m pstats {profile_path})")
@@ -0,0 +1,258 @@
+import os
+import json
+import argparse
+import importlib
+from pathlib import Path
+from collections import defaultdict
+
+from dicom_index import load_dicom_index
+from conversion_engine import run_stages
+import clahe
+import dicom_converter
+from clahe import apply_clahe
+from manifest import Manifest, code_version, combine_hashes
+from roi import breast_bbox, DEFAULT_MARGIN
+from annotation_store import default_annotations_path
+from image_io import IMAGE_FORMATS, write_image, output_name
+from sharding import add_shard_arguments, check_shard, in_shard, shard_name, write_shard_report
+from stats import DatasetStats, PixelStats, STATS_NAME
+from dicom_converter import (EXPECTED_COUNTS, NORMALIZE_MODES, read_dicom, normalize_dicom,
+                             load_annotations, select_cases, collect_jobs, print_summary,
+                             sort_failures)
+
+# Имя файла скрипта аугментации содержит кириллическую букву
+augmentation = importlib.import_module('Comb_Auп_for_Orig_and_CLAHE_Images')
+
+# Выходные директории относительно текущей, как у отдельных скриптов
+OUTPUT_DIRS = {'converted': 'mass_images', 'clahe': 'mass_images_clahe', 'augmented': 'augmented_dataset'}
+
+def stats_keys(output_path, image_format='png'):
+    """Returns statistics keys of the outputs of a job by output_dirs key, as in the standalone scripts"""
+    category, img_file = Path(output_path).parent.name, output_name(Path(output_path).name, image_format)
+    return {'converted': f"{category}/{img_file}", 'clahe': f"{category}/clahe_{img_file}",
+            'augmented': f"{category}/{img_file}"}
+
+def run_pipeline(jobs, output_dirs, save_converted=False, save_clahe=False, augment=True,
+                 clip_limit=2.0, tile_grid_size=(8, 8), mode='minmax', bit_depth=8,
+                 workers=None, queue_size=4, manifest=None, image_format='png', compression=None,
+                 rois=None, crop_margin=None, stats=None):
+    """
+    Run DICOM -> normalize -> CLAHE -> augmentation with pixels kept in memory.
+
+    Each DICOM is read once; only the enabled outputs are written. With all
+    outputs enabled the file layout matches dicom_converter.py, clahe.py and
+    the augmentation script run one after another.
+
+    Args:
+        jobs: List of (dicom_path, output_path) tuples from dicom_converter.collect_jobs;
+            output_path is <converted dir>/<category>/<filename>.png
+        output_dirs: Dictionary with 'converted', 'clahe' and 'augmented' base paths
+        save_converted: Write normalized images (mass_images layout)
+        save_clahe: Write CLAHE images (mass_images_clahe layout)
+        augment: Write rotated/flipped variants (augmented_dataset layout)
+        clip_limit, tile_grid_size: CLAHE parameters
+        mode, bit_depth: Normalization parameters, see dicom_converter.normalize_dicom
+        workers: Workers per stage (int or [read, enhance, write])
+        queue_size: Maximum number of images waiting between stages
+        manifest: Optional Manifest based in the common parent of output_dirs;
+            DICOMs whose outputs are up to date are skipped
+        image_format, compression: Output file format and compression level, see image_io.encode_image
+        rois, crop_margin: Crop to the breast region, see dicom_converter.convert_dicom_files
+        stats: Optional dictionary of DatasetStats keyed like output_dirs; pixel statistics of
+            the written images are recorded under the keys of the standalone scripts
+
+    Returns:
+        List of booleans in the same order as jobs, True if all outputs were written
+    """
+    def decode(job):
+        dicom_path, output_path, input_hash, roi = job
+        return Path(output_path), input_hash, roi, read_dicom(dicom_path)
+
+    def enhance(task):
+        output_path, input_hash, roi, dicom_data = task
+        if crop_margin is not None and roi is None:
+            roi = breast_bbox(dicom_data.pixel_array, crop_margin)
+        orig_img = normalize_dicom(dicom_data, mode, bit_depth, roi)
+        clahe_img = apply_clahe(orig_img, clip_limit, tile_grid_size) if (save_clahe or augment) else None
+        return output_path, input_hash, orig_img, clahe_img
+
+    def write(task):
+        output_path, input_hash, orig_img, clahe_img = task
+        category, img_file = output_path.parent.name, output_name(output_path.name, image_format)
+        outputs = []
+        keys = stats_keys(output_path, image_format)
+
+        def write_file(path, image):
+            write_image(path, image, image_format, compression)
+            outputs.append(path)
+
+        if save_converted:
+            write_file(output_dirs['converted'] / category / img_file, orig_img)
+            if stats is not None:
+                stats['converted'].record(keys['converted'], category, PixelStats.from_image(orig_img))
+        if save_clahe:
+            write_file(output_dirs['clahe'] / category / f"clahe_{img_file}", clahe_img)
+            if stats is not None:
+                stats['clahe'].record(keys['clahe'], category, PixelStats.from_image(clahe_img))
+        if augment:
+            augmented_dir = output_dirs['augmented'] / category
+            # Отражения только переставляют пиксели: статистика считается один раз на (источник, угол)
+            pair_stats = PixelStats()
+            variants = {}
+
+            def write_variant(name, image, meta):
+                write_file(augmented_dir / name, image)
+                if stats is None:
+                    return
+                variant = (meta['source'], meta['angle']) if meta['angle'] is not None else None
+                pixels = variants.get(variant) if variant is not None else None
+                if pixels is None:
+                    pixels = PixelStats.from_image(image)
+                    if variant is not None:
+                        variants[variant] = pixels
+                pair_stats.merge(pixels)
+
+            variant_outputs = augmentation.augment_image_pair(orig_img, clahe_img, img_file, str(augmented_dir),
+                                                              writer=write_variant)
+            if stats is not None:
+                stats['augmented'].record(keys['augmented'], category, pair_stats, len(variant_outputs))
+
+        if manifest is not None:
+            manifest.record(f"{category}/{output_path.name}", input_hash,
+                            [os.path.relpath(output, manifest.base_path) for output in outputs])
+
+    results = [False] * len(jobs)
+    
+    # Пропускаем DICOM, для которых все выходы актуальны
+    pending = []
+    pending_idx = []
+    for idx, (dicom_path, output_path) in enumerate(jobs):
+        roi = rois[idx] if crop_margin is not None and rois is not None else None
+        input_hash = manifest.input_hash(dicom_path) if manifest is not None else None
+        if input_hash is not None and roi is not None:
+            input_hash = combine_hashes(input_hash, json.dumps(roi, sort_keys=True))
+        key = f"{Path(output_path).parent.name}/{Path(output_path).name}"
+        keys = stats_keys(output_path, image_format)
+        if (manifest is not None and manifest.is_current(key, input_hash)
+                and all(keys[name] in dataset_stats for name, dataset_stats in (stats or {}).items())):
+            results[idx] = True
+            continue
+        pending.append((dicom_path, output_path, input_hash, roi))
+        pending_idx.append(idx)
+    if manifest is not None and len(pending) < len(jobs):
+        print(f"Skipping {len(jobs) - len(pending)} up-to-date images")
+    
+    for i, _, error in run_stages(pending, [decode, enhance, write], workers, queue_size):
+        idx = pending_idx[i]
+        if error is None:
+            results[idx] = True
+        else:
+            print(f"Error processing {jobs[idx][0]}: {str(error)}")
+    return results
+
+def main(save_converted=False, save_clahe=False, augment=True, workers=None, queue_size=4,
+         mode='minmax', bit_depth=8, force=False, shard_index=0, shard_count=1, image_format='png',
+         compression=None, crop_margin=None):
+    check_shard(shard_index, shard_count)
+    current_dir = Path.cwd()
+    dicom_dir = current_dir / 'ALL-IMGS'
+    annotations_path = default_annotations_path(current_dir / 'annotations')
+    output_dirs = {key: current_dir / name for key, name in OUTPUT_DIRS.items()}
+    enabled = {'converted': save_converted, 'clahe': save_clahe, 'augmented': augment}
+
+    print("Loading annotations...")
+    selected_annotations = select_cases(load_annotations(annotations_path))
+    # Выбор не зависит от шардов: сначала выбираем, потом берем свою часть
+    selected_annotations = [ann for ann in selected_annotations
+                            if in_shard(ann['filename'], shard_index, shard_count)]
+
+    # Создаем директории только для включенных выходов
+    for key, base in output_dirs.items():
+        if enabled[key]:
+            for category in EXPECTED_COUNTS:
+                (base / category).mkdir(parents=True, exist_ok=True)
+
+    dicom_index = load_dicom_index(dicom_dir)
+    successful = defaultdict(int)
+    failed = []
+    jobs, job_anns = collect_jobs(selected_annotations, dicom_index, output_dirs['converted'], failed)
+
+    # Параметры включают набор выходов: при его изменении все пересчитывается
+    params = {'outputs': enabled, 'mode': mode, 'bit_depth': bit_depth, 'clip_limit': 2.0,
+              'tile_grid_size': (8, 8), 'rotation_angles': augmentation.ROTATION_ANGLES,
+              'jitter_step': augmentation.JITTER_STEP, 'format': image_format, 'compression': compression}
+    if crop_margin is not None:
+        params['crop_margin'] = crop_margin
+    version = code_version(__file__, dicom_converter.__file__, clahe.__file__, augmentation.__file__)
+    manifest = Manifest(current_dir, params, version,
+                        name=shard_name('.pipeline_manifest.json', shard_index, shard_count),
+                        fallback='.pipeline_manifest.json')
+    # Статистика пикселей рядом с выходами, как у отдельных скриптов (у шарда свой файл)
+    stats = {key: DatasetStats(base, shard_name(STATS_NAME, shard_index, shard_count), fallback=STATS_NAME)
+             for key, base in output_dirs.items() if enabled[key]}
+    if force:
+        manifest.entries = {}
+        for dataset_stats in stats.values():
+            dataset_stats.entries = {}
+
+    print(f"\nProcessing {len(jobs)} DICOM files...")
+    results = run_pipeline(jobs, output_dirs, save_converted, save_clahe, augment,
+                           mode=mode, bit_depth=bit_depth, workers=workers, queue_size=queue_size,
+                           manifest=manifest, image_format=image_format, compression=compression,
+                           rois=[ann['image'].get('roi') for ann in job_anns], crop_margin=crop_margin,
+                           stats=stats)
+    manifest.close()
+    for key, dataset_stats in stats.items():
+        if shard_count <= 1:
+            # Убираем статистику изображений, которые больше не отбираются
+            dataset_stats.prune(stats_keys(output_path, image_format)[key] for _, output_path in jobs)
+        dataset_stats.close()
+    for ann, done in zip(job_anns, results):
+        if done:
+            successful[ann['classification']['category']] += 1
+        else:
+            failed.append((ann['filename'], "Processing failed"))
+    sort_failures(failed, selected_annotations)
+
+    print_summary(successful, failed)
+    if shard_count > 1:
+        write_shard_report(current_dir, 'pipeline', shard_index, shard_count, successful, failed)
+        print(f"\nShard {shard_index} of {shard_count} done; after all shards run: python sharding.py pipeline .")
+
+    for key, base in output_dirs.items():
+        if enabled[key]:
+            print(f"\nImages are saved in: {base}")
+            print(f"Pixel statistics are saved in: {stats[key].path}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fused DICOM -> normalize -> CLAHE -> augmentation pipeline')
+    parser.add_argument('--save-converted', action='store_true',
+                        help='Also write normalized images to mass_images/')
+    parser.add_argument('--save-clahe', action='store_true',
+                        help='Also write CLAHE images to mass_images_clahe/')
+    parser.add_argument('--no-augment', action='store_true',
+                        help='Skip rotation/flip augmentation (augmented_dataset/)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker threads per stage (default: CPU count)')
+    parser.add_argument('--queue-size', type=int, default=4,
+                        help='Maximum number of images waiting between stages')
+    parser.add_argument('--mode', choices=NORMALIZE_MODES, default='minmax',
+                        help='Intensity normalization: min-max stretch or DICOM VOI window/LUT')
+    parser.add_argument('--bit-depth', type=int, choices=(8, 16), default=8,
+                        help='Output bit depth')
+    parser.add_argument('--force', action='store_true',
+                        help='Reprocess all images, ignoring the manifest of up-to-date outputs')
+    parser.add_argument('--format', choices=IMAGE_FORMATS, default='png', help='Image file format')
+    parser.add_argument('--compression', type=int, default=None,
+                        help='PNG zlib level 0-9 (default: OpenCV default); for TIFF 0 disables LZW')
+    parser.add_argument('--crop', action='store_true',
+                        help='Crop images to the breast region (image.roi from the annotations)')
+    parser.add_argument('--crop-margin', type=int, default=DEFAULT_MARGIN,
+                        help='Margin for breast regions not stored in the annotations')
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    main(save_converted=args.save_converted, save_clahe=args.save_clahe, augment=not args.no_augment,
+         workers=args.workers, queue_size=args.queue_size, mode=args.mode, bit_depth=args.bit_depth,
+         force=args.force, shard_index=args.shard_index, shard_count=args.shard_count,
+         image_format=args.format, compression=args.compression,
+         crop_margin=args.crop_margin if args.crop else None)
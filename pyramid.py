@@ -0,0 +1,170 @@
+import os
+from pathlib import Path
+
+import cv2
+
+from image_io import READ_EXTENSIONS, find_image, read_image, write_image, output_name
+
+# Уровни пирамиды внутри выходной директории этапа: <base>/.pyramid/<size>/<category>/<file>
+# (скрытая директория, этапы ее пропускают при обходе категорий)
+PYRAMID_DIR = '.pyramid'
+
+def add_pyramid_arguments(parser):
+    """Adds --pyramid option to an argparse parser"""
+    parser.add_argument('--pyramid', type=int, nargs='+', default=None,
+                        help='Also save reduced copies with these long-side sizes, e.g. 256 512 1024')
+
+def level_shape(shape, size):
+    """Returns (height, width) of an image scaled so that its long side equals size, aspect preserved"""
+    h, w = shape[:2]
+    scale = size / max(h, w)
+    return max(1, round(h * scale)), max(1, round(w * scale))
+
+def build_pyramid(image, sizes):
+    """
+    Downsample image to several long-side sizes with area interpolation.
+
+    Levels are computed from the largest to the smallest, each from the previous
+    one, so every pixel of the full image is read once. Sizes not smaller than
+    the image are skipped (no upsampling).
+
+    Args:
+        image: Grayscale image
+        sizes: Long-side sizes in pixels
+
+    Returns:
+        Dictionary {size: image}
+    """
+    levels = {}
+    source = image
+    for size in sorted(set(sizes), reverse=True):
+        if size >= max(image.shape[:2]):
+            continue
+        h, w = level_shape(image.shape, size)
+        source = levels[size] = cv2.resize(source, (w, h), interpolation=cv2.INTER_AREA)
+    return levels
+
+def level_path(base_path, size, category, name):
+    """Returns path of an image in a pyramid level"""
+    return Path(base_path) / PYRAMID_DIR / str(size) / category / name
+
+def is_pyramid_output(output):
+    """Checks whether a manifest output (relative path) belongs to the pyramid"""
+    return Path(output).parts[:1] == (PYRAMID_DIR,)
+
+def write_pyramid(base_path, category, name, image, sizes, fmt='png', level=None):
+    """
+    Build and save pyramid levels of one image.
+
+    Args:
+        base_path: Output directory of the stage
+        category: Category (subdirectory) of the image
+        name: File name; the extension is replaced with the one of fmt
+        image: Full-size image
+        sizes: Long-side sizes
+        fmt, level: Image format and compression level, see image_io.encode_image
+
+    Returns:
+        Tuple (outputs, bytes written): paths relative to base_path and total size
+    """
+    outputs = []
+    size_written = 0
+    name = output_name(name, fmt)
+    for size, level_img in build_pyramid(image, sizes).items():
+        path = level_path(base_path, size, category, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        size_written += write_image(path, level_img, fmt, level)
+        outputs.append(os.path.relpath(path, base_path))
+    return outputs, size_written
+
+def remove_stale_levels(manifest, key, outputs):
+    """Deletes pyramid files recorded earlier for key that are not in outputs (e.g. after changing sizes)"""
+    for output in manifest.stale_outputs(key, outputs):
+        path = manifest.base_path / output
+        if is_pyramid_output(output) and path.exists():
+            path.unlink()
+            # Пустые директории категории и уровня тоже удаляем
+            for directory in (path.parent, path.parent.parent):
+                try:
+                    directory.rmdir()
+                except OSError:
+                    break
+
+def pyramid_levels(base_path):
+    """Returns sorted list of cached level sizes"""
+    pyramid_dir = Path(base_path) / PYRAMID_DIR
+    if not pyramid_dir.is_dir():
+        return []
+    return sorted(int(d.name) for d in pyramid_dir.iterdir() if d.is_dir() and d.name.isdigit())
+
+class PyramidLoader:
+    """
+    Read images of a stage output at a reduced resolution.
+
+    load(category, name, size) returns the cached level when it exists; otherwise
+    the image is resized (area interpolation) from the smallest larger cached
+    level or, failing that, from the full-size image.
+    """
+
+    def __init__(self, base_path):
+        """
+        Args:
+            base_path: Output directory of the converter or CLAHE stage (e.g. mass_images)
+        """
+        self.base_path = Path(base_path)
+        self.levels = pyramid_levels(base_path)
+
+    def categories(self, size=None):
+        """Returns sorted categories of a level (of the full-size images without size)"""
+        base = self.base_path / PYRAMID_DIR / str(size) if size is not None else self.base_path
+        if not base.is_dir():
+            return []
+        return sorted(d.name for d in base.iterdir() if d.is_dir() and not d.name.startswith('.'))
+
+    def names(self, category, size=None):
+        """Returns sorted image file names of a category in a level (full-size images without size)"""
+        base = self.base_path / PYRAMID_DIR / str(size) if size is not None else self.base_path
+        directory = base / category
+        if not directory.is_dir():
+            return []
+        return sorted(f for f in os.listdir(directory) if f.lower().endswith(READ_EXTENSIONS))
+
+    def load(self, category, name, size=None):
+        """
+        Returns image with long side size (full-size image without size) or None if it is missing.
+        name may have any readable extension.
+        """
+        if size is not None:
+            path = find_image(self.base_path / PYRAMID_DIR / str(size) / category, name)
+            if path is not None:
+                return read_image(path)
+        # Ближайший больший уровень, затем полный размер
+        sources = [self.base_path / PYRAMID_DIR / str(level) / category
+                   for level in self.levels if size is not None and level > size]
+        sources.append(self.base_path / category)
+        for directory in sources:
+            path = find_image(directory, name)
+            if path is None:
+                continue
+            image = read_image(path)
+            if image is None or size is None or size >= max(image.shape[:2]):
+                return image
+            h, w = level_shape(image.shape, size)
+            return cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA)
+        return None
+
+    def iter_level(self, size, categories=None):
+        """
+        Yields (category, name, image) for all images of a level.
+
+        Args:
+            size: Long-side size
+            categories: Optional collection of categories to keep
+        """
+        # Список берем из готового уровня, если он есть, иначе из полноразмерных изображений
+        listed = size if size in self.levels else None
+        for category in self.categories(listed):
+            if categories is not None and category not in categories:
+                continue
+            for name in self.names(category, listed):
+                yield category, name, self.load(category, name, size)
@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+
+# Отступ вокруг найденной области груди, в пикселях исходного снимка
+DEFAULT_MARGIN = 32
+
+# Во сколько раз уменьшать снимок для поиска области (точность bbox - этот шаг)
+DEFAULT_DOWNSAMPLE = 4
+
+def breast_bbox(image, margin=DEFAULT_MARGIN, downsample=DEFAULT_DOWNSAMPLE):
+    """
+    Find the breast region of a mammogram.
+
+    The image is subsampled, stretched to 8 bits and thresholded with Otsu's
+    method; the bounding box of the largest connected component is expanded
+    by margin and clipped to the image.
+
+    Args:
+        image: Grayscale image (raw DICOM pixels or normalized, any integer or float dtype)
+        margin: Pixels added on every side of the region
+        downsample: Subsampling step for the search
+
+    Returns:
+        Dictionary with x, y, width, height of the region; the whole image if no region is found
+    """
+    h, w = image.shape[:2]
+    full = {'x': 0, 'y': 0, 'width': int(w), 'height': int(h)}
+    small = np.asarray(image[::downsample, ::downsample], dtype=np.float32)
+    low, high = float(small.min()), float(small.max())
+    if high <= low:
+        return full
+    small = ((small - low) * (255.0 / (high - low))).astype(np.uint8)
+
+    _, mask = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    if n < 2:
+        return full
+    # Компонента 0 - фон, берем самую большую из остальных
+    largest = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+    x, y, bw, bh = (int(v) for v in stats[largest, :4])
+
+    x0 = max(0, x * downsample - margin)
+    y0 = max(0, y * downsample - margin)
+    x1 = min(w, (x + bw) * downsample + margin)
+    y1 = min(h, (y + bh) * downsample + margin)
+    return {'x': x0, 'y': y0, 'width': x1 - x0, 'height': y1 - y0}
+
+def crop(image, roi):
+    """Returns view of image cropped to roi (no copy)"""
+    if roi is None:
+        return image
+    return image[roi['y']:roi['y'] + roi['height'], roi['x']:roi['x'] + roi['width']]
+
+def to_original(points, roi):
+    """
+    Map (x, y) coordinates in a cropped image back to the full image.
+
+    Args:
+        points: Array-like of shape (N, 2)
+        roi: Region used for cropping (annotation['image']['roi'])
+
+    Returns:
+        float array (N, 2)
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if roi is None:
+        return points
+    return points + (roi['x'], roi['y'])
+
+def to_cropped(points, roi):
+    """Map (x, y) coordinates in the full image to the cropped image"""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if roi is None:
+        return points
+    return points - (roi['x'], roi['y'])
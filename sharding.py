@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import hashlib
+import argparse
+from pathlib import Path
+from collections import Counter
+
+import numpy as np
+
+from array_store import ArrayStore, is_array_store
+from manifest import MANIFEST_NAME, merge_manifests
+from pyramid import is_pyramid_output
+from stats import STATS_NAME, merge_stats
+
+SHARDS_DIR = '.shards'  # отчеты шардов внутри выходной директории этапа
+STAGES = ('converter', 'clahe', 'augment', 'pipeline')
+
+def check_shard(shard_index, shard_count):
+    """Validates shard arguments"""
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard {shard_index} of {shard_count}")
+
+def add_shard_arguments(parser):
+    """Adds --shard-index/--shard-count options to an argparse parser"""
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='Index of this shard (0-based), see --shard-count')
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='Split the images between this many processes/nodes by filename hash')
+
+def shard_key(name):
+    """Returns the name used for shard assignment: image id without extension and clahe_ prefix"""
+    stem = Path(name).stem
+    return stem[len('clahe_'):] if stem.startswith('clahe_') else stem
+
+def shard_of(name, shard_count):
+    """Returns shard index of an image; depends only on the file name, so every stage and node agrees"""
+    digest = hashlib.blake2b(shard_key(name).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+def in_shard(name, shard_index=0, shard_count=1):
+    """Checks whether image belongs to the shard"""
+    return shard_count <= 1 or shard_of(name, shard_count) == shard_index
+
+def shard_suffix(shard_index, shard_count):
+    return f"shard{shard_index}-of-{shard_count}"
+
+def shard_name(name, shard_index=0, shard_count=1):
+    """Returns per-shard file name, e.g. .manifest.json -> .manifest.shard0-of-4.json (unchanged without sharding)"""
+    if shard_count <= 1:
+        return name
+    path = Path(name)
+    return f"{path.stem}.{shard_suffix(shard_index, shard_count)}{path.suffix}"
+
+def owns_key(path, key):
+    """
+    Checks whether a per-shard file (name with shard<i>-of-<n>) owns an output key <category>/<name>.
+    Files without a shard suffix own every key.
+    """
+    match = re.search(r'shard(\d+)-of-(\d+)', Path(path).name)
+    if match is None:
+        return True
+    return in_shard(Path(key).name, int(match.group(1)), int(match.group(2)))
+
+def shard_store_path(base_path, shard_index=0, shard_count=1):
+    """Returns array store directory for a shard: <base>/shard<i>-of-<n> (base itself without sharding)"""
+    if shard_count <= 1:
+        return Path(base_path)
+    return Path(base_path) / shard_suffix(shard_index, shard_count)
+
+def store_exists(store, base_path):
+    """
+    Returns exists(key) for Manifest.is_current with outputs in an array store.
+
+    Pyramid levels are files in base_path, other outputs are <category>/<name> keys of the store.
+    A shard store is also checked against the merged store at base_path: merge_shards moves
+    the images of earlier sharded runs there and removes the shard stores.
+    """
+    base_path = Path(base_path)
+    merged = None
+    if store.base_path != base_path and is_array_store(base_path):
+        merged = ArrayStore(base_path)
+
+    def exists(key):
+        if is_pyramid_output(key):
+            return (base_path / key).exists()
+        key = tuple(key.split('/', 1))
+        return key in store or (merged is not None and key in merged)
+    return exists
+
+def write_shard_report(base_path, stage, shard_index, shard_count, successful, failed):
+    """
+    Save results of one shard for the merge step.
+
+    Args:
+        base_path: Output directory of the stage
+        stage: Stage name, see STAGES
+        shard_index, shard_count: Shard of this run
+        successful: {category: number of processed images}
+        failed: List of (filename, reason)
+    """
+    report_dir = Path(base_path) / SHARDS_DIR
+    report_dir.mkdir(parents=True, exist_ok=True)
+    report_path = report_dir / f"{stage}-{shard_suffix(shard_index, shard_count)}.json"
+    tmp_path = f"{report_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({
+            'stage': stage,
+            'shard_index': shard_index,
+            'shard_count': shard_count,
+            'successful': dict(successful),
+            'failed': [list(item) for item in failed]
+        }, f, indent=2, ensure_ascii=False)
+    os.replace(tmp_path, report_path)
+
+def merge_shards(base_path, stage, manifest_name=MANIFEST_NAME, stats_dirs=None):
+    """
+    Combine the per-shard outputs of a stage.
+
+    Sums the per-category counts and concatenates the failure lists from the
+    shard reports, merges per-shard manifests and pixel statistics into those of the stage and copies
+    per-shard array stores into the store at base_path (images already there unchanged are not copied again).
+
+    Args:
+        base_path: Output directory of the stage
+        stage: Stage name, see STAGES
+        manifest_name: Manifest file name of the stage
+        stats_dirs: Directories with per-shard pixel statistics (default: base_path;
+            the pipeline keeps them next to each of its outputs)
+
+    Returns:
+        Tuple (successful, failed, missing): Counter by category, list of (filename, reason)
+        and list of shard indexes without a report
+    """
+    base_path = Path(base_path)
+    reports = []
+    for report_path in sorted((base_path / SHARDS_DIR).glob(f"{stage}-shard*-of-*.json")):
+        with open(report_path, 'r', encoding='utf-8') as f:
+            reports.append(json.load(f))
+    if not reports:
+        raise FileNotFoundError(f"No shard reports for stage {stage} in {base_path / SHARDS_DIR}")
+
+    shard_count = max(report['shard_count'] for report in reports)
+    reports = sorted((report for report in reports if report['shard_count'] == shard_count),
+                     key=lambda report: report['shard_index'])
+    found = {report['shard_index'] for report in reports}
+    missing = [index for index in range(shard_count) if index not in found]
+
+    successful = Counter()
+    failed = []
+    for report in reports:
+        successful.update(report['successful'])
+        failed.extend(tuple(item) for item in report['failed'])
+
+    # Манифесты шардов -> общий манифест, чтобы запуск без шардов видел готовые выходы
+    manifest_path = Path(manifest_name)
+    shard_manifests = sorted(base_path.glob(f"{manifest_path.stem}.shard*-of-*{manifest_path.suffix}"))
+    if shard_manifests:
+        merge_manifests(base_path, shard_manifests, manifest_name, owns_key)
+    # Статистика пикселей шардов объединяется так же
+    stats_path = Path(STATS_NAME)
+    for stats_dir in (stats_dirs or [base_path]):
+        shard_stats = sorted(Path(stats_dir).glob(f"{stats_path.stem}.shard*-of-*{stats_path.suffix}"))
+        if shard_stats:
+            merge_stats(stats_dir, shard_stats, owns=owns_key)
+
+    # Хранилища массивов шардов копируются в общее хранилище
+    # Изображения, уже лежащие в нем без изменений, не дописываются повторно, измененные заменяются
+    shard_stores = sorted(path for path in base_path.glob('shard*-of-*') if is_array_store(path))
+    if shard_stores:
+        with ArrayStore(base_path, mode='a') as store:
+            for shard_path in shard_stores:
+                with ArrayStore(shard_path) as shard_store:
+                    for category in shard_store.categories():
+                        for name, array in shard_store.items(category):
+                            if (category, name) in store and np.array_equal(store.get(category, name), array):
+                                continue
+                            store.put(category, name, array)
+        for shard_path in shard_stores:
+            for path in shard_path.iterdir():
+                path.unlink()
+            shard_path.rmdir()
+
+    return successful, failed, missing
+
+def print_merged_summary(successful, failed):
+    """Print per-category table of processed images and failures for merged shards"""
+    print("\nResults by category:")
+    for category, count in sorted(successful.items()):
+        print(f"{category}: {count}")
+    print(f"Total: {sum(successful.values())}")
+    if failed:
+        print("\nFailed:")
+        for filename, reason in failed:
+            print(f"- {filename}: {reason}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge outputs of a stage run with --shard-index/--shard-count')
+    parser.add_argument('stage', choices=STAGES, help='Stage to merge')
+    parser.add_argument('output', help='Output directory of the stage (current directory for pipeline)')
+    args = parser.parse_args()
+
+    if args.stage == 'pipeline':
+        from pipeline import OUTPUT_DIRS
+        successful, failed, missing = merge_shards(args.output, args.stage, '.pipeline_manifest.json',
+                                                   [Path(args.output) / name for name in OUTPUT_DIRS.values()])
+    else:
+        successful, failed, missing = merge_shards(args.output, args.stage)
+    if missing:
+        print(f"Warning: no report for shards {missing}, results are incomplete")
+    if args.stage in ('converter', 'pipeline'):
+        from dicom_converter import print_summary
+        print_summary(successful, failed)
+    else:
+        print_merged_summary(successful, failed)
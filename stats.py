@@ -0,0 +1,258 @@
+import os
+import json
+import threading
+import cv2
+import numpy as np
+from pathlib import Path
+
+STATS_NAME = '.stats.json'
+STATS_VERSION = 1
+
+# Число корзин гистограммы интенсивности (для 16 бит корзина шириной 256 уровней)
+HIST_BINS = 256
+
+# cv2.calcHist считает в float32: счетчики точны, пока пикселей в изображении меньше 2**24
+EXACT_CALCHIST_PIXELS = 1 << 24
+
+class PixelStats:
+    """
+    Mergeable pixel statistics: count, mean, sum of squared deviations (M2),
+    min, max and an intensity histogram.
+
+    from_image() takes one exact full-resolution histogram of the image and
+    derives everything else from it, so the pixels are read once. merge() combines two accumulators
+    with the parallel form of Welford's algorithm (Chan et al.), so per-image,
+    per-thread or per-shard statistics can be added up in any order.
+    """
+
+    def __init__(self, levels=256, bins=HIST_BINS):
+        """
+        Args:
+            levels: Number of intensity levels (256 for 8-bit, 65536 for 16-bit images)
+            bins: Histogram bins over [0, levels)
+        """
+        self.levels = levels
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.histogram = np.zeros(min(bins, levels), dtype=np.int64)
+
+    @classmethod
+    def from_image(cls, image, bins=HIST_BINS):
+        """Returns statistics of one uint8 or uint16 image"""
+        if image.dtype not in (np.uint8, np.uint16):
+            raise ValueError(f"Unsupported image dtype: {image.dtype}")
+        levels = 256 if image.dtype == np.uint8 else 65536
+        stats = cls(levels, bins)
+        if image.size < EXACT_CALCHIST_PIXELS:
+            # calcHist в несколько раз быстрее bincount и отпускает GIL
+            counts = cv2.calcHist([np.ascontiguousarray(image)], [0], None, [levels], [0, levels])
+            counts = counts.ravel().astype(np.int64)
+        else:
+            counts = np.bincount(np.ravel(image), minlength=levels)
+        n = int(counts.sum())
+        if n == 0:
+            return stats
+        values = np.arange(levels, dtype=np.float64)
+        nonzero = np.flatnonzero(counts)
+        stats.count = n
+        stats.mean = float(counts @ values) / n
+        stats.m2 = float(counts @ (values - stats.mean) ** 2)
+        stats.min, stats.max = int(nonzero[0]), int(nonzero[-1])
+        stats.histogram = counts.reshape(len(stats.histogram), -1).sum(axis=1)
+        return stats
+
+    @property
+    def std(self):
+        """Population standard deviation"""
+        return (self.m2 / self.count) ** 0.5 if self.count else 0.0
+
+    def merge(self, other):
+        """Adds statistics of other to this accumulator; returns self"""
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.levels = other.levels
+            self.histogram = np.zeros_like(other.histogram)
+        elif (other.levels, len(other.histogram)) != (self.levels, len(self.histogram)):
+            raise ValueError("Cannot merge statistics of different bit depths or bin counts")
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        self.m2 += other.m2 + delta * delta * self.count * other.count / n
+        self.mean += delta * other.count / n
+        self.count = n
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self.histogram += other.histogram
+        return self
+
+    def to_dict(self):
+        return {'levels': self.levels, 'count': self.count, 'mean': self.mean, 'm2': self.m2,
+                'min': self.min, 'max': self.max, 'histogram': self.histogram.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls(data['levels'], len(data['histogram']))
+        stats.count = data['count']
+        stats.mean = data['mean']
+        stats.m2 = data['m2']
+        stats.min = data['min']
+        stats.max = data['max']
+        stats.histogram = np.asarray(data['histogram'], dtype=np.int64)
+        return stats
+
+def merge_entries(entries):
+    """Returns {category: (images, PixelStats)} merged from DatasetStats entries"""
+    result = {}
+    for entry in entries:
+        images, pixels = result.get(entry['category'], (0, PixelStats()))
+        result[entry['category']] = (images + entry['images'], pixels.merge(PixelStats.from_dict(entry['pixels'])))
+    return dict(sorted(result.items()))
+
+def summarize(entries):
+    """Returns per-category summary of DatasetStats entries: images, pixels, mean, std, min, max, histogram"""
+    return {category: {'images': images, 'pixels': pixels.count, 'mean': pixels.mean, 'std': pixels.std,
+                       'min': pixels.min, 'max': pixels.max, 'levels': pixels.levels,
+                       'histogram': pixels.histogram.tolist()}
+            for category, (images, pixels) in merge_entries(entries).items()}
+
+class DatasetStats:
+    """
+    Statistics of a stage output, kept per output key and summed per category.
+
+    Entries are recorded by the stage while it holds the pixels, next to its
+    manifest records, so skipped up-to-date images keep their earlier entries and
+    no extra pass over the images is needed. Saved to <base_path>/<name> every
+    save_every records and on close(); the file also holds the per-category
+    summary read by distribution.py and count.py.
+    """
+
+    def __init__(self, base_path, name=STATS_NAME, save_every=20, fallback=None):
+        """
+        Args:
+            base_path: Output directory of the stage
+            name: Statistics file name
+            save_every: Save after this many new records
+            fallback: File to start from when <name> does not exist yet (a shard starts from the merged file)
+        """
+        self.base_path = Path(base_path)
+        self.path = self.base_path / name
+        self.save_every = save_every
+        self._lock = threading.Lock()
+        self._unsaved = 0
+
+        path = self.path
+        if fallback and not path.exists():
+            path = self.base_path / fallback
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != STATS_VERSION:
+                raise ValueError("Unsupported statistics version")
+            self.entries = data['entries']
+        except (OSError, ValueError, KeyError):
+            self.entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.entries
+
+    def record(self, key, category, pixels, images=1):
+        """
+        Record statistics of an output key (replacing earlier ones).
+
+        Args:
+            key: Output key, as in the manifest
+            category: Category of the images
+            pixels: PixelStats of all images of the key
+            images: Number of images of the key
+        """
+        with self._lock:
+            self.entries[key] = {'category': category, 'images': images, 'pixels': pixels.to_dict()}
+            self._unsaved += 1
+            if self._unsaved >= self.save_every:
+                self._save()
+
+    def prune(self, keys):
+        """Removes entries not in keys (outputs no longer produced)"""
+        keys = set(keys)
+        with self._lock:
+            for key in [key for key in self.entries if key not in keys]:
+                del self.entries[key]
+
+    def categories(self):
+        """Returns {category: (images, PixelStats)} merged from the entries"""
+        with self._lock:
+            return merge_entries(self.entries.values())
+
+    def summary(self):
+        """Returns per-category summary: images, pixels, mean, std, min, max, histogram"""
+        with self._lock:
+            return summarize(self.entries.values())
+
+    def _save(self, final=False):
+        self.base_path.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(f"{self.path.name}.tmp")
+        data = {'version': STATS_VERSION, 'entries': self.entries}
+        if final:
+            # Сводка по категориям только при закрытии, промежуточные сохранения - для продолжения после сбоя
+            data['categories'] = summarize(self.entries.values())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+        self._unsaved = 0
+
+    def close(self):
+        """Save the statistics with the per-category summary"""
+        with self._lock:
+            self._save(final=True)
+
+def merge_stats(base_path, paths, name=STATS_NAME, owns=None):
+    """
+    Merge entries of several statistics files (e.g. one per shard) into <base_path>/<name> and remove them.
+    owns(path, key): optional check that the file at path owns the key, see manifest.merge_manifests
+    """
+    target = DatasetStats(base_path, name)
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            entries = json.load(f).get('entries', {})
+        target.entries.update((key, entry) for key, entry in entries.items()
+                              if owns is None or owns(path, key))
+    target.close()
+    for path in paths:
+        os.remove(path)
+
+def load_summary(path):
+    """
+    Returns per-category summary from a statistics file, or None if it does not exist.
+
+    Args:
+        path: Statistics file or the stage output directory containing it
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / STATS_NAME
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except OSError:
+        return None
+    if 'categories' not in data:
+        # Файл прерванного запуска, сводки еще нет
+        return summarize(data.get('entries', {}).values())
+    return data['categories']
+
+def print_stats(summary):
+    """Print per-category image counts and pixel mean/std of a summary"""
+    print("\nPixel statistics:")
+    for category, item in summary.items():
+        print(f"{category}: {item['images']} images, mean {item['mean']:.2f}, std {item['std']:.2f}, "
+              f"range {item['min']}-{item['max']}")
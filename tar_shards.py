@@ -0,0 +1,175 @@
+import io
+import json
+import random
+import tarfile
+import threading
+from pathlib import Path
+from collections import Counter
+
+import cv2
+import numpy as np
+
+INDEX_SUFFIX = '.json'  # индекс шарда: <name>.tar.json рядом с <name>.tar
+
+class TarShardWriter:
+    """
+    Writes samples into fixed-size tar shards (WebDataset layout).
+
+    Each sample is a pair of members with the same key: <key>.png (the image)
+    and <key>.json (its metadata). A new shard is started when the current one
+    reaches max_samples or max_bytes. When a shard is closed, its index with
+    every sample's metadata and data offset is saved as <shard>.tar.json, so
+    tallies and random access do not need to read the tar. Writing is thread-safe.
+    """
+
+    def __init__(self, output_dir, prefix='augmented', max_samples=10000, max_bytes=1 << 30):
+        """
+        Args:
+            output_dir: Directory for shards
+            prefix: Shard name prefix, shards are <prefix>-000000.tar, <prefix>-000001.tar, ...
+            max_samples: Maximum samples per shard
+            max_bytes: Approximate maximum shard size in bytes
+        """
+        self.output_dir = Path(output_dir)
+        self.prefix = prefix
+        self.max_samples = max_samples
+        self.max_bytes = max_bytes
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._tar = None
+        self._shard_idx = 0
+        self._samples = []
+        self._bytes = 0
+
+        # Шарды прежнего запуска с тем же префиксом заменяются
+        for path in self.output_dir.glob(f"{prefix}-[0-9]*.tar*"):
+            path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open_shard(self):
+        self._path = self.output_dir / f"{self.prefix}-{self._shard_idx:06d}.tar"
+        self._tar = tarfile.open(self._path, 'w', format=tarfile.PAX_FORMAT)
+        self._samples = []
+        self._bytes = 0
+
+    def _add_member(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        self._bytes += len(data)
+
+    def write(self, key, image, meta=None):
+        """
+        Add one sample.
+
+        Args:
+            key: Sample key, e.g. Density1+Benign/rotation_30_orig_22678622
+            image: Image array, stored as PNG
+            meta: JSON-serializable metadata (category, source, angle, flip, ...)
+
+        Returns:
+            Number of data bytes added (image and metadata)
+        """
+        ok, png = cv2.imencode('.png', image)
+        if not ok:
+            raise IOError(f"Error encoding image {key}")
+        meta_bytes = json.dumps(meta or {}, ensure_ascii=False).encode('utf-8')
+        with self._lock:
+            if self._tar is None:
+                self._open_shard()
+            self._add_member(f"{key}.png", png.tobytes())
+            self._add_member(f"{key}.json", meta_bytes)
+            self._samples.append({'key': key, **(meta or {})})
+            if len(self._samples) >= self.max_samples or self._bytes >= self.max_bytes:
+                self._close_shard()
+        return len(png) + len(meta_bytes)
+
+    def _close_shard(self):
+        self._tar.close()
+        self._tar = None
+        # Смещения данных берем из заголовков готового архива
+        with tarfile.open(self._path, 'r') as tar:
+            offsets = {member.name: (member.offset_data, member.size) for member in tar}
+        for sample in self._samples:
+            sample['offset'], sample['size'] = offsets[f"{sample['key']}.png"]
+        index = {'shard': self._path.name, 'samples': self._samples}
+        with open(f"{self._path}{INDEX_SUFFIX}", 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        self._shard_idx += 1
+
+    def close(self):
+        """Finish the current shard"""
+        with self._lock:
+            if self._tar is not None:
+                self._close_shard()
+
+def shard_paths(shard_dir):
+    """Returns sorted list of finished (indexed) tar shards in directory"""
+    return sorted(path for path in Path(shard_dir).glob('*.tar') if Path(f"{path}{INDEX_SUFFIX}").exists())
+
+def is_tar_shard_dir(path):
+    """Checks whether path contains indexed tar shards"""
+    return Path(path).is_dir() and any(Path(path).glob(f"*.tar{INDEX_SUFFIX}"))
+
+def read_index(shard_dir):
+    """Yields (shard path, sample entry) for all samples from the shard indexes"""
+    for path in shard_paths(shard_dir):
+        with open(f"{path}{INDEX_SUFFIX}", 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        for sample in index['samples']:
+            yield path, sample
+
+def category_counts(shard_dir):
+    """Returns Counter of samples per category, from the indexes only"""
+    return Counter(sample['category'] for _, sample in read_index(shard_dir))
+
+def source_counts(shard_dir):
+    """Returns Counter of distinct source images per category, from the indexes only"""
+    sources = {(sample['category'], sample['image']) for _, sample in read_index(shard_dir)}
+    return Counter(category for category, _ in sources)
+
+def load_sample(shard_path, sample):
+    """Random access: reads one image using the offset from the shard index"""
+    with open(shard_path, 'rb') as f:
+        f.seek(sample['offset'])
+        data = f.read(sample['size'])
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH)
+
+def iter_samples(shard_dir, shuffle_shards=False, seed=None, categories=None):
+    """
+    Stream samples for training, reading every shard sequentially.
+
+    Args:
+        shard_dir: Directory with tar shards
+        shuffle_shards: Visit shards in random order (samples inside a shard keep their order)
+        seed: Seed for the shard order
+        categories: Optional collection of categories to keep
+
+    Yields:
+        (image, meta) tuples; meta contains key, category, source, angle, flip, ...
+    """
+    paths = shard_paths(shard_dir)
+    if shuffle_shards:
+        random.Random(seed).shuffle(paths)
+    for path in paths:
+        pending = {}
+        # Потоковое чтение: без перемещений по файлу, подходит для сетевой ФС
+        with tarfile.open(path, 'r|') as tar:
+            for member in tar:
+                key, ext = member.name.rsplit('.', 1)
+                pending.setdefault(key, {})[ext] = tar.extractfile(member).read()
+                sample = pending[key]
+                if 'png' not in sample or 'json' not in sample:
+                    continue
+                del pending[key]
+                meta = {'key': key, **json.loads(sample['json'])}
+                if categories is not None and meta.get('category') not in categories:
+                    continue
+                image = cv2.imdecode(np.frombuffer(sample['png'], np.uint8),
+                                     cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH)
+                yield image, meta
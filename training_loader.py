@@ -0,0 +1,396 @@
+import os
+import time
+import queue
+import argparse
+import multiprocessing as mp
+from pathlib import Path
+from collections import Counter
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from image_io import READ_EXTENSIONS, read_image
+from tar_shards import is_tar_shard_dir, read_index, load_sample
+
+class FolderSource:
+    """Samples of an augmented_dataset-style folder: <base>/<category>/<image>"""
+
+    def __init__(self, base_path):
+        self.base_path = Path(base_path)
+        self.items = []
+        for category in sorted(os.listdir(base_path)):
+            category_dir = self.base_path / category
+            if category_dir.is_dir() and not category.startswith('.'):
+                self.items.extend((category, category_dir / f) for f in sorted(os.listdir(category_dir))
+                                  if f.lower().endswith(READ_EXTENSIONS))
+
+    def __len__(self):
+        return len(self.items)
+
+    def category(self, idx):
+        return self.items[idx][0]
+
+    def load(self, idx):
+        image = read_image(self.items[idx][1])
+        if image is None:
+            raise IOError(f"Error reading image: {self.items[idx][1]}")
+        return image
+
+class TarSource:
+    """Samples of tar shards (augmented_shards), read by offset from the shard indexes"""
+
+    def __init__(self, shard_dir):
+        self.items = list(read_index(shard_dir))
+
+    def __len__(self):
+        return len(self.items)
+
+    def category(self, idx):
+        return self.items[idx][1]['category']
+
+    def load(self, idx):
+        return load_sample(*self.items[idx])
+
+class VirtualSource:
+    """Samples generated on the fly from the source images (virtual_dataset.VirtualAugmentedDataset)"""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def category(self, idx):
+        return self.dataset.locate(idx)[0]
+
+    def load(self, idx):
+        return self.dataset[idx][0]
+
+def open_source(path):
+    """Returns FolderSource or TarSource for a directory"""
+    return TarSource(path) if is_tar_shard_dir(path) else FolderSource(path)
+
+def fit_image(image, size):
+    """
+    Resize image to fit into size (height, width) keeping the aspect ratio, zero-padded and centered.
+    Area interpolation for downscaling.
+    """
+    height, width = size
+    h, w = image.shape[:2]
+    scale = min(height / h, width / w)
+    new_h, new_w = max(1, round(h * scale)), max(1, round(w * scale))
+    if (new_h, new_w) != (h, w):
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        image = cv2.resize(image, (new_w, new_h), interpolation=interpolation)
+    top, left = (height - new_h) // 2, (width - new_w) // 2
+    return cv2.copyMakeBorder(image, top, height - new_h - top, left, width - new_w - left,
+                              cv2.BORDER_CONSTANT, value=0)
+
+class StratifiedSampler:
+    """
+    Batches with categories drawn uniformly (or with given weights), not by their frequency.
+
+    Within a category, samples are taken from a reshuffled permutation, so every
+    sample of a small category (e.g. Density4+Malignant with a single source case)
+    is seen before any repeats. Batches depend only on the seed and the epoch.
+    """
+
+    def __init__(self, categories, batch_size, seed=0, weights=None, num_samples=None):
+        """
+        Args:
+            categories: Category of every sample (list indexed like the dataset)
+            batch_size: Samples per batch
+            seed: Base seed
+            weights: Optional {category: weight}; default: equal weight for all categories
+            num_samples: Samples per epoch (default: dataset size)
+        """
+        self.batch_size = batch_size
+        self.seed = seed
+        self.by_category = {}
+        for idx, category in enumerate(categories):
+            self.by_category.setdefault(category, []).append(idx)
+        self.categories = sorted(self.by_category)
+        weights = weights or {}
+        p = np.array([weights.get(category, 1.0) for category in self.categories], dtype=np.float64)
+        self.p = p / p.sum()
+        self.num_samples = num_samples or len(categories)
+
+    def __len__(self):
+        return -(-self.num_samples // self.batch_size)
+
+    def batches(self, epoch=0):
+        """Yields lists of sample indices for one epoch"""
+        rng = np.random.default_rng((self.seed, epoch))
+        pools = {category: [] for category in self.categories}
+        picks = rng.choice(len(self.categories), size=self.num_samples, p=self.p)
+        batch = []
+        for pick in picks:
+            category = self.categories[pick]
+            if not pools[category]:
+                pools[category] = list(rng.permutation(self.by_category[category]))
+            batch.append(int(pools[category].pop()))
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+class RandomSampler:
+    """Plain shuffled (or sequential) batches over all samples"""
+
+    def __init__(self, size, batch_size, seed=0, shuffle=True):
+        self.size = size
+        self.batch_size = batch_size
+        self.seed = seed
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return -(-self.size // self.batch_size)
+
+    def batches(self, epoch=0):
+        order = (np.random.default_rng((self.seed, epoch)).permutation(self.size) if self.shuffle
+                 else np.arange(self.size))
+        for start in range(0, self.size, self.batch_size):
+            yield [int(idx) for idx in order[start:start + self.batch_size]]
+
+def _fill_batch(source, indices, images, labels, category_ids, image_size, augment, seed):
+    """Loads samples into the batch arrays; returns number of samples"""
+    for k, idx in enumerate(indices):
+        image = source.load(idx)
+        if image.dtype == np.uint16:
+            image = (image >> 8).astype(np.uint8)  # 16 бит -> 8 бит
+        images[k] = fit_image(image, image_size)
+        labels[k] = category_ids[source.category(idx)]
+    if augment:
+        from data_augmentation import augment_batch
+        images[:len(indices)], _ = augment_batch(images[:len(indices)], seed=seed, indices=indices,
+                                                 pad_divisor=None)
+    return len(indices)
+
+def _worker_loop(source, slots, category_ids, image_size, augment, seed, tasks, results):
+    """Worker process: fills shared-memory slots with the batches it is given"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_idx, slot, indices, epoch = task
+        images, labels = slots[slot]
+        try:
+            n = _fill_batch(source, indices, images, labels, category_ids, image_size, augment,
+                            seed + epoch)
+            results.put((batch_idx, slot, n, None))
+        except Exception as e:
+            results.put((batch_idx, slot, 0, f"{type(e).__name__}: {e}"))
+
+class TrainingLoader:
+    """
+    Multi-process batch loader for the augmented dataset.
+
+    Worker processes decode and resize images straight into shared-memory batch
+    buffers (no pickling of pixel data). At most prefetch batches are in flight,
+    which bounds memory. Batches come out in sampler order.
+
+    Yielded arrays are views into a shared buffer that is reused after the next
+    batch is requested; copy them to keep them longer (or use copy=True).
+    """
+
+    def __init__(self, source, batch_size=32, image_size=(512, 512), workers=4, prefetch=None,
+                 stratified=True, seed=0, augment=False, copy=False, weights=None, num_samples=None):
+        """
+        Args:
+            source: Path (augmented_dataset folder or tar shard directory) or a source object
+                (FolderSource, TarSource, VirtualSource)
+            batch_size: Samples per batch
+            image_size: Output (height, width); images are resized with aspect kept and zero-padded
+            workers: Worker processes (0 loads in the calling process)
+            prefetch: Maximum batches loaded ahead (default: 2 per worker)
+            stratified: Draw categories uniformly with StratifiedSampler, otherwise shuffle all samples
+            seed: Seed for sampling and augmentation
+            augment: Apply data_augmentation.augment_batch to every batch in the workers
+            copy: Yield copies instead of views into the shared buffers
+            weights, num_samples: StratifiedSampler parameters
+        """
+        self.source = open_source(source) if isinstance(source, (str, Path)) else source
+        self.batch_size = batch_size
+        self.image_size = tuple(image_size)
+        self.workers = workers
+        self.prefetch = prefetch or max(2, 2 * workers)
+        self.seed = seed
+        self.augment = augment
+        self.copy = copy
+        self.epoch = 0
+
+        sample_categories = [self.source.category(idx) for idx in range(len(self.source))]
+        self.categories = sorted(set(sample_categories))
+        self.category_ids = {category: i for i, category in enumerate(self.categories)}
+        self.sampler = (StratifiedSampler(sample_categories, batch_size, seed, weights, num_samples)
+                        if stratified else RandomSampler(len(self.source), batch_size, seed))
+
+        self._pool = None
+        self._slots = None
+        self._shm = None
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _start(self):
+        """Creates shared buffers and starts the worker processes (once)"""
+        height, width = self.image_size
+        image_bytes = self.batch_size * height * width
+        label_bytes = self.batch_size * np.dtype(np.int64).itemsize
+        self._shm = shared_memory.SharedMemory(create=True, size=self.prefetch * (image_bytes + label_bytes))
+        self._slots = []
+        for slot in range(self.prefetch):
+            offset = slot * (image_bytes + label_bytes)
+            images = np.ndarray((self.batch_size, height, width), np.uint8, self._shm.buf, offset)
+            labels = np.ndarray((self.batch_size,), np.int64, self._shm.buf, offset + image_bytes)
+            self._slots.append((images, labels))
+
+        # fork: воркеры наследуют отображение общей памяти и объект источника без сериализации
+        context = mp.get_context('fork')
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._pool = [context.Process(target=_worker_loop, daemon=True,
+                                      args=(self.source, self._slots, self.category_ids, self.image_size,
+                                            self.augment, self.seed, self._tasks, self._results))
+                      for _ in range(self.workers)]
+        for process in self._pool:
+            process.start()
+
+    def _iter_local(self, epoch):
+        height, width = self.image_size
+        images = np.zeros((self.batch_size, height, width), np.uint8)
+        labels = np.zeros(self.batch_size, np.int64)
+        for indices in self.sampler.batches(epoch):
+            n = _fill_batch(self.source, indices, images, labels, self.category_ids, self.image_size,
+                            self.augment, self.seed + epoch)
+            yield (images[:n].copy(), labels[:n].copy()) if self.copy else (images[:n], labels[:n])
+
+    def _iter_workers(self, epoch):
+        if self._pool is None:
+            self._start()
+        batches = self.sampler.batches(epoch)
+        free = list(range(self.prefetch))
+        ready = {}
+        submitted = 0
+        next_idx = 0
+        held = None  # слот, выданный вызывающему коду, освобождается при следующем запросе
+        exhausted = False
+        in_flight = 0  # пакеты, результат которых еще не получен
+        try:
+            while True:
+                # Держим не больше prefetch пакетов в работе
+                while free and not exhausted:
+                    indices = next(batches, None)
+                    if indices is None:
+                        exhausted = True
+                        break
+                    self._tasks.put((submitted, free.pop(), indices, epoch))
+                    submitted += 1
+                    in_flight += 1
+                if next_idx == submitted:
+                    break
+                while next_idx not in ready:
+                    batch_idx, slot, n, error = self._results.get()
+                    in_flight -= 1
+                    if error is not None:
+                        raise RuntimeError(f"Error loading batch {batch_idx}: {error}")
+                    ready[batch_idx] = (slot, n)
+                slot, n = ready.pop(next_idx)
+                next_idx += 1
+                if held is not None:
+                    free.append(held)
+                held = slot
+                images, labels = self._slots[slot]
+                yield (images[:n].copy(), labels[:n].copy()) if self.copy else (images[:n], labels[:n])
+        finally:
+            # Прерванная эпоха или ошибка: дожидаемся пакетов в работе, чтобы слоты не переписывались позже
+            while in_flight:
+                try:
+                    self._results.get(timeout=1)
+                    in_flight -= 1
+                except queue.Empty:
+                    if not any(process.is_alive() for process in self._pool):
+                        break
+
+    def __iter__(self):
+        """Yields (images uint8 (B, H, W), labels int64 (B,)) for one epoch; the next call gives the next epoch"""
+        epoch = self.epoch
+        self.epoch += 1
+        if self.workers == 0:
+            return self._iter_local(epoch)
+        return self._iter_workers(epoch)
+
+    def close(self):
+        """Stops the workers and frees the shared memory"""
+        if self._pool is not None:
+            for _ in self._pool:
+                self._tasks.put(None)
+            for process in self._pool:
+                process.join(timeout=5)
+                if process.is_alive():
+                    process.terminate()
+            self._pool = None
+        if self._shm is not None:
+            self._slots = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+def measure_throughput(loader, max_batches=None):
+    """
+    Iterate one epoch (or max_batches) and measure loading speed.
+
+    Returns:
+        Dictionary with images, seconds, images_per_second and samples per category
+    """
+    counts = Counter()
+    images = 0
+    start = time.perf_counter()
+    for i, (batch, labels) in enumerate(loader):
+        images += len(batch)
+        counts.update(loader.categories[label] for label in labels.tolist())
+        if max_batches is not None and i + 1 >= max_batches:
+            break
+    seconds = time.perf_counter() - start
+    return {'images': images, 'seconds': seconds,
+            'images_per_second': images / seconds if seconds else 0.0,
+            'category_counts': dict(sorted(counts.items()))}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure training loader throughput on the augmented dataset')
+    parser.add_argument('path', nargs='?', default='augmented_dataset',
+                        help='augmented_dataset folder or tar shard directory; with --virtual: mass_images')
+    parser.add_argument('--virtual', action='store_true',
+                        help='Generate rotations/flips on the fly from source images (virtual_dataset.py)')
+    parser.add_argument('--clahe', default=None, help='CLAHE images for --virtual (default: computed)')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--image-size', type=int, nargs=2, default=(512, 512), metavar=('HEIGHT', 'WIDTH'))
+    parser.add_argument('--workers', type=int, default=4, help='Worker processes (0 = in-process)')
+    parser.add_argument('--prefetch', type=int, default=None, help='Batches loaded ahead (default: 2 per worker)')
+    parser.add_argument('--no-stratify', action='store_true', help='Shuffle all samples instead of balancing categories')
+    parser.add_argument('--augment', action='store_true', help='Apply batched intensity/geometry augmentation')
+    parser.add_argument('--batches', type=int, default=None, help='Stop after this many batches')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.virtual:
+        from virtual_dataset import VirtualAugmentedDataset
+        source = VirtualSource(VirtualAugmentedDataset(args.path, args.clahe, seed=args.seed))
+    else:
+        source = open_source(args.path)
+    with TrainingLoader(source, args.batch_size, args.image_size, args.workers, args.prefetch,
+                        stratified=not args.no_stratify, seed=args.seed, augment=args.augment) as loader:
+        print(f"{len(source)} samples in {len(loader.categories)} categories, {len(loader)} batches per epoch")
+        result = measure_throughput(loader, args.batches)
+    print(f"{result['images']} images in {result['seconds']:.2f} s: {result['images_per_second']:.1f} images/s")
+    print("\nSamples per category:")
+    for category, count in result['category_counts'].items():
+        print(f"{category}: {count}")
@@ -0,0 +1,161 @@
+import os
+import importlib
+import threading
+from pathlib import Path
+from collections import Counter, OrderedDict
+
+import cv2
+import numpy as np
+
+from clahe import apply_clahe
+from array_store import ArrayStore, is_array_store
+from image_io import READ_EXTENSIONS, read_image, find_image
+
+# Имя файла скрипта аугментации содержит кириллическую букву
+augmentation = importlib.import_module('Comb_Auп_for_Orig_and_CLAHE_Images')
+
+def build_variants(rotation_angles=augmentation.ROTATION_ANGLES):
+    """
+    Returns list of (source, angle, flip) for one image in the order the
+    augmentation script writes them; source is 'orig' or 'clahe', flip is None, 'hflip' or 'vflip'
+    """
+    variants = [('orig', None, None), ('clahe', None, None)]
+    for angle in rotation_angles:
+        for flip in (None, 'hflip', 'vflip'):
+            for source in ('orig', 'clahe'):
+                variants.append((source, angle, flip))
+    return variants
+
+def variant_name(img_file, source, angle, flip):
+    """Returns file name used in augmented_dataset for the variant"""
+    if angle is None:
+        return f"{source}_{img_file}"
+    if flip is None:
+        return f"rotation_{angle}_{source}_{img_file}"
+    return f"rotation_{angle}_{source}_{flip}_{img_file}"
+
+class VirtualAugmentedDataset:
+    """
+    Indexable replacement for the augmented_dataset folder.
+
+    Index i maps deterministically to (source image, orig/CLAHE, angle, flip) and the
+    sample is produced on access from cached source images. Names and per-category
+    counts match the folder written by process_and_augment_images.
+    """
+
+    def __init__(self, orig_base_path, clahe_base_path=None, rotation_angles=None,
+                 seed=0, cache_size=16, clip_limit=2.0, tile_grid_size=(8, 8)):
+        """
+        Args:
+            orig_base_path: Original images (mass_images folders or array store)
+            clahe_base_path: CLAHE images; if None, CLAHE is computed from the originals
+            rotation_angles: Rotation angles (defaults to the augmentation script's angles)
+            seed: Seed for the ±1° rotation jitter; the same index always gives the same image
+            cache_size: Number of source images kept in memory
+            clip_limit, tile_grid_size: CLAHE parameters used when clahe_base_path is None
+        """
+        self.orig_base_path = orig_base_path
+        self.clahe_base_path = clahe_base_path
+        self.seed = seed
+        self.cache_size = cache_size
+        self.clahe_params = (clip_limit, tile_grid_size)
+        self.variants = build_variants(rotation_angles or augmentation.ROTATION_ANGLES)
+
+        self._orig_store = ArrayStore(orig_base_path) if is_array_store(orig_base_path) else None
+        self._clahe_store = (ArrayStore(clahe_base_path)
+                             if clahe_base_path and is_array_store(clahe_base_path) else None)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Список исходных изображений: (category, img_file)
+        self.sources = []
+        if self._orig_store is not None:
+            for category in self._orig_store.categories():
+                self.sources.extend((category, f"{name}.png") for name in self._orig_store.names(category))
+        else:
+            for category in sorted(os.listdir(orig_base_path)):
+                category_dir = os.path.join(orig_base_path, category)
+                if os.path.isdir(category_dir) and not category.startswith('.'):
+                    self.sources.extend((category, f) for f in sorted(os.listdir(category_dir))
+                                        if f.lower().endswith(READ_EXTENSIONS))
+
+    def __len__(self):
+        return len(self.sources) * len(self.variants)
+
+    def locate(self, idx):
+        """Returns (category, img_file, source, angle, flip) for index"""
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(f"Index {idx} out of range")
+        source_idx, variant_idx = divmod(idx, len(self.variants))
+        category, img_file = self.sources[source_idx]
+        return (category, img_file) + self.variants[variant_idx]
+
+    def name(self, idx):
+        """Returns augmented_dataset-relative path of the sample, e.g. Density1+Benign/orig_123.png"""
+        category, img_file, source, angle, flip = self.locate(idx)
+        return f"{category}/{variant_name(img_file, source, angle, flip)}"
+
+    def category_counts(self):
+        """Returns Counter of samples per category"""
+        counts = Counter(category for category, _ in self.sources)
+        return Counter({category: n * len(self.variants) for category, n in counts.items()})
+
+    def _read(self, store, base_path, category, name):
+        if store is not None:
+            return store.get(category, Path(name).stem)
+        # CLAHE может быть сохранен в другом формате, чем оригинал
+        path = find_image(os.path.join(base_path, category), name)
+        return read_image(path) if path is not None else None
+
+    def load_source(self, category, img_file):
+        """Returns (orig, clahe) images for a source file, using the LRU cache"""
+        key = (category, img_file)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        orig_img = self._read(self._orig_store, self.orig_base_path, category, img_file)
+        if orig_img is None:
+            raise IOError(f"Error reading image: {category}/{img_file}")
+        if self.clahe_base_path is None:
+            clahe_img = apply_clahe(orig_img, *self.clahe_params)
+        else:
+            clahe_img = self._read(self._clahe_store, self.clahe_base_path, category, f"clahe_{img_file}")
+            if clahe_img is None:
+                raise IOError(f"Error reading image: {category}/clahe_{img_file}")
+
+        with self._lock:
+            self._cache[key] = (orig_img, clahe_img)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return orig_img, clahe_img
+
+    def __getitem__(self, idx):
+        """Returns (image, category) for index"""
+        category, img_file, source, angle, flip = self.locate(idx)
+        orig_img, clahe_img = self.load_source(category, img_file)
+        image = orig_img if source == 'orig' else clahe_img
+
+        if angle is not None:
+            # Джиттер ±1° как в скрипте аугментации, но воспроизводимый; оригинал, CLAHE
+            # и отражения используют один и тот же поворот
+            source_idx = (idx % len(self)) // len(self.variants)
+            rng = np.random.default_rng((self.seed, source_idx, angle))
+            exact_angle = augmentation.sample_angle(angle, rng=rng)
+            image = augmentation.pad_to_divisor(augmentation.rotate_image(image, exact_angle))
+            if flip == 'hflip':
+                image = cv2.flip(image, 1)
+            elif flip == 'vflip':
+                image = cv2.flip(image, 0)
+        return image, category
+
+    def export(self, output_base_path):
+        """Materialize the dataset in the augmented_dataset folder layout"""
+        for idx in range(len(self)):
+            image, _ = self[idx]
+            output_path = os.path.join(output_base_path, self.name(idx))
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            cv2.imwrite(output_path, image)